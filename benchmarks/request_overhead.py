@@ -0,0 +1,90 @@
+"""Measure the cost of passing a request through configuration middleware.
+
+    python benchmarks/request_overhead.py
+
+Each configuration middleware copies the request it is given, so this is
+the per-layer overhead of every call, even one that is served from cache.
+"""
+
+import argparse
+import timeit
+
+from haverscript import (
+    Reply,
+    Service,
+    ServiceProvider,
+    dedent,
+    fresh,
+    model,
+    options,
+)
+from haverscript.types import Contexture, Exchange, Request
+
+
+class Constant(ServiceProvider):
+    """A service that replies instantly."""
+
+    def ask(self, request: Request) -> Reply:
+        return Reply(["Hello"])
+
+    def list(self) -> list[str]:
+        return ["constant"]
+
+
+LAYERS = [
+    model("constant"),
+    options(temperature=0.5),
+    options(seed=1),
+    fresh(),
+    dedent(),
+    model("constant"),
+    options(num_ctx=4096),
+    dedent(),
+]
+
+
+def main(args: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20_000)
+    args = parser.parse_args(args)
+
+    contexture = Contexture(model="constant")
+    for i in range(10):
+        contexture = contexture.append_exchange(
+            Exchange(prompt=f"prompt {i}", images=(), reply=f"reply {i}")
+        )
+    request = Request(contexture=contexture, prompt="Hello")
+
+    def pipeline(layers):
+        middleware = layers[0]
+        for layer in layers[1:]:
+            middleware = middleware | layer
+        return middleware
+
+    def per_call(stmt) -> float:
+        return min(timeit.repeat(stmt, number=args.number, repeat=5)) / args.number
+
+    copy = per_call(
+        lambda: request.model_copy(
+            update=dict(
+                contexture=request.contexture.model_copy(update=dict(model="other"))
+            )
+        )
+    )
+    print(f"copy request and contexture: {copy * 1e6:8.2f} us")
+
+    for depth in (1, len(LAYERS)):
+        middleware = pipeline(LAYERS[:depth])
+        seconds = per_call(lambda: middleware.prepare(request))
+        print(f"prepare through {depth:2} layers: {seconds * 1e6:8.2f} us")
+
+    llm = Service(Constant()) | pipeline(LAYERS)
+    seconds = per_call(lambda: llm.pipeline().prepare(request))
+    print(f"prepare through pipeline: {seconds * 1e6:8.2f} us")
+
+    seconds = per_call(lambda: str(llm.chat("Hello")))
+    print(f"chat through {len(LAYERS):2} layers:    {seconds * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,12 +13,15 @@ from .exceptions import (
 from .haverscript import Middleware, Model, Response, Service
 from .middleware import (
     cache,
+    coalesce,
     dedent,
     echo,
     format,
     fresh,
+    hedge,
     model,
     options,
+    rate_limit,
     retry,
     stats,
     trace,
@@ -26,7 +29,15 @@ from .middleware import (
     validate,
 )
 from .ollama import connect
-from .types import LanguageModel, Reply, Request, ServiceProvider, Middleware
+from .types import (
+    AsyncReply,
+    CancellationToken,
+    LanguageModel,
+    Reply,
+    Request,
+    ServiceProvider,
+    Middleware,
+)
 
 __all__ = [
     "LLMConfigurationError",
@@ -41,12 +52,15 @@ __all__ = [
     "Response",
     "Service",
     "cache",
+    "coalesce",
     "dedent",
     "echo",
     "format",
     "fresh",
+    "hedge",
     "model",
     "options",
+    "rate_limit",
     "retry",
     "stats",
     "trace",
@@ -54,6 +68,8 @@ __all__ = [
     "validate",
     "connect",
     "LanguageModel",
+    "AsyncReply",
+    "CancellationToken",
     "Reply",
     "Request",
     "ServiceProvider",
@@ -1,22 +1,54 @@
+import argparse
+import atexit
+import hashlib
+import socket
 import sqlite3
 import json
-from dataclasses import asdict, dataclass, field, fields
-from abc import abstractmethod
-from .types import Exchange
-
-SQL_VERSION = 2
+import itertools
+import math
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
+from .exceptions import (
+    LLMConfigurationError,
+    LLMConnectivityError,
+    LLMError,
+    LLMInternalError,
+)
+from .types import Exchange, History
+
+SQL_VERSION = 7
 
 SQL_SCHEMA = f"""
 BEGIN;
 
 PRAGMA user_version = {SQL_VERSION};
 
-CREATE TABLE IF NOT EXISTS string_pool (
+CREATE TABLE IF NOT EXISTS collections (
+    id INTEGER PRIMARY KEY,         -- one row for each garbage collection
+    time REAL
+);
+
+CREATE TABLE IF NOT EXISTS codecs (
     id INTEGER PRIMARY KEY,
-    string TEXT NOT NULL UNIQUE
+    name TEXT NOT NULL,             -- zlib or zstd
+    dictionary BLOB                 -- trained zstd dictionary, if any
 );
 
-CREATE INDEX IF NOT EXISTS string_index ON string_pool(string);
+CREATE TABLE IF NOT EXISTS string_pool (
+    id INTEGER PRIMARY KEY,
+    hash BLOB NOT NULL UNIQUE,      -- digest of the string
+    string TEXT,                    -- the string, when not compressed
+    data BLOB,                      -- the compressed string
+    codec INTEGER,                  -- how data was compressed
+    FOREIGN KEY (codec)         REFERENCES codecs(id)
+);
 
 CREATE TABLE IF NOT EXISTS context (
     id INTEGER PRIMARY KEY,
@@ -24,41 +56,290 @@ CREATE TABLE IF NOT EXISTS context (
     images INTEGER NOT NULL,        -- string of list of images
     reply INTEGER NOT NULL,         -- reply from the LLM
     context INTEGER,                
+    hash BLOB,                      -- content address of the whole context
     FOREIGN KEY (prompt)        REFERENCES string_pool(id),
     FOREIGN KEY (images)        REFERENCES string_pool(id),
     FOREIGN KEY (reply)         REFERENCES string_pool(id),
     FOREIGN KEY (context)       REFERENCES interactions(id)
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS context_hash_index ON context(hash);
+
 CREATE INDEX IF NOT EXISTS context_prompt_index ON context(prompt);
 CREATE INDEX IF NOT EXISTS context_images_index ON context(images);
 CREATE INDEX IF NOT EXISTS context_reply_index ON context(reply);
-CREATE INDEX IF NOT EXISTS context_context_index ON context(context);
+-- covers finding the replies that follow a context
+CREATE INDEX IF NOT EXISTS context_lookup_index ON context(context, prompt, images, reply);
 
 CREATE TABLE IF NOT EXISTS interactions (
     id INTEGER PRIMARY KEY,
     system INTEGER,
     context INTEGER,                
     parameters INTEGER NOT NULL,     
+    created REAL,                   -- when the interaction was added (unix time)
+    accessed REAL,                  -- when the interaction was last used (unix time)
+    model INTEGER,                  -- name of the model
+    format INTEGER,                 -- requested format, as JSON
     FOREIGN KEY (system)        REFERENCES string_pool(id),
     FOREIGN KEY (context)       REFERENCES context(id),
-    FOREIGN KEY (parameters)    REFERENCES string_pool(id)
+    FOREIGN KEY (parameters)    REFERENCES string_pool(id),
+    FOREIGN KEY (model)         REFERENCES string_pool(id),
+    FOREIGN KEY (format)        REFERENCES string_pool(id)
 );
 
-CREATE INDEX IF NOT EXISTS interactions_system_index ON interactions(system);
-CREATE INDEX IF NOT EXISTS interactions_context_index ON interactions(context);
-CREATE INDEX IF NOT EXISTS interactions_parameters_index ON interactions(parameters);
-
-CREATE TEMPORARY TABLE blacklist (
-    id INTEGER PRIMARY KEY,
-    interaction INTEGER NOT NULL,
-    FOREIGN KEY (interaction)    REFERENCES interactions(id)
-);
+-- covers the whole of a lookup, from a context row
+CREATE INDEX IF NOT EXISTS interactions_lookup_index
+    ON interactions(context, system, parameters, model, format);
+CREATE INDEX IF NOT EXISTS interactions_accessed_index ON interactions(accessed);
 
 COMMIT;
 """
 
 
+def string_hash(string: str) -> bytes:
+    """The fixed-size digest of a string, used to find it in the string pool."""
+    return hashlib.blake2b(string.encode(), digest_size=16).digest()
+
+
+def context_hash(parent: bytes | None, prompt: str, images: str, reply: str) -> bytes:
+    """The content address of a context, given the content address of its parent."""
+    digest = hashlib.blake2b(parent or b"", digest_size=16)
+    for part in (prompt, images, reply):
+        data = part.encode()
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.digest()
+
+
+def context_address(context: tuple[Exchange, ...]) -> bytes | None:
+    """The content address of a context, or None for the empty context.
+
+    Each History remembers its content address, so a context that extends
+    one already seen hashes only the new exchanges.
+    """
+    context = History.of(context)
+    unhashed = []
+    node = context
+    while node.length and node.address is None:
+        unhashed.append(node)
+        node = node.previous
+    parent = node.address
+    for node in reversed(unhashed):
+        exchange = node.last
+        parent = context_hash(
+            parent, exchange.prompt, json.dumps(exchange.images), exchange.reply
+        )
+        node.address = parent
+    return parent
+
+
+def context_hashes(context: tuple[Exchange, ...]) -> list[bytes]:
+    """The content addresses of every prefix of a context."""
+    context = History.of(context)
+    context_address(context)
+    hashes = []
+    node = context
+    while node.length:
+        hashes.append(node.address)
+        node = node.previous
+    return hashes[::-1]
+
+
+def upgrade_2_to_3(conn: sqlite3.Connection) -> None:
+    """Add a content address to every context row."""
+    conn.execute("ALTER TABLE context ADD COLUMN hash BLOB")
+    hashes = {None: None}
+    # A parent context is always inserted before its children.
+    for id, parent, prompt, images, reply in conn.execute(
+        "SELECT context.id, context.context, s1.string, s2.string, s3.string FROM "
+        " context JOIN string_pool as s1 JOIN string_pool as s2 JOIN string_pool as s3 WHERE "
+        " context.prompt = s1.id AND "
+        " context.images = s2.id AND "
+        " context.reply = s3.id "
+        " ORDER BY context.id"
+    ).fetchall():
+        hashes[id] = context_hash(hashes[parent], prompt, images, reply)
+        conn.execute("UPDATE context SET hash = ? WHERE id = ?", (hashes[id], id))
+
+
+def upgrade_3_to_4(conn: sqlite3.Connection) -> None:
+    """Key the string pool on the digest of each string, not the string itself."""
+    conn.create_function("string_hash", 1, string_hash, deterministic=True)
+    conn.execute(
+        "CREATE TABLE string_pool_4 ("
+        " id INTEGER PRIMARY KEY,"
+        " hash BLOB NOT NULL UNIQUE,"
+        " string TEXT NOT NULL"
+        ")"
+    )
+    conn.execute(
+        "INSERT INTO string_pool_4 (id, hash, string)"
+        " SELECT id, string_hash(string), string FROM string_pool"
+    )
+    conn.execute("DROP TABLE string_pool")
+    conn.execute("ALTER TABLE string_pool_4 RENAME TO string_pool")
+
+
+def upgrade_4_to_5(conn: sqlite3.Connection) -> None:
+    """Allow strings in the string pool to be stored compressed."""
+    conn.execute(
+        "CREATE TABLE string_pool_5 ("
+        " id INTEGER PRIMARY KEY,"
+        " hash BLOB NOT NULL UNIQUE,"
+        " string TEXT,"
+        " data BLOB,"
+        " codec INTEGER,"
+        " FOREIGN KEY (codec) REFERENCES codecs(id)"
+        ")"
+    )
+    conn.execute(
+        "INSERT INTO string_pool_5 (id, hash, string)"
+        " SELECT id, hash, string FROM string_pool"
+    )
+    conn.execute("DROP TABLE string_pool")
+    conn.execute("ALTER TABLE string_pool_5 RENAME TO string_pool")
+
+
+def upgrade_5_to_6(conn: sqlite3.Connection) -> None:
+    """Track when interactions are added and used.
+
+    Existing interactions are treated as being added (and used) now.
+    """
+    conn.execute("ALTER TABLE interactions ADD COLUMN created REAL")
+    conn.execute("ALTER TABLE interactions ADD COLUMN accessed REAL")
+    now = time.time()
+    conn.execute("UPDATE interactions SET created = ?, accessed = ?", (now, now))
+
+
+def upgrade_6_to_7(conn: sqlite3.Connection) -> None:
+    """Add the model and format to interactions, with covering indices for lookup.
+
+    The model and format of existing interactions are unknown, so are left NULL.
+    """
+    conn.execute("ALTER TABLE interactions ADD COLUMN model INTEGER")
+    conn.execute("ALTER TABLE interactions ADD COLUMN format INTEGER")
+    # These are either prefixes of the new covering indices, or would
+    # lead the query planner away from them.
+    for index in [
+        "interactions_context_index",
+        "interactions_system_index",
+        "interactions_parameters_index",
+        "context_context_index",
+    ]:
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+
+
+UPGRADES = {
+    2: upgrade_2_to_3,
+    3: upgrade_3_to_4,
+    4: upgrade_4_to_5,
+    5: upgrade_5_to_6,
+    6: upgrade_6_to_7,
+}
+
+
+@dataclass(frozen=True)
+class Retention:
+    """How much of the cache to keep. Least recently used interactions are evicted first."""
+
+    max_rows: int | None = None  # maximum number of interactions
+    max_bytes: int | None = None  # maximum size of the (used part of the) cache file
+    max_age: float | None = None  # maximum seconds since an interaction was used
+
+
+class Codec(ABC):
+    """A compression scheme for strings in the string pool."""
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        pass
+
+
+class Zlib(Codec):
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class Zstd(Codec):
+    def __init__(self, dictionary: bytes | None = None) -> None:
+        try:
+            import zstandard
+        except ImportError:
+            raise LLMConfigurationError(
+                'compress="zstd" needs the zstandard package (haverscript[zstd])'
+            )
+        self.dictionary = dictionary and zstandard.ZstdCompressionDict(dictionary)
+        self.compressor = zstandard.ZstdCompressor(dict_data=self.dictionary)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+        self.lock = threading.Lock()  # the (de)compressors are not thread-safe
+
+    @staticmethod
+    def train(samples: list[bytes], size: int = 16 * 1024) -> bytes | None:
+        """Train a dictionary from samples, if there are enough samples."""
+        import zstandard
+
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            return None
+
+    def compress(self, data: bytes) -> bytes:
+        with self.lock:
+            return self.compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        with self.lock:
+            return self.decompressor.decompress(data)
+
+
+CODECS = {"zlib": Zlib, "zstd": Zstd}
+
+# Strings shorter than this are never compressed
+COMPRESS_MIN_LENGTH = 64
+
+# Training a zstd dictionary is tried again after this many new strings
+TRAIN_EVERY = 100
+
+# Reads check for a garbage collection by another process at most this often,
+# in seconds; writes always check.
+FORGET_EVERY = 1.0
+
+
+class LRU:
+    """A bounded map, that forgets the least recently used entries first."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def __setitem__(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
 @dataclass(frozen=True)
 class TEXT:
     id: int
@@ -82,6 +363,39 @@ class INTERACTION:
 @dataclass
 class DB:
     conn: sqlite3.Connection
+    store: "Store"
+    compress: str | None = None  # the codec used when adding strings
+    blacklisted: set[int] = field(default_factory=set)  # already used replies
+
+    def remember_string(self, text: str, id: int) -> None:
+        self.store.strings[text] = id
+
+    def remember_context(self, hash: bytes, id: int) -> None:
+        self.store.contexts[hash] = id
+
+    def find_text(self, text: str) -> TEXT:
+        """Find a string in the string pool, raising ValueError if it is not there."""
+        if text is None:
+            return TEXT(None)
+        assert isinstance(text, str), f"text={text}, expecting str"
+        if (id := self.store.strings.get(text)) is not None:
+            return TEXT(id)
+        # Retrieve the id of the string
+        if row := self.conn.execute(
+            "SELECT id FROM string_pool WHERE hash = ?", (string_hash(text),)
+        ).fetchone():
+            self.remember_string(text, row[0])
+            return TEXT(row[0])  # Return the id of the string
+        raise ValueError
+
+    def string(self, id: int) -> str:
+        """Read a string from the string pool, decompressing if needed."""
+        string, data, codec = self.conn.execute(
+            "SELECT string, data, codec FROM string_pool WHERE id = ?", (id,)
+        ).fetchone()
+        if data is None:
+            return string
+        return self.store.codec(codec).decompress(data).decode()
 
     @abstractmethod
     def text(self, text: str) -> TEXT:
@@ -89,13 +403,25 @@ class DB:
 
     @abstractmethod
     def context_row(
-        self, prompt: TEXT, images: TEXT, reply: TEXT, context: CONTEXT
+        self, prompt: TEXT, images: TEXT, reply: TEXT, context: CONTEXT, hash: bytes
     ) -> PROMPT_REPLY:
         pass
 
+    def context_hash_row(self, hash: bytes) -> CONTEXT:
+        if row := self.conn.execute(
+            "SELECT id FROM context WHERE hash = ?", (hash,)
+        ).fetchone():
+            return CONTEXT(row[0])
+        raise ValueError
+
     @abstractmethod
     def interaction_row(
-        self, system: TEXT, context: CONTEXT, parameters: TEXT
+        self,
+        system: TEXT,
+        context: CONTEXT,
+        parameters: TEXT,
+        model: TEXT,
+        format: TEXT,
     ) -> CONTEXT:
         pass
 
@@ -106,6 +432,8 @@ class DB:
         prompt: TEXT | None,
         images: TEXT | None,
         parameters: TEXT,
+        model: TEXT,
+        format: TEXT,
         limit: int | None,
         blacklist: bool = False,
     ) -> dict[INTERACTION, tuple[str, list[str], str]]:
@@ -113,6 +441,8 @@ class DB:
         interactions_args = {
             "system": system.id,
             "parameters": parameters.id,
+            "model": model.id,
+            "format": format.id,
         }
 
         context_args = {
@@ -124,13 +454,12 @@ class DB:
         if images:
             context_args["images"] = images.id
 
+        # We find the ids of the strings first, and only read
+        # (and decompress) the strings of the rows that are returned.
         rows = self.conn.execute(
-            "SELECT s1.string, s2.string, s3.string, interactions.id FROM "
-            " interactions JOIN context JOIN string_pool as s1 JOIN string_pool as s2 JOIN string_pool as s3 WHERE "
+            "SELECT context.prompt, context.images, context.reply, interactions.id FROM "
+            " interactions JOIN context WHERE "
             " interactions.context = context.id AND "
-            " context.prompt = s1.id AND "
-            " context.images = s2.id AND "
-            " context.reply = s3.id AND "
             + " AND ".join(
                 [
                     (
@@ -152,14 +481,14 @@ class DB:
                     for key in context_args.keys()
                 ]
             )
-            + (
-                " AND interactions.id NOT IN (SELECT interaction FROM blacklist) "
-                if blacklist
-                else ""
-            )
-            + (f" LIMIT {limit}" if limit else ""),
+            + (f" LIMIT {limit}" if limit and not blacklist else ""),
             interactions_args | context_args,
-        ).fetchall()
+        )
+
+        if blacklist:
+            rows = (row for row in rows if row[3] not in self.blacklisted)
+
+        rows = list(itertools.islice(rows, limit))
 
         def decode_images(txt):
             if txt == '["foo.png"]':
@@ -168,61 +497,44 @@ class DB:
             return []
 
         return {
-            INTERACTION(row[3]): (row[0], decode_images(row[1]), row[2]) for row in rows
+            INTERACTION(row[3]): (
+                self.string(row[0]),
+                decode_images(self.string(row[1])),
+                self.string(row[2]),
+            )
+            for row in rows
         }
 
     def blacklist(self, key: INTERACTION):  # stale?
-        self.conn.execute("INSERT INTO blacklist (interaction) VALUES (?)", (key.id,))
+        self.blacklisted.add(key.id)
 
 
 @dataclass
 class ReadOnly(DB):
 
     def text(self, text: str) -> TEXT:
-        if text is None:
-            return TEXT(None)
-        assert isinstance(text, str), f"text={text}, expecting str"
-        # Retrieve the id of the string
-        if row := self.conn.execute(
-            "SELECT id FROM string_pool WHERE string = ?", (text,)
-        ).fetchone():
-            return TEXT(row[0])  # Return the id of the string
-        else:
-            raise ValueError
+        return self.find_text(text)
 
     def context_row(
-        self, prompt: TEXT, images: TEXT, reply: TEXT, context: CONTEXT
+        self, prompt: TEXT, images: TEXT, reply: TEXT, context: CONTEXT, hash: bytes
     ) -> PROMPT_REPLY:
-
-        args = {
-            "prompt": prompt.id,
-            "images": images.id,
-            "reply": reply.id,
-            "context": context.id,
-        }
-
-        if row := self.conn.execute(
-            f"SELECT id FROM context WHERE "
-            + " AND ".join(
-                [
-                    f"{key} IS NULL" if args[key] is None else f"{key} = :{key}"
-                    for key in args.keys()
-                ]
-            ),
-            args,
-        ).fetchone():
-            return CONTEXT(row[0])  # Return the id of the string
-
-        raise ValueError
+        return self.context_hash_row(hash)
 
     def interaction_row(
-        self, system: TEXT, context: CONTEXT, parameters: TEXT
+        self,
+        system: TEXT,
+        context: CONTEXT,
+        parameters: TEXT,
+        model: TEXT,
+        format: TEXT,
     ) -> INTERACTION:
 
         args = {
             "system": system.id,
             "context": context.id,
             "parameters": parameters.id,
+            "model": model.id,
+            "format": format.id,
         }
 
         if row := self.conn.execute(
@@ -241,19 +553,60 @@ class ReadOnly(DB):
 
 @dataclass
 class ReadAppend(DB):
+    """Reads and writes, inside a transaction started by Store.write.
+
+    The ids of rows found, or added, are remembered for the store only
+    once the transaction has been committed.
+    """
+
+    strings: dict[str, int] = field(default_factory=dict)
+    contexts: dict[bytes, int] = field(default_factory=dict)
+    inserted: list[INTERACTION] = field(default_factory=list)
+
+    def remember_string(self, text: str, id: int) -> None:
+        self.strings[text] = id
+
+    def remember_context(self, hash: bytes, id: int) -> None:
+        self.contexts[hash] = id
+
+    def publish(self) -> None:
+        """Remember the ids for the store, now they have been committed."""
+        for text, id in self.strings.items():
+            self.store.strings[text] = id
+        for hash, id in self.contexts.items():
+            self.store.contexts[hash] = id
+
+    def discard(self) -> None:
+        """Forget the interactions added by a transaction that was rolled back."""
+        for interaction in self.inserted:
+            self.blacklisted.discard(interaction.id)
 
     def text(self, text: str) -> TEXT:
         try:
-            return ReadOnly(self.conn).text(text)
+            return self.find_text(text)
         except ValueError:
-            return TEXT(
-                self.conn.execute(
-                    "INSERT INTO string_pool (string) VALUES (?)", (text,)
-                ).lastrowid
+            string, data, codec = text, None, None
+            if self.compress and len(text) >= COMPRESS_MIN_LENGTH:
+                codec = self.store.codec_id(self.compress)
+                compressed = self.store.codec(codec).compress(text.encode())
+                if len(compressed) < len(text):
+                    string, data = None, compressed
+                else:
+                    codec = None
+            hash = string_hash(text)
+            self.conn.execute(
+                "INSERT OR IGNORE INTO string_pool (hash, string, data, codec)"
+                " VALUES (?, ?, ?, ?)",
+                (hash, string, data, codec),
             )
+            (id,) = self.conn.execute(
+                "SELECT id FROM string_pool WHERE hash = ?", (hash,)
+            ).fetchone()
+            self.remember_string(text, id)
+            return TEXT(id)
 
     def context_row(
-        self, prompt: TEXT, images: TEXT, reply: TEXT, context: CONTEXT
+        self, prompt: TEXT, images: TEXT, reply: TEXT, context: CONTEXT, hash: bytes
     ) -> CONTEXT:
         assert isinstance(prompt, TEXT), f"prompt : {type(prompt)}, expecting : TEXT"
         assert isinstance(images, TEXT), f"images : {type(images)}, expecting : TEXT"
@@ -262,18 +615,20 @@ class ReadAppend(DB):
             context, CONTEXT
         ), f"context : {type(context)}, expecting : CONTEXT"
 
-        try:
-            return ReadOnly(self.conn).context_row(prompt, images, reply, context)
-        except ValueError:
-            return CONTEXT(
-                self.conn.execute(
-                    "INSERT INTO context (prompt, images, reply, context) VALUES (?, ?, ?, ?)",
-                    (prompt.id, images.id, reply.id, context.id),
-                ).lastrowid
-            )
+        self.conn.execute(
+            "INSERT OR IGNORE INTO context (prompt, images, reply, context, hash)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (prompt.id, images.id, reply.id, context.id, hash),
+        )
+        return self.context_hash_row(hash)
 
     def interaction_row(
-        self, system: TEXT, context: CONTEXT, parameters: TEXT
+        self,
+        system: TEXT,
+        context: CONTEXT,
+        parameters: TEXT,
+        model: TEXT,
+        format: TEXT,
     ) -> INTERACTION:
         assert isinstance(system, TEXT), f"system : {type(context)}, expecting : TEXT"
         assert isinstance(
@@ -284,69 +639,511 @@ class ReadAppend(DB):
         ), f"parameters : {type(context)}, expecting : TEXT"
 
         try:
-            return ReadOnly(self.conn).interaction_row(system, context, parameters)
+            return ReadOnly(self.conn, self.store).interaction_row(
+                system, context, parameters, model, format
+            )
         except ValueError:
+            now = time.time()
             interaction = INTERACTION(
                 self.conn.execute(
-                    "INSERT INTO interactions (system, context, parameters) VALUES (?,?,?)",
-                    (system.id, context.id, parameters.id),
+                    "INSERT INTO interactions (system, context, parameters, created, accessed, model, format)"
+                    " VALUES (?,?,?,?,?,?,?)",
+                    (
+                        system.id,
+                        context.id,
+                        parameters.id,
+                        now,
+                        now,
+                        model.id,
+                        format.id,
+                    ),
                 ).lastrowid
             )
             # The idea here is that if you have just added a result of calling a LLM,
             # then in the same session you re-ask the question, you want a new answer.
             self.blacklist(interaction)
+            self.inserted.append(interaction)
             return interaction
 
 
+class Store:
+    """The per-process state of a single cache file.
+
+    Each thread gets its own connection, so readers do not block each other.
+    The blacklist is shared between all threads, because it is a property
+    of the session, not the connection.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        # Writers in this process take turns, rather than wait on SQLite.
+        self.write_lock = threading.Lock()
+        self.blacklisted: set[int] = set()
+        self.contexts = LRU(4096)  # content address to context id
+        self.strings = LRU(4096)  # string to string_pool id
+        self.collection = None  # the garbage collection that the above reflect
+        self.checked = 0.0  # when the collection was last checked
+        self.codecs: dict[int, Codec] = {}
+        self.train_at = TRAIN_EVERY  # string pool id to next try training at
+        # Bookkeeping for eviction has its own lock, because self.lock
+        # can be held by a thread waiting on the database.
+        self.usage_lock = threading.Lock()
+        self.accessed: dict[int, float] = {}  # interaction to last use, not yet saved
+        self.saved = time.monotonic()  # when uses were last saved
+        self.saving: threading.Thread | None = None
+        self.inserted = 0  # interactions added since the last eviction
+        self.evicting: threading.Thread | None = None
+        self.upgrade()
+        self.conn.executescript(SQL_SCHEMA)
+        atexit.register(self.save_accessed_now)
+
+    def upgrade(self) -> None:
+        """Upgrade an existing cache file to the current schema.
+
+        Each step is a write transaction, which checks the version again,
+        because another process may be upgrading the same file.
+        """
+        while self.upgrade_step():
+            pass
+
+    def upgrade_step(self) -> bool:
+        """Upgrade the cache file by one version, if it needs it."""
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        self.check_version(version)
+        if version in {0, SQL_VERSION}:
+            return False  # a new, or current, cache file
+        with self.write() as conn:
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            self.check_version(version)
+            if version in {0, SQL_VERSION}:
+                return False
+            UPGRADES[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        return True
+
+    def check_version(self, version: int) -> None:
+        if version > SQL_VERSION:
+            raise LLMConfigurationError(
+                f"{self.filename} uses cache schema version {version}, "
+                f"expecting version {SQL_VERSION} or earlier"
+            )
+        if version not in UPGRADES and version not in {0, SQL_VERSION}:
+            raise LLMConfigurationError(
+                f"{self.filename} uses cache schema version {version}, "
+                "which can not be upgraded"
+            )
+
+    @contextmanager
+    def write(self, db: DB | None = None):
+        """A write transaction, on this thread's connection.
+
+        BEGIN IMMEDIATE takes the write lock of the file at the start, so a
+        writer in another process waits for the whole transaction, rather
+        than failing part way through it. Any error rolls back. The ids
+        that db found are remembered only once they have been committed.
+        """
+        with self.write_lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                # a codec added by the transaction may have been remembered
+                self.codecs.clear()
+                if isinstance(db, ReadAppend):
+                    db.discard()
+                raise
+        if isinstance(db, ReadAppend):
+            db.publish()
+
+    def codec(self, id: int) -> Codec:
+        """Get the codec with a specific id."""
+        if id not in self.codecs:
+            name, dictionary = self.conn.execute(
+                "SELECT name, dictionary FROM codecs WHERE id = ?", (id,)
+            ).fetchone()
+            self.codecs[id] = Zstd(dictionary) if name == "zstd" else CODECS[name]()
+        return self.codecs[id]
+
+    def codec_id(self, name: str) -> int:
+        """Get the id of the newest codec called name, adding one if needed.
+
+        A zstd codec has a dictionary trained from the strings already in
+        the cache. Until there are enough of them, the codec has none, and
+        training is tried again every TRAIN_EVERY new strings. A trained
+        dictionary is a new codec, so strings already compressed can still
+        be read.
+        """
+        assert name in CODECS, f"unknown compression: {name}"
+        # This is only called in a write transaction, which already keeps
+        # other writers out, so self.lock is not held, and readers are not
+        # held up while a dictionary is trained.
+        row = self.conn.execute(
+            "SELECT id, dictionary FROM codecs WHERE name = ?"
+            " ORDER BY id DESC LIMIT 1",
+            (name,),
+        ).fetchone()
+        if row and (name != "zstd" or row[1] is not None or not self.trainable()):
+            return row[0]
+        dictionary = None
+        if name == "zstd":
+            dictionary = Zstd.train(self.samples())
+        if row and dictionary is None:
+            return row[0]
+        return self.conn.execute(
+            "INSERT INTO codecs (name, dictionary) VALUES (?, ?)",
+            (name, dictionary),
+        ).lastrowid
+
+    def trainable(self) -> bool:
+        """Whether to try training a zstd dictionary again, given the new strings."""
+        (newest,) = self.conn.execute("SELECT max(id) FROM string_pool").fetchone()
+        with self.usage_lock:
+            if (newest or 0) < self.train_at:
+                return False
+            self.train_at = newest + TRAIN_EVERY
+            return True
+
+    def samples(self, limit: int = 1000) -> list[bytes]:
+        """The newest strings worth compressing, to train a dictionary with."""
+        return [
+            string.encode() if data is None else self.codec(codec).decompress(data)
+            for string, data, codec in self.conn.execute(
+                "SELECT string, data, codec FROM string_pool"
+                " WHERE data IS NOT NULL OR length(string) >= ?"
+                " ORDER BY id DESC LIMIT ?",
+                (COMPRESS_MIN_LENGTH, limit),
+            )
+        ]
+
+    def save_accessed(self) -> None:
+        """Write any recorded uses of interactions, as part of the current transaction."""
+        with self.usage_lock:
+            accessed, self.accessed = self.accessed, {}
+        self.conn.executemany(
+            "UPDATE interactions SET accessed = ? WHERE id = ?",
+            [(when, id) for id, when in accessed.items()],
+        )
+
+    def save_accessed_soon(self, every: float = 5.0) -> None:
+        """Save recorded uses in a background thread, at most every so many seconds.
+
+        Processes that only read the cache still record which interactions
+        are in use, so eviction (here, or by haverscript-cache gc) keeps them.
+        """
+        with self.usage_lock:
+            if (
+                not self.accessed
+                or self.saving is not None
+                or time.monotonic() - self.saved < every
+            ):
+                return
+            self.saved = time.monotonic()
+            self.saving = threading.Thread(target=self.save_accessed_now, daemon=True)
+            self.saving.start()
+
+    def save_accessed_now(self) -> None:
+        """Save recorded uses of interactions, in their own short transaction."""
+        try:
+            if self.accessed:
+                with self.write():
+                    self.save_accessed()
+        except sqlite3.Error:
+            # The file is read-only, or busy for longer than the timeout,
+            # so these uses are lost; recency is approximate.
+            pass
+        finally:
+            with self.usage_lock:
+                if self.saving is threading.current_thread():
+                    self.saving = None
+
+    def prune(self, retention: Retention, pause: float = 0.0, batch: int = 100) -> int:
+        """Evict interactions until the cache is within retention.
+
+        Interactions are evicted in small batches, pausing between them, so
+        other writers are not held up, then what they used is collected in
+        a single pass. Returns the number of interactions evicted.
+
+        Only collecting frees bytes, so with max_bytes, each batch is
+        collected before the size is checked again.
+        """
+        evicted = 0
+        collected = True
+        while count := self.evict(retention, batch):
+            evicted += count
+            collected = retention.max_bytes is not None
+            if collected:
+                with self.write():
+                    self.collect()
+            time.sleep(pause)
+        if not collected:
+            with self.write():
+                self.collect()
+        return evicted
+
+    def evict(self, retention: Retention, batch: int = 100) -> int:
+        """Evict up to batch interactions, returning the number evicted.
+
+        The contexts and strings they used are left for collect.
+        """
+        conn = self.conn
+        with self.write():
+            self.save_accessed()
+            victims = set()
+            if retention.max_age is not None:
+                victims |= {
+                    id
+                    for (id,) in conn.execute(
+                        "SELECT id FROM interactions WHERE accessed < ? LIMIT ?",
+                        (time.time() - retention.max_age, batch),
+                    )
+                }
+            excess = 0
+            (rows,) = conn.execute("SELECT count(*) FROM interactions").fetchone()
+            if retention.max_rows is not None:
+                excess = rows - retention.max_rows
+            if retention.max_bytes is not None:
+                size = self.size()
+                if size > retention.max_bytes:
+                    # the rows that the excess bytes are worth, on average
+                    excess = max(
+                        excess, math.ceil(rows * (size - retention.max_bytes) / size)
+                    )
+            if excess > 0:
+                victims |= {
+                    id
+                    for (id,) in conn.execute(
+                        "SELECT id FROM interactions ORDER BY accessed LIMIT ?",
+                        (min(excess, batch),),
+                    )
+                }
+            conn.executemany(
+                "DELETE FROM interactions WHERE id = ?", [(id,) for id in victims]
+            )
+        return len(victims)
+
+    def collect(self) -> None:
+        """Remove contexts and strings that are no longer used by any interaction."""
+        conn = self.conn
+        # Removing a context can leave its parent unused.
+        while conn.execute(
+            "DELETE FROM context WHERE"
+            " id NOT IN (SELECT context FROM interactions WHERE context IS NOT NULL) AND"
+            " id NOT IN (SELECT context FROM context WHERE context IS NOT NULL)"
+        ).rowcount:
+            pass
+        conn.execute(
+            "DELETE FROM string_pool WHERE id NOT IN ("
+            " SELECT prompt FROM context UNION"
+            " SELECT images FROM context UNION"
+            " SELECT reply FROM context UNION"
+            " SELECT system FROM interactions WHERE system IS NOT NULL UNION"
+            " SELECT model FROM interactions WHERE model IS NOT NULL UNION"
+            " SELECT format FROM interactions WHERE format IS NOT NULL UNION"
+            " SELECT parameters FROM interactions)"
+        )
+        conn.execute("INSERT INTO collections (time) VALUES (?)", (time.time(),))
+        self.forget()
+
+    def forget(self, every: float = 0.0) -> None:
+        """Forget remembered ids, if a garbage collection has happened since.
+
+        Checking is a query, so reads only check every so many seconds.
+        """
+        now = time.monotonic()
+        if now - self.checked < every:
+            return
+        self.checked = now
+        (collection,) = self.conn.execute("SELECT max(id) FROM collections").fetchone()
+        if collection != self.collection:
+            self.contexts.clear()
+            self.strings.clear()
+            self.collection = collection
+
+    def size(self) -> int:
+        """The number of bytes of the cache file that are in use."""
+        conn = self.conn
+        (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+        (page_count,) = conn.execute("PRAGMA page_count").fetchone()
+        (freelist_count,) = conn.execute("PRAGMA freelist_count").fetchone()
+        return (page_count - freelist_count) * page_size
+
+    def maintain(self, retention: Retention, every: int = 100) -> None:
+        """Evict interactions in a background thread, after every so many inserts."""
+        with self.usage_lock:
+            self.inserted += 1
+            if self.inserted < every or self.evicting is not None:
+                return
+            self.inserted = 0
+
+            def evict():
+                try:
+                    self.prune(retention, pause=0.01)
+                finally:
+                    with self.usage_lock:
+                        self.evicting = None
+
+            self.evicting = threading.Thread(target=evict, daemon=True)
+            self.evicting.start()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.filename, cached_statements=256)
+        # WAL allows readers to run concurrently with a writer, and
+        # synchronous=NORMAL avoids a sync to disk for every commit.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        try:
+            return self.local.conn
+        except AttributeError:
+            self.local.conn = self.connect()
+            return self.local.conn
+
+
 class Cache:
     connections = {}
+    lock = threading.Lock()
 
-    def __init__(self, filename: str, mode: str) -> None:
+    def __init__(
+        self,
+        filename: str,
+        mode: str,
+        compress: str | None = None,
+        blacklisted: set[int] | None = None,
+    ) -> None:
         self.version = SQL_VERSION
         self.filename = filename
         self.mode = mode
+        self.compress = compress
 
         assert mode in {"r", "a", "a+"}
+        assert compress in {None, *CODECS}, f"unknown compression: {compress}"
+
+        with Cache.lock:
+            if filename not in Cache.connections:
+                Cache.connections[filename] = Store(filename)
+            self.store = Cache.connections[filename]
+
+        # By default, the session is the whole process.
+        if blacklisted is None:
+            blacklisted = self.store.blacklisted
+        self.blacklisted = blacklisted
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.store.conn
+
+    @property
+    def db(self) -> DB:
+        """A view of the cache for writing, if the mode allows, else for reading."""
+        if self.mode in {"a", "a+"}:
+            return ReadAppend(self.conn, self.store, self.compress, self.blacklisted)
+        return self.reader
+
+    @property
+    def reader(self) -> ReadOnly:
+        """A view of the cache for reading, that never writes."""
+        return ReadOnly(self.conn, self.store, blacklisted=self.blacklisted)
+
+    def context_id(self, db: DB, hash: bytes) -> CONTEXT:
+        """Find a context by content address, remembering any we have found."""
+        if (id := self.store.contexts.get(hash)) is not None:
+            return CONTEXT(id)
+        context = db.context_hash_row(hash)
+        db.remember_context(hash, context.id)
+        return context
 
-        if (filename) in Cache.connections:
-            self.conn = Cache.connections[filename]
-        else:
-            self.conn = sqlite3.connect(
-                filename, check_same_thread=sqlite3.threadsafety != 3
-            )
-            Cache.connections[filename] = self.conn
-            self.conn.executescript(SQL_SCHEMA)
-
-        if mode in {"a", "a+"}:
-            self.db = ReadAppend(self.conn)
-        elif mode == "r":
-            self.db = ReadOnly(self.conn)
+    def context(self, db: DB, context):
+        if not isinstance(db, ReadAppend):
+            # writes check once per transaction, in insert_interactions
+            self.store.forget(FORGET_EVERY)
 
-    def context(self, context):
         if not context:
             return CONTEXT(None)
 
-        top: Exchange = context[-1]
-
-        prompt, images, reply = top.prompt, top.images, top.reply
-        context = self.context(context[:-1])
-        prompt = self.db.text(prompt)
-        images = self.db.text(json.dumps(images))
-        reply = self.db.text(reply)
-        context = self.db.context_row(prompt, images, reply, context)
-
-        return context
-
-    def insert_interaction(self, system, context, prompt, images, reply, parameters):
+        context = History.of(context)
+        try:
+            return self.context_id(db, context_address(context))
+        except ValueError:
+            if not isinstance(db, ReadAppend):
+                raise
+
+        hashes = context_hashes(context)
+
+        # Find the longest prefix of the context that is already cached,
+        # then add the rest of the context, one exchange at a time.
+        ix = len(context) - 1
+        parent = CONTEXT(None)
+        while ix > 0:
+            try:
+                parent = self.context_id(db, hashes[ix - 1])
+                break
+            except ValueError:
+                ix -= 1
+
+        for exchange, hash in zip(context[ix:], hashes[ix:]):
+            prompt = db.text(exchange.prompt)
+            images = db.text(json.dumps(exchange.images))
+            reply = db.text(exchange.reply)
+            parent = db.context_row(prompt, images, reply, parent, hash)
+            db.remember_context(hash, parent.id)
+
+        return parent
+
+    def insert_interaction(
+        self,
+        system,
+        context,
+        prompt,
+        images,
+        reply,
+        parameters,
+        model: str | None = None,
+        format: str | dict = "",
+    ) -> INTERACTION:
+        return self.insert_interactions(
+            [(system, context, prompt, images, reply, parameters, model, format)]
+        )[0]
+
+    def insert_interactions(self, interactions: list[tuple]) -> list[INTERACTION]:
+        """Insert many interactions, as a single transaction."""
+        db = self.db
+        with self.store.write(db):
+            # another process may have removed the rows that we remember
+            self.store.forget()
+            keys = [self.interaction(db, *interaction) for interaction in interactions]
+            self.store.save_accessed()
+        return keys
+
+    def interaction(
+        self,
+        db: ReadAppend,
+        system,
+        context,
+        prompt,
+        images,
+        reply,
+        parameters,
+        model: str | None = None,
+        format: str | dict = "",
+    ) -> INTERACTION:
         assert (
             prompt is not None
         ), f"should not be saving empty prompt, reply = {repr(reply)}"
         context = context + (Exchange(prompt=prompt, images=images, reply=reply),)
-        context = self.context(context)
-        system = self.db.text(system)
-        parameters = self.db.text(json.dumps(parameters))
-        self.db.interaction_row(system, context, parameters)
-        self.conn.commit()
+        context = self.context(db, context)
+        system = db.text(system)
+        parameters = db.text(json.dumps(parameters))
+        model = db.text(model)
+        format = db.text(json.dumps(format) if format else None)
+        return db.interaction_row(system, context, parameters, model, format)
 
     def lookup_interactions(
         self,
@@ -357,20 +1154,450 @@ class Cache:
         parameters: dict,
         limit: int | None,
         blacklist: bool,
+        model: str | None = None,
+        format: str | dict = "",
     ) -> dict[INTERACTION, str]:
 
-        context = self.context(context)
-        system = self.db.text(system)
+        # Lookups never write; anything not in the cache can not match.
+        db = self.reader
+        context = self.context(db, context)
+        system = db.text(system)
         if prompt:
-            prompt = self.db.text(prompt)
+            prompt = db.text(prompt)
         if images:
-            images = self.db.text(json.dumps(images))
-        parameters = self.db.text(json.dumps(parameters))
+            images = db.text(json.dumps(images))
+        parameters = db.text(json.dumps(parameters))
+        model = db.text(model)
+        format = db.text(json.dumps(format) if format else None)
 
-        return self.db.interaction_replies(
-            system, context, prompt, images, parameters, limit, blacklist
+        return db.interaction_replies(
+            system, context, prompt, images, parameters, model, format, limit, blacklist
         )
 
     def blacklist(self, key: INTERACTION):
         self.db.blacklist(key)
-        self.conn.commit()
+
+    def touch(self, key: INTERACTION):
+        """Record that an interaction has been used.
+
+        This is saved with the next write to the cache, or by
+        Store.save_accessed_soon, whichever comes first.
+        """
+        with self.store.usage_lock:
+            self.store.accessed[key.id] = time.time()
+
+
+MEMORY_LRU = ":memory-lru:"
+
+
+@dataclass(frozen=True)
+class Query:
+    """Everything that a cached reply is keyed on."""
+
+    system: str | None
+    context: tuple[Exchange, ...]
+    prompt: str | None  # None = match any
+    images: tuple[str, ...]
+    parameters: dict
+    model: str | None = None
+    format: str | dict = ""
+
+    def to_json(self) -> dict:
+        return asdict(self) | dict(
+            context=[exchange.model_dump() for exchange in self.context]
+        )
+
+    @staticmethod
+    def from_json(query: dict) -> "Query":
+        return Query(
+            **(
+                query
+                | dict(
+                    context=tuple(
+                        Exchange(**exchange) for exchange in query["context"]
+                    ),
+                    images=tuple(query["images"]),
+                )
+            )
+        )
+
+
+class Backend(ABC):
+    """Somewhere to keep cached interactions.
+
+    A backend is also a session: replies that are claimed, or inserted,
+    are not returned again by lookup.
+    """
+
+    @abstractmethod
+    def lookup(self, query: Query, claim: bool) -> tuple[INTERACTION, str] | None:
+        """Find a reply not used in this session, claiming it if asked."""
+
+    @abstractmethod
+    def claim(self, key: INTERACTION) -> bool:
+        """Claim a specific reply, returning False if it has already been used."""
+
+    @abstractmethod
+    def touch(self, key: INTERACTION) -> None:
+        """Record that a reply found elsewhere, such as in Memory, has been used."""
+
+    @abstractmethod
+    def insert(self, query: Query, reply: str) -> INTERACTION:
+        """Add a reply. The interaction may be INTERACTION(None) if not known yet."""
+
+    @abstractmethod
+    def replies(self, query: Query) -> list[tuple[str, list[str], str]]:
+        """All the (prompt, images, reply) triples that match the query."""
+
+    def flush(self) -> None:
+        """Write any pending inserts."""
+
+    @staticmethod
+    def open(
+        filename: str,
+        mode: str,
+        compress: str | None = None,
+        retention: Retention | None = None,
+    ) -> "Backend":
+        """Open the backend for a cache filename or URL.
+
+        tcp://host:port and unix:///path use a cache server, sqlite:///path
+        (or just a filename) uses a local SQLite file.
+        """
+        filename = str(filename)
+        scheme = urlsplit(filename).scheme
+        if scheme in {"tcp", "unix"}:
+            # The server decides how replies are stored, and kept;
+            # the mode is applied by the client, by what it asks for.
+            if compress is not None or retention is not None:
+                raise LLMConfigurationError(
+                    f"cache {filename}: compression and retention are"
+                    " options of the cache server, not its clients"
+                )
+            if mode not in {"r", "a", "a+"}:
+                raise LLMConfigurationError(f"cache {filename}: unknown mode {mode}")
+            return RemoteBackend.of(filename)
+        if scheme == "sqlite":
+            filename = filename.removeprefix("sqlite://")
+        return SQLiteBackend(filename, mode, compress, retention)
+
+
+class SQLiteBackend(Backend):
+    """A cache kept in a local SQLite file."""
+
+    def __init__(
+        self,
+        filename: str,
+        mode: str,
+        compress: str | None = None,
+        retention: Retention | None = None,
+        blacklisted: set[int] | None = None,
+    ) -> None:
+        self.cache = Cache(filename, mode, compress, blacklisted)
+        self.retention = retention
+
+    def lookup(self, query: Query, claim: bool) -> tuple[INTERACTION, str] | None:
+        cache = self.cache
+        while True:
+            # The query runs without the lock, so readers run at once,
+            # each on its own connection.
+            try:
+                cached = cache.lookup_interactions(
+                    query.system,
+                    query.context,
+                    query.prompt,
+                    query.images,
+                    query.parameters,
+                    limit=1,
+                    blacklist=True,
+                    model=query.model,
+                    format=query.format,
+                )
+            except ValueError:
+                # something has never been seen
+                return None
+            if not cached:
+                return None
+            key, (_, _, reply) = next(iter(cached.items()))
+            if not claim:
+                self.touch(key)
+                return key, reply
+            # Claiming is atomic, so concurrent requests are given different
+            # cached replies. A reply claimed by another thread since the
+            # query is skipped by the query, next time around.
+            if self.claim(key):
+                return key, reply
+
+    def claim(self, key: INTERACTION) -> bool:
+        cache = self.cache
+        with cache.store.lock:
+            if key.id is None or key.id in cache.blacklisted:
+                return False
+            cache.blacklist(key)
+            cache.touch(key)
+        cache.store.save_accessed_soon()
+        return True
+
+    def touch(self, key: INTERACTION) -> None:
+        if key.id is None:
+            return
+        self.cache.touch(key)
+        self.cache.store.save_accessed_soon()
+
+    def insert(self, query: Query, reply: str) -> INTERACTION:
+        key = self.cache.insert_interaction(*self.row(query, reply))
+        if self.retention is not None:
+            self.cache.store.maintain(self.retention)
+        return key
+
+    def insert_many(self, rows: list[tuple[Query, str]]) -> list[INTERACTION]:
+        keys = self.cache.insert_interactions(
+            [self.row(query, reply) for query, reply in rows]
+        )
+        if self.retention is not None:
+            for _ in keys:
+                self.cache.store.maintain(self.retention)
+        return keys
+
+    def replies(self, query: Query) -> list[tuple[str, list[str], str]]:
+        try:
+            return list(
+                self.cache.lookup_interactions(
+                    query.system,
+                    query.context,
+                    query.prompt,
+                    query.images,
+                    query.parameters,
+                    limit=None,
+                    blacklist=False,
+                    model=query.model,
+                    format=query.format,
+                ).values()
+            )
+        except ValueError:
+            return []
+
+    @staticmethod
+    def row(query: Query, reply: str) -> tuple:
+        return (
+            query.system,
+            query.context,
+            query.prompt,
+            query.images,
+            reply,
+            query.parameters,
+            query.model,
+            query.format,
+        )
+
+
+class RemoteBackend(Backend):
+    """A cache kept by a cache server (see haverscript.cache_server).
+
+    There is one session for each server, in each process, shared by a pool
+    of connections, so that calls from many threads are made at once.
+    Inserts are sent in batches, after batch_size inserts or batch_delay seconds,
+    along with the uses of replies found in Memory.
+    """
+
+    clients: dict[str, "RemoteBackend"] = {}
+    lock = threading.Lock()
+    batch_size = 32
+    batch_delay = 1.0
+    max_idle = 8  # idle connections kept open
+
+    @classmethod
+    def of(cls, url: str) -> "RemoteBackend":
+        with cls.lock:
+            if url not in cls.clients:
+                cls.clients[url] = RemoteBackend(url)
+            return cls.clients[url]
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.session = uuid.uuid4().hex
+        self.idle = []  # connections not in use
+        self.idle_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending: list[tuple[Query, str]] = []
+        self.touched: set[int] = set()  # interactions used, not yet sent
+        self.timer = None  # flushes the pending inserts, and uses
+        atexit.register(self.flush)
+
+    def connect(self):
+        url = urlsplit(self.url)
+        try:
+            if url.scheme == "unix":
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(url.path)
+            else:
+                sock = socket.create_connection((url.hostname, url.port))
+        except OSError as e:
+            raise LLMConnectivityError(f"cache server {self.url}: {e}") from e
+        file = sock.makefile("rwb")
+        # every connection joins this process's session
+        self.send(file, "session", id=self.session)
+        return file
+
+    def call(self, op: str, **args):
+        with self.idle_lock:
+            file = self.idle.pop() if self.idle else None
+        if file is None:
+            file = self.connect()
+        result = self.send(file, op, **args)
+        with self.idle_lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(file)
+                return result
+        file.close()
+        return result
+
+    def send(self, file, op: str, **args):
+        """Make one call on a connection; a connection that fails is closed."""
+        try:
+            file.write(json.dumps(dict(op=op) | args).encode() + b"\n")
+            file.flush()
+            line = file.readline()
+        except OSError as e:
+            file.close()
+            raise LLMConnectivityError(f"cache server {self.url}: {e}") from e
+        if not line:
+            file.close()
+            raise LLMConnectivityError(f"cache server {self.url}: disconnected")
+        response = json.loads(line)
+        if "error" in response:
+            raise LLMInternalError(f"cache server {self.url}: {response['error']}")
+        return response["result"]
+
+    def lookup(self, query: Query, claim: bool) -> tuple[INTERACTION, str] | None:
+        if hit := self.call("lookup", query=query.to_json(), claim=claim):
+            return INTERACTION(hit[0]), hit[1]
+        return None
+
+    def claim(self, key: INTERACTION) -> bool:
+        if key.id is None:
+            return False
+        return self.call("claim", id=key.id)
+
+    def touch(self, key: INTERACTION) -> None:
+        if key.id is None:
+            return
+        with self.pending_lock:
+            self.touched.add(key.id)
+            self.start_timer()
+
+    def insert(self, query: Query, reply: str) -> INTERACTION:
+        with self.pending_lock:
+            self.pending.append((query, reply))
+            full = len(self.pending) >= self.batch_size
+            if not full:
+                self.start_timer()
+        if full:
+            self.flush()
+        return INTERACTION(None)
+
+    def start_timer(self) -> None:
+        """Flush after batch_delay, if not already due to; pending_lock must be held."""
+        if self.timer is None:
+            self.timer = threading.Timer(self.batch_delay, self.flush_soon)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def replies(self, query: Query) -> list[tuple[str, list[str], str]]:
+        self.flush()
+        return [tuple(reply) for reply in self.call("replies", query=query.to_json())]
+
+    def flush(self) -> None:
+        """Send pending inserts, and uses."""
+        with self.pending_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, []
+            touched, self.touched = self.touched, set()
+        if pending:
+            self.call(
+                "insert", batch=[[query.to_json(), reply] for query, reply in pending]
+            )
+        if touched:
+            self.call("touch", ids=sorted(touched))
+
+    def flush_soon(self) -> None:
+        """Send pending inserts, and uses, from the timer thread."""
+        try:
+            self.flush()
+        except LLMError:
+            # The server has gone, so these inserts are lost, as they
+            # would be from a local cache that could not be written.
+            pass
+
+
+class Memory:
+    """An in-memory tier of the cache, holding the latest reply to recent requests.
+
+    Each reply is remembered with its interaction in the backend (if any),
+    so it can be claimed, as for any other cached reply.
+    """
+
+    instances: dict[tuple[str, int], "Memory"] = {}
+    lock = threading.Lock()
+
+    def __init__(self, max_entries: int) -> None:
+        self.replies = LRU(max_entries)
+
+    @classmethod
+    def of(cls, filename: str, max_entries: int) -> "Memory":
+        """The (shared) memory tier in front of this cache file."""
+        with cls.lock:
+            key = (str(filename), max_entries)
+            if key not in cls.instances:
+                cls.instances[key] = Memory(max_entries)
+            return cls.instances[key]
+
+    @staticmethod
+    def key(query: Query) -> tuple:
+        """A normalized (and hashable) version of a query."""
+        return (
+            query.system,
+            context_address(query.context),
+            query.prompt,
+            tuple(query.images),
+            json.dumps(query.parameters, sort_keys=True),
+            json.dumps(query.format, sort_keys=True),
+            query.model,
+        )
+
+    def lookup(self, key: tuple) -> tuple[INTERACTION, str] | None:
+        return self.replies.get(key)
+
+    def insert(self, key: tuple, interaction: INTERACTION, reply: str) -> None:
+        self.replies[key] = (interaction, reply)
+
+
+def main(args: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="haverscript-cache", description="Maintain a haverscript cache file."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc = commands.add_parser("gc", help="evict old interactions, and compact the file")
+    gc.add_argument("filename")
+    gc.add_argument("--max-rows", type=int, help="maximum number of interactions")
+    gc.add_argument("--max-bytes", type=int, help="maximum size of the file")
+    gc.add_argument("--max-age", type=float, help="maximum seconds since last used")
+    gc.add_argument("--no-vacuum", action="store_true", help="do not compact the file")
+    args = parser.parse_args(args)
+
+    store = Cache(args.filename, "a").store
+    retention = Retention(args.max_rows, args.max_bytes, args.max_age)
+    evicted = store.prune(retention, batch=1000)
+    if not evicted:
+        # collected anyway, to tidy up after any earlier gc
+        with store.write():
+            store.collect()
+    if not args.no_vacuum:
+        store.conn.execute("VACUUM")
+    print(f"{args.filename}: evicted {evicted} interactions, {store.size():,} bytes")
+
+
+if __name__ == "__main__":
+    main()
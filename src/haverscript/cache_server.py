@@ -0,0 +1,154 @@
+"""A cache server, so that many processes (and hosts) can share one cache.
+
+    python -m haverscript.cache_server cache.db --port 8765
+    python -m haverscript.cache_server cache.db --unix /tmp/haverscript.sock
+
+Clients use cache("tcp://host:8765") or cache("unix:///tmp/haverscript.sock").
+The protocol is one JSON object per line, in each direction. A client may
+open many connections, which share its session when they each start with
+{"op": "session", "id": ...}.
+"""
+
+import argparse
+import json
+import socketserver
+import threading
+from dataclasses import dataclass, field
+
+from .cache import CODECS, INTERACTION, Query, Retention, SQLiteBackend
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # Each connection is a session, with its own blacklist,
+        # unless it joins a session shared with other connections.
+        self.session = None
+        backend = self.backend(set())
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    if message["op"] == "session":
+                        backend = self.backend(self.join(message["id"]))
+                        result = True
+                    else:
+                        result = dispatch(backend, message)
+                    response = {"result": result}
+                except Exception as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+        finally:
+            self.leave()
+
+    def backend(self, blacklisted: set[int]) -> SQLiteBackend:
+        server = self.server
+        return SQLiteBackend(
+            server.filename, "a+", server.compress, server.retention, blacklisted
+        )
+
+    def join(self, session: str) -> set[int]:
+        """Join a session, returning its blacklist."""
+        self.leave()
+        server = self.server
+        with server.lock:
+            if session not in server.sessions:
+                server.sessions[session] = Session()
+            server.sessions[session].connections += 1
+            blacklisted = server.sessions[session].blacklisted
+        self.session = session
+        return blacklisted
+
+    def leave(self) -> None:
+        """Leave any session; it is forgotten once every connection has left."""
+        if self.session is None:
+            return
+        server = self.server
+        with server.lock:
+            session = server.sessions[self.session]
+            session.connections -= 1
+            if session.connections == 0:
+                del server.sessions[self.session]
+        self.session = None
+
+
+@dataclass
+class Session:
+    """A client process, with its blacklist, shared by its connections."""
+
+    blacklisted: set[int] = field(default_factory=set)
+    connections: int = 0
+
+
+def dispatch(backend: SQLiteBackend, message: dict):
+    op = message["op"]
+    if op == "lookup":
+        hit = backend.lookup(Query.from_json(message["query"]), message["claim"])
+        return hit and [hit[0].id, hit[1]]
+    if op == "claim":
+        return backend.claim(INTERACTION(message["id"]))
+    if op == "touch":
+        for id in message["ids"]:
+            backend.touch(INTERACTION(id))
+        return True
+    if op == "insert":
+        keys = backend.insert_many(
+            [(Query.from_json(query), reply) for query, reply in message["batch"]]
+        )
+        return [key.id for key in keys]
+    if op == "replies":
+        return backend.replies(Query.from_json(message["query"]))
+    raise ValueError(f"unknown operation: {op}")
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(
+    filename: str,
+    address: tuple[str, int] | str,
+    compress: str | None = None,
+    retention: Retention | None = None,
+) -> socketserver.BaseServer:
+    """Create a cache server; address is (host, port), or the path of a Unix socket."""
+    server = (TCPServer if isinstance(address, tuple) else UnixServer)(address, Handler)
+    server.filename = filename
+    server.compress = compress
+    server.retention = retention
+    server.sessions = {}  # by session id
+    server.lock = threading.Lock()
+    return server
+
+
+def main(args: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m haverscript.cache_server",
+        description="Share a haverscript cache file between processes.",
+    )
+    parser.add_argument("filename")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket, not TCP")
+    parser.add_argument("--compress", choices=sorted(CODECS))
+    parser.add_argument("--max-rows", type=int, help="maximum number of interactions")
+    parser.add_argument("--max-bytes", type=int, help="maximum size of the file")
+    parser.add_argument("--max-age", type=float, help="maximum seconds since last used")
+    args = parser.parse_args(args)
+
+    retention = None
+    if (args.max_rows, args.max_bytes, args.max_age) != (None, None, None):
+        retention = Retention(args.max_rows, args.max_bytes, args.max_age)
+
+    address = args.unix or (args.host, args.port)
+    with serve(args.filename, address, args.compress, retention) as server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import email.utils
+from datetime import datetime, timezone
+
+
 class LLMError(Exception):
     """Base exception for all LLM-related errors."""
 
@@ -21,6 +25,28 @@ class LLMPermissionError(LLMRequestError):
 class LLMRateLimitError(LLMRequestError):
     """Exception raised when the rate limit is exceeded with the LLM service."""
 
+    def __init__(self, message: str = "", retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after  # seconds the service asked us to wait
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header, which is seconds or an HTTP date."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        # -0000 means UTC, with no claim about local time
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
 
 class LLMResponseError(LLMError):
     """Exception raised for errors occurring during the response from the LLM."""
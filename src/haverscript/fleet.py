@@ -0,0 +1,300 @@
+"""Balance requests over a fleet of ollama hosts.
+
+    from haverscript.fleet import connect
+    model = connect("mistral", ["http://gpu1:11434", "http://gpu2:11434"])
+
+Each host is an ordinary Ollama provider; the fleet picks one per request.
+"""
+
+import logging as log
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable
+
+from .exceptions import LLMConnectivityError
+from .haverscript import Model, Service
+from .middleware import model
+from .ollama import Ollama, Pool
+from .types import AsyncReply, CancellationToken, Reply, Request, ServiceProvider
+
+logger = log.getLogger("haverscript")
+
+LEAST_OUTSTANDING = "least-outstanding"  # the host with fewest open replies
+RESIDENCY = "residency"  # a host with the model loaded, then fewest open replies
+
+
+def tagged(model: str | None) -> str | None:
+    """The model name with its tag, as ollama lists loaded models."""
+    if model is None or ":" in model.rsplit("/", 1)[-1]:
+        return model
+    return f"{model}:latest"
+
+
+class Host:
+    """An ollama host, and what the fleet knows about it."""
+
+    def __init__(
+        self,
+        hostname: str,
+        pool: Pool | None = None,
+        keep_alive: float | str | None = None,
+    ) -> None:
+        self.hostname = hostname
+        self.ollama = Ollama(hostname, pool, keep_alive)
+        self.outstanding = 0  # replies not yet closed
+        self.models = set()  # models loaded, as far as we know
+        self.ejected_until = 0.0  # in time.monotonic() seconds
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def __repr__(self):
+        return f"Host({self.hostname!r})"
+
+
+class Fleet(ServiceProvider):
+    """A ServiceProvider that balances requests over many ollama hosts.
+
+    Requests in the same conversation go to the same host, so that the
+    host can reuse its cache of the context. Other requests go to the host
+    with fewest open replies, preferring hosts with the model already
+    loaded when routing by residency.
+
+    A host that raises LLMConnectivityError is ejected for eject_for
+    seconds, and the request is tried on another host. A background
+    thread checks every host each health_interval seconds, finding which
+    models are loaded, and bringing recovered hosts back.
+    """
+
+    def __init__(
+        self,
+        hostnames: list[str],
+        routing: str = RESIDENCY,
+        pool: Pool | None = None,
+        health_interval: float | None = 10.0,
+        eject_for: float = 30.0,
+        max_sessions: int = 10_000,
+        keep_alive: float | str | None = None,
+    ) -> None:
+        assert hostnames, "a fleet needs at least one host"
+        assert routing in (LEAST_OUTSTANDING, RESIDENCY), f"unknown routing {routing}"
+        self.hosts = [Host(hostname, pool, keep_alive) for hostname in hostnames]
+        self.routing = routing
+        self.health_interval = health_interval
+        self.eject_for = eject_for
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # session key -> Host, least recent first
+        self.lock = threading.Lock()
+        self.checker = None  # the health check thread, started on first use
+
+    def session(self, request: Request) -> tuple:
+        """The key shared by every request in a conversation."""
+        contexture = request.contexture
+        first = contexture.context[0] if contexture.context else request
+        return (contexture.model, contexture.system, first.prompt, first.images)
+
+    def choose(self, request: Request, tried: list[Host]) -> Host | None:
+        """Pick a host for a request, and count the request as outstanding."""
+        now = time.monotonic()
+        key = self.session(request)
+        model = tagged(request.contexture.model)
+        with self.lock:
+            hosts = [
+                host for host in self.hosts if host.healthy(now) and host not in tried
+            ]
+            if not hosts:
+                return None
+            host = self.sessions.get(key)
+            if host in hosts:
+                self.sessions.move_to_end(key)
+            else:
+                if self.routing == RESIDENCY:
+                    hosts = [host for host in hosts if model in host.models] or hosts
+                host = min(hosts, key=lambda host: host.outstanding)
+                self.sessions[key] = host
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            host.outstanding += 1
+            # asking for a model loads it
+            host.models.add(model)
+            return host
+
+    def release(self, host: Host) -> Callable[[], None]:
+        """A callback, to call (at least) once the reply from host is closed."""
+        released = False
+
+        def release():
+            nonlocal released
+            with self.lock:
+                if not released:
+                    released = True
+                    host.outstanding -= 1
+
+        return release
+
+    def eject(self, host: Host) -> None:
+        with self.lock:
+            host.ejected_until = time.monotonic() + self.eject_for
+            host.models.clear()
+
+    def check(self) -> None:
+        """Check the health, and loaded models, of every host."""
+        for host in self.hosts:
+            try:
+                models = {tagged(model) for model in host.ollama.loaded()}
+            except LLMConnectivityError:
+                self.eject(host)
+                continue
+            except Exception:
+                # any other failure, such as a malformed reply, also ejects
+                # the host, rather than stopping the checks of every host
+                logger.exception(f"health check of {host.hostname} failed")
+                self.eject(host)
+                continue
+            with self.lock:
+                host.models = models
+                host.ejected_until = 0.0
+
+    def start(self) -> None:
+        """Start checking the hosts in the background, if not already."""
+        if self.checker is not None or self.health_interval is None:
+            return
+        with self.lock:
+            if self.checker is not None:
+                return
+
+            def checking():
+                while True:
+                    self.check()
+                    time.sleep(self.health_interval)
+
+            self.checker = threading.Thread(target=checking, daemon=True)
+            self.checker.start()
+
+    def ask(self, request: Request) -> Reply:
+        self.start()
+        tried = []
+        error = None
+        while host := self.choose(request, tried):
+            release = self.release(host)
+            try:
+                reply = host.ollama.ask(request)
+            except LLMConnectivityError as e:
+                release()
+                self.eject(host)
+                tried.append(host)
+                error = e
+                continue
+            except BaseException:
+                release()
+                raise
+            return self.track(request, reply, release)
+        raise LLMConnectivityError("no healthy hosts in the fleet") from error
+
+    async def aask(self, request: Request) -> AsyncReply:
+        self.start()
+        tried = []
+        error = None
+        while host := self.choose(request, tried):
+            release = self.release(host)
+            try:
+                reply = await host.ollama.aask(request)
+            except LLMConnectivityError as e:
+                release()
+                self.eject(host)
+                tried.append(host)
+                error = e
+                continue
+            except BaseException:
+                release()
+                raise
+            return self.atrack(request, reply, release)
+        raise LLMConnectivityError("no healthy hosts in the fleet") from error
+
+    def track(
+        self, request: Request, reply: Reply, release: Callable[[], None]
+    ) -> Reply:
+        """The reply, released however it ends: read, failed, cancelled or collected."""
+
+        def streaming():
+            # Reply starts this generator, so its finally always runs
+            done = False
+            try:
+                yield from reply
+                done = True
+            finally:
+                if not done:
+                    reply.cancel()
+                release()
+
+        if request.cancellation is not None:
+            request.cancellation.on_cancel(release)
+        return Reply(streaming())
+
+    def atrack(
+        self, request: Request, reply: AsyncReply, release: Callable[[], None]
+    ) -> AsyncReply:
+        """As track, for an AsyncReply."""
+
+        async def streaming():
+            try:
+                async for packet in reply:
+                    yield packet
+            finally:
+                release()
+
+        # An AsyncReply does not start its generator, so a reply that is
+        # never read is released when it is cancelled or collected.
+        async_reply = AsyncReply(streaming())
+        async_reply.cancellation = CancellationToken()
+        async_reply.cancellation.on_cancel(reply.cancel)
+        async_reply.cancellation.on_cancel(release)
+        weakref.finalize(async_reply, release)
+        if request.cancellation is not None:
+            request.cancellation.on_cancel(release)
+        return async_reply
+
+    def list(self) -> list[str]:
+        models = set()
+        for host in self.hosts:
+            try:
+                models.update(host.ollama.list())
+            except LLMConnectivityError:
+                self.eject(host)
+        return sorted(models)
+
+
+def connect(
+    model_name: str | None,
+    hostnames: list[str],
+    routing: str = RESIDENCY,
+    max_connections: int = 100,
+    keepalive: float = 5.0,
+    timeout: float | None = None,
+    health_interval: float | None = 10.0,
+    eject_for: float = 30.0,
+    keep_alive: float | str | None = None,
+) -> Model | Service:
+    """return a model or service that balances requests over the given hosts.
+
+    routing is RESIDENCY (the default) or LEAST_OUTSTANDING. The pool
+    options, and keep_alive, are used for each host, as in ollama.connect.
+    """
+
+    pool = Pool(max_connections=max_connections, keepalive=keepalive, timeout=timeout)
+    fleet = Fleet(
+        hostnames,
+        routing=routing,
+        pool=pool,
+        health_interval=health_interval,
+        eject_for=eject_for,
+        keep_alive=keep_alive,
+    )
+    service = Service(fleet)
+
+    if model_name:
+        service = service | model(model_name)
+
+    return service
@@ -1,20 +1,26 @@
 from __future__ import annotations
 
+import asyncio
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field, replace
+from functools import cached_property
 
 from pydantic import BaseModel
 
 from .types import (
+    CancellationToken,
     ServiceProvider,
     Metrics,
     Contexture,
     Request,
     Reply,
+    AsyncReply,
     Exchange,
     EmptyMiddleware,
+    Pipeline,
 )
-from .exceptions import LLMInternalError
+from .exceptions import LLMInternalError, LLMResultError
 from .middleware import Middleware, CacheMiddleware
 from .render import render_interaction, render_system
 
@@ -27,6 +33,11 @@ class Settings:
 
     middleware: Middleware = field(default_factory=EmptyMiddleware)
 
+    @cached_property
+    def pipeline(self) -> Pipeline:
+        """The middleware, compiled once, as Settings are frozen."""
+        return Pipeline.compile(self.middleware, self.service)
+
 
 @dataclass(frozen=True)
 class Service(ABC):
@@ -95,12 +106,117 @@ class Model(ABC):
 
         request = self.request(prompt, images=images)
 
+        pipeline = self.pipeline()
         if middleware is not None:
-            middleware = self.settings.middleware | middleware
+            response = middleware.invoke(request=request, next=pipeline)
         else:
-            middleware = self.settings.middleware
+            response = pipeline.ask(request)
+        response.cancellation = request.cancellation
+        # process makes the reply's text into a Response
+        response.keep_text()
+
+        return (request, response)
+
+    def chat_many(
+        self,
+        prompts: list[str],
+        middleware: Middleware | None = None,
+        max_concurrency: int = 8,
+    ) -> list[Response | Exception]:
+        """
+        Call the LLM with many independent prompts, in the same context.
+
+        The prompts are run concurrently, using at most max_concurrency threads.
+
+        Args:
+            prompts (list): the prompts
+            middleware (Middleware): extra middleware for each prompt
+            max_concurrency (int): the maximum number of calls in flight at once
+
+        Returns:
+            A list of Responses, in the same order as the prompts.
+            If a specific chat raised an exception, the exception is
+            returned in place of the Response.
+        """
+        assert max_concurrency > 0
+
+        def chat(prompt: str) -> Response | Exception:
+            try:
+                return self.chat(prompt, middleware=middleware)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(chat, prompts))
+
+    async def achat_many(
+        self,
+        prompts: list[str],
+        middleware: Middleware | None = None,
+        max_concurrency: int = 8,
+    ) -> list[Response | Exception]:
+        """The asyncio version of chat_many."""
+        assert max_concurrency > 0
+
+        semaphore = asyncio.Semaphore(max_concurrency)
 
-        response = middleware.invoke(request=request, next=self.settings.service)
+        async def achat(prompt: str) -> Response:
+            async with semaphore:
+                return await self.achat(prompt, middleware=middleware)
+
+        return await asyncio.gather(
+            *[achat(prompt) for prompt in prompts], return_exceptions=True
+        )
+
+    async def achat(
+        self,
+        prompt: str,
+        images: list[str] = [],
+        middleware: Middleware | None = None,
+    ) -> Response:
+        """
+        Take a prompt and call the LLM in a previously provided context, using asyncio.
+
+        Args:
+            prompt (str): the prompt
+            images: (list): images to pass to the LLM
+            middleware (Middleware): extra middleware specifically for this prompt
+
+        Returns:
+            A Response that contains the reply, and context for any future
+            calls to chat.
+        """
+        request, response = await self.aask(prompt, images, middleware)
+
+        return await self.aprocess(request, response)
+
+    async def aask(
+        self,
+        prompt: str,
+        images: list[str] = [],
+        middleware: Middleware | None = None,
+    ) -> tuple[Request, AsyncReply]:
+        """
+        Take a prompt and call the LLM in a previously provided context, using asyncio.
+
+        Args:
+            prompt (str): the prompt
+            images: (list): images to pass to the LLM
+            middleware (Middleware): extra middleware specifically for this prompt
+
+        Returns:
+            An internal Request/AsyncReply pair.
+        """
+        assert prompt is not None, "Can not build a response with no prompt"
+
+        request = self.request(prompt, images=images)
+
+        pipeline = self.pipeline()
+        if middleware is not None:
+            response = await middleware.ainvoke(request=request, next=pipeline)
+        else:
+            response = await pipeline.aask(request)
+        response.cancellation = request.cancellation
 
         return (request, response)
 
@@ -114,6 +230,16 @@ class Model(ABC):
             value=response.value,
         )
 
+    async def aprocess(self, request: Request, response: AsyncReply) -> "Response":
+
+        return self.response(
+            request.prompt,
+            await response.text(),
+            images=tuple(request.images),
+            metrics=await response.metrics(),
+            value=await response.value(),
+        )
+
     def request(
         self,
         prompt: str | None,
@@ -129,6 +255,7 @@ class Model(ABC):
             format=format,
             fresh=fresh,
             stream=stream,
+            cancellation=CancellationToken(),
         )
 
     def response(
@@ -137,12 +264,13 @@ class Model(ABC):
         reply: str,
         images: list[str] = [],
         metrics: Metrics | None = None,
-        value: BaseModel | dict | None = None,
+        value: BaseModel | dict | list | str | int | float | bool | None = None,
     ):
         assert isinstance(prompt, str)
         assert isinstance(reply, str)
         assert isinstance(metrics, (Metrics, type(None)))
-        assert isinstance(value, (BaseModel, dict, type(None)))
+        if not isinstance(value, (BaseModel, dict, list, str, int, float, type(None))):
+            raise LLMResultError(f"reply value is not JSON, or a BaseModel: {value!r}")
         return Response(
             settings=self.settings,
             contexture=self.contexture.append_exchange(
@@ -153,11 +281,14 @@ class Model(ABC):
             value=value,
         )
 
+    def pipeline(self) -> Pipeline:
+        """The middleware of this model, flattened, outermost first."""
+        return self.settings.pipeline
+
     def children(self, prompt: str | None = None, images: list[str] | None = []):
         """Return all already cached replies to this prompt."""
 
-        service = self.settings.service
-        first = self.settings.middleware.first()
+        first = self.pipeline().first()
 
         if not isinstance(first, CacheMiddleware):
             # only top-level cache can be interrogated.
@@ -165,7 +296,8 @@ class Model(ABC):
                 ".children(...) method needs cache to be final middleware"
             )
 
-        replies = first.children(self.request(prompt, images=images))
+        request = self.request(prompt, images=images)
+        replies = first.children(self.pipeline().prepare(request))
 
         return [
             self.response(prompt_, prose, images=list(images))
@@ -251,7 +383,7 @@ class Response(Model):
 
     parent: Model
     metrics: Metrics | None
-    value: BaseModel | dict | None
+    value: BaseModel | dict | list | str | int | float | bool | None
 
     @property
     def prompt(self) -> str:
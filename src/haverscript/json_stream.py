@@ -0,0 +1,174 @@
+"""Incremental JSON parsing, for replies that arrive a token at a time."""
+
+import json
+import re
+
+from .exceptions import LLMResultError
+
+_WHITESPACE = " \t\n\r"
+_NUMBER = set("0123456789+-.eE")
+_LITERALS = {"true": True, "false": False, "null": None}
+_STRING_BODY = re.compile(r'[^"\\]*')
+
+# what the parser is expecting next
+_VALUE = "value"
+_VALUE_OR_END = "value or ]"
+_KEY = "key"
+_KEY_OR_END = "key or }"
+_COLON = ":"
+_COMMA_OR_END = ", or end"
+_NOTHING = "nothing"
+
+
+class JSONStream:
+    """Parse a JSON document, a chunk at a time.
+
+    feed returns a snapshot of the outermost object (or array) each time
+    one of its fields (or elements) is complete. Snapshots only contain
+    complete fields. Any syntax error raises LLMResultError as soon as it
+    is seen, not at the end of the document.
+    """
+
+    def __init__(self) -> None:
+        self.offset = 0  # characters seen so far
+        self.stack = []  # open containers, each [container, pending key]
+        self.expecting = _VALUE
+        self.token = None  # a string, number or literal, still being read
+        self.escaped = False  # the last character of a string was a backslash
+        self.done = False
+        self.value = None
+
+    def feed(self, chunk: str) -> list[dict | list]:
+        snapshots = []
+        ix = 0
+        while ix < len(chunk):
+            if self.token is not None and self.token.startswith('"'):
+                ix = self._string(chunk, ix, snapshots)
+                continue
+            c = chunk[ix]
+            if self.token is not None:
+                if self.token[0] in _NUMBER:
+                    continues = c in _NUMBER
+                else:
+                    continues = c.isalpha()
+                if continues:
+                    self.token += c
+                    if self.token[0].isalpha() and not any(
+                        literal.startswith(self.token) for literal in _LITERALS
+                    ):
+                        self._error(f"unexpected {self.token!r}")
+                    self.offset += 1
+                    ix += 1
+                    continue
+                self._token(snapshots)
+            self._char(c, snapshots)
+            self.offset += 1
+            ix += 1
+        return snapshots
+
+    def finish(self) -> dict | list | str | int | float | bool | None:
+        """The whole document, once all chunks have been fed."""
+        if self.token is not None and not self.token.startswith('"'):
+            self._token([])
+        if not self.done:
+            self._error("incomplete JSON")
+        return self.value
+
+    def _error(self, message: str):
+        raise LLMResultError(f"invalid JSON at offset {self.offset}: {message}")
+
+    def _string(self, chunk: str, ix: int, snapshots: list) -> int:
+        """Read as much of a string as possible, returning where we stopped."""
+        start = ix
+        while ix < len(chunk):
+            if self.escaped:
+                self.token += chunk[ix]
+                self.escaped = False
+                ix += 1
+                continue
+            body = _STRING_BODY.match(chunk, ix).group()
+            self.token += body
+            ix += len(body)
+            if ix == len(chunk):
+                break
+            self.token += chunk[ix]
+            ix += 1
+            if chunk[ix - 1] == "\\":
+                self.escaped = True
+            else:
+                self.offset += ix - start
+                self._token(snapshots)
+                return ix
+        self.offset += ix - start
+        return ix
+
+    def _token(self, snapshots: list) -> None:
+        token, self.token = self.token, None
+        try:
+            value = json.loads(token)
+        except json.JSONDecodeError:
+            self._error(f"unexpected {token!r}")
+        if token.startswith('"') and self.expecting in (_KEY, _KEY_OR_END):
+            self.stack[-1][1] = value
+            self.expecting = _COLON
+            return
+        self._complete(value, snapshots)
+
+    def _char(self, c: str, snapshots: list) -> None:
+        if c in _WHITESPACE:
+            return
+        expecting = self.expecting
+        if expecting in (_VALUE, _VALUE_OR_END):
+            if c == "]" and expecting == _VALUE_OR_END:
+                self._close(snapshots)
+            elif c == "{":
+                self.stack.append([{}, None])
+                self.expecting = _KEY_OR_END
+            elif c == "[":
+                self.stack.append([[], None])
+                self.expecting = _VALUE_OR_END
+            elif c == '"' or c in _NUMBER or c in "tfn":
+                self.token = c
+            else:
+                self._error(f"expecting {expecting}, found {c!r}")
+        elif expecting in (_KEY, _KEY_OR_END):
+            if c == "}" and expecting == _KEY_OR_END:
+                self._close(snapshots)
+            elif c == '"':
+                self.token = c
+            else:
+                self._error(f"expecting {expecting}, found {c!r}")
+        elif expecting == _COLON:
+            if c != ":":
+                self._error(f"expecting :, found {c!r}")
+            self.expecting = _VALUE
+        elif expecting == _COMMA_OR_END:
+            container = self.stack[-1][0]
+            if c == ",":
+                self.expecting = _KEY if isinstance(container, dict) else _VALUE
+            elif c == ("}" if isinstance(container, dict) else "]"):
+                self._close(snapshots)
+            else:
+                self._error(f"expecting {expecting}, found {c!r}")
+        else:
+            self._error(f"unexpected {c!r} after the end of the JSON")
+
+    def _close(self, snapshots: list) -> None:
+        container, _ = self.stack.pop()
+        self._complete(container, snapshots)
+
+    def _complete(self, value, snapshots: list) -> None:
+        """A value is complete; add it to the enclosing container, if any."""
+        if not self.stack:
+            self.value = value
+            self.done = True
+            self.expecting = _NOTHING
+            return
+        container, key = self.stack[-1]
+        if isinstance(container, dict):
+            container[key] = value
+        else:
+            container.append(value)
+        self.expecting = _COMMA_OR_END
+        if len(self.stack) == 1:
+            snapshots.append(container.copy())
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-import builtins
+import asyncio
+import hashlib
 import json
 import logging as log
 import os
@@ -9,22 +10,36 @@ import re
 import textwrap
 import threading
 import time
+import weakref
 from abc import ABC, abstractmethod
 from copy import deepcopy
-from dataclasses import dataclass, field
+from collections import deque
+from dataclasses import dataclass, field, replace
 from datetime import datetime
-from typing import Callable, Type
+from typing import Callable, ClassVar, Type
 
-from pydantic import BaseModel
-from tenacity import RetryError, Retrying
+from pydantic import BaseModel, ValidationError
+from tenacity import AsyncRetrying, RetryError, Retrying
 from yaspin import yaspin
 
-from .cache import Cache
-from .exceptions import LLMError, LLMResultError
+from .cache import INTERACTION, MEMORY_LRU, Backend, Memory, Query, Retention
+from .exceptions import (
+    LLMConfigurationError,
+    LLMError,
+    LLMRateLimitError,
+    LLMResultError,
+)
+from .json_stream import JSONStream
 from .types import (
+    AsyncReply,
+    CancellationToken,
     Exchange,
     Informational,
     LanguageModel,
+    Metrics,
+    MiddlewareLanguageModel,
+    Packet,
+    Pipeline,
     Reply,
     Request,
     Value,
@@ -74,29 +89,528 @@ class RetryMiddleware(Middleware):
         except RetryError as e:
             raise LLMResultError()
 
+    async def ainvoke(self, request: Request, next: LanguageModel):
+        try:
+            async for attempt in AsyncRetrying(**self.options):
+                with attempt:
+                    return await next.aask(request=request)
+        except RetryError as e:
+            raise LLMResultError()
+
 
 def retry(**options) -> Middleware:
     """retry uses tenacity to wrap the LLM request-response action in retry options."""
     return RetryMiddleware(options)
 
 
+class Bucket:
+    """A token bucket, holding up to a second's worth of tokens, and at least one.
+
+    Taking more tokens than are in the bucket leaves it in debt.
+    """
+
+    def __init__(self, rate: float | None) -> None:
+        self.rate = rate  # None is unlimited
+        # a request takes a whole token, even at less than one a second
+        self.capacity = 0.0 if rate is None else max(rate, 1.0)
+        self.level = self.capacity
+        self.time = time.monotonic()
+
+    def fill(self, now: float) -> None:
+        if self.rate is not None:
+            self.level = min(self.capacity, self.level + (now - self.time) * self.rate)
+        self.time = now
+
+    def wait(self, now: float) -> float:
+        """How long until a token can be taken."""
+        self.fill(now)
+        if self.rate is None or self.level >= 1:
+            return 0.0
+        return (1 - self.level) / self.rate
+
+    def take(self, now: float, tokens: float) -> None:
+        self.fill(now)
+        self.level -= tokens
+
+
+class Limiter:
+    """Throttling for one provider and model, shared by every rate_limit.
+
+    Buckets bound requests, and LLM tokens, per second. The number of
+    requests in flight is adjusted by AIMD: it grows by one for each window
+    of successful requests, and halves when the service limits our rate.
+    """
+
+    limiters = {}
+    limiters_lock = threading.Lock()
+
+    def __init__(
+        self,
+        requests_per_second: float | None,
+        tokens_per_second: float | None,
+        max_concurrency: int,
+    ) -> None:
+        self.parameters = (requests_per_second, tokens_per_second, max_concurrency)
+        self.requests = Bucket(requests_per_second)
+        self.tokens = Bucket(tokens_per_second)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)  # the AIMD window
+        self.in_flight = 0
+        self.paused_until = 0.0  # from Retry-After
+        self.condition = threading.Condition()
+
+    @classmethod
+    def of(cls, key: tuple, *args) -> Limiter:
+        with cls.limiters_lock:
+            if key not in cls.limiters:
+                cls.limiters[key] = cls(*args)
+            limiter = cls.limiters[key]
+        if args != limiter.parameters:
+            raise LLMConfigurationError(
+                f"rate_limit{args} conflicts with rate_limit{limiter.parameters}"
+                f" for the same provider and model {key}"
+            )
+        return limiter
+
+    def poll(self) -> float | None:
+        """Take a slot if a request may be made now, returning 0.0.
+
+        Otherwise, return how long until a request may be made, or None
+        if that waits on a request in flight completing.
+        """
+        with self.condition:
+            if self.in_flight >= int(self.concurrency):
+                return None
+            now = time.monotonic()
+            wait = max(
+                self.paused_until - now,
+                self.requests.wait(now),
+                self.tokens.wait(now),
+            )
+            if wait > 0:
+                return wait
+            self.requests.take(now, 1)
+            self.in_flight += 1
+            return 0.0
+
+    def acquire(self) -> None:
+        """Wait until a request may be made."""
+        with self.condition:
+            while (wait := self.poll()) != 0:
+                self.condition.wait(wait)
+
+    async def aacquire(self, interval: float = 0.01) -> None:
+        """Wait until a request may be made, without taking a worker thread.
+
+        Releases happen on other threads, so waiting on a request in flight
+        polls, every interval seconds.
+        """
+        while (wait := self.poll()) != 0:
+            await asyncio.sleep(interval if wait is None else wait)
+
+    def release(self, tokens: int = 0) -> None:
+        """A request has completed, using this many LLM tokens."""
+        with self.condition:
+            self.in_flight -= 1
+            self.tokens.take(time.monotonic(), tokens)
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1 / self.concurrency
+            )
+            self.condition.notify_all()
+
+    def failed(self, tokens: int = 0) -> None:
+        """A request has failed, or was cancelled, using this many LLM tokens.
+
+        Its slot is given back, but it is not a success, so the window
+        does not grow.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.tokens.take(time.monotonic(), tokens)
+            self.condition.notify_all()
+
+    def limited(self, retry_after: float | None) -> None:
+        """A request was refused by the service."""
+        with self.condition:
+            self.in_flight -= 1
+            self.concurrency = max(1.0, self.concurrency / 2)
+            if retry_after is None:
+                # without a hint, wait for a request's worth of quota
+                retry_after = 1 / (self.requests.rate or 1)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.condition.notify_all()
+
+
+class Slot:
+    """A request's place in a Limiter, given back once, however its reply ends."""
+
+    def __init__(self, limiter: Limiter) -> None:
+        self.limiter = limiter
+        self.metrics = None
+        self.released = False
+
+    def observe(self, packet: Packet) -> None:
+        if isinstance(packet, Metrics) and self.metrics is None:
+            self.metrics = packet
+
+    def release(self, succeeded: bool = False) -> None:
+        with self.limiter.condition:
+            if self.released:
+                return
+            self.released = True
+        if succeeded:
+            self.limiter.release(_tokens(self.metrics))
+        else:
+            self.limiter.failed(_tokens(self.metrics))
+
+
+def _tokens(metrics: Metrics | None) -> int:
+    """The LLM tokens used, as reported by the provider, if known."""
+    if metrics is None:
+        return 0
+    if (total := getattr(metrics, "total_tokens", None)) is not None:
+        return total
+    return getattr(metrics, "prompt_eval_count", 0) + getattr(metrics, "eval_count", 0)
+
+
+@dataclass(frozen=True)
+class RateLimitMiddleware(Middleware):
+    requests_per_second: float | None
+    tokens_per_second: float | None
+    max_concurrency: int
+    retries: int
+
+    def invoke(self, request: Request, next: LanguageModel) -> Reply:
+        limiter = self.limiter(request, next)
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            try:
+                reply = next.ask(request=request)
+            except LLMRateLimitError as e:
+                limiter.limited(e.retry_after)
+                if attempt == self.retries:
+                    raise
+                continue
+            except BaseException:
+                limiter.failed()
+                raise
+            break
+
+        slot = Slot(limiter)
+
+        def streaming():
+            # The slot is released when the reply is read, cancelled,
+            # closed, or garbage collected, which all close this generator.
+            # (Reply starts the generator, so its finally always runs.)
+            done = False
+            try:
+                for packet in reply:
+                    slot.observe(packet)
+                    yield packet
+                done = True
+            finally:
+                if not done:
+                    reply.cancel()
+                slot.release(done)
+
+        if request.cancellation is not None:
+            # the provider stops, even if no one is reading the reply
+            request.cancellation.on_cancel(slot.release)
+        return Reply(streaming())
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        limiter = self.limiter(request, next)
+        for attempt in range(self.retries + 1):
+            await limiter.aacquire()
+            try:
+                reply = await next.aask(request=request)
+            except LLMRateLimitError as e:
+                limiter.limited(e.retry_after)
+                if attempt == self.retries:
+                    raise
+                continue
+            except BaseException:
+                limiter.failed()
+                raise
+            break
+
+        slot = Slot(limiter)
+
+        async def streaming():
+            done = False
+            try:
+                async for packet in reply:
+                    slot.observe(packet)
+                    yield packet
+                done = True
+            finally:
+                slot.release(done)
+
+        # An AsyncReply does not start its generator, so a reply that is
+        # never read, or is collected before it is finished, would not run
+        # the finally above. Cancelling, and collection, release it instead.
+        async_reply = AsyncReply(streaming())
+        async_reply.cancellation = CancellationToken()
+        async_reply.cancellation.on_cancel(reply.cancel)
+        async_reply.cancellation.on_cancel(slot.release)
+        weakref.finalize(async_reply, slot.release)
+        if request.cancellation is not None:
+            request.cancellation.on_cancel(slot.release)
+        return async_reply
+
+    def limiter(self, request: Request, next: LanguageModel) -> Limiter:
+        return Limiter.of(
+            _provider_key(request, next),
+            self.requests_per_second,
+            self.tokens_per_second,
+            self.max_concurrency,
+        )
+
+
+def _provider_key(request: Request, next: LanguageModel) -> tuple:
+    """The provider at the end of the pipeline, and the model it will be asked for."""
+    provider = next.service if isinstance(next, Pipeline) else next
+    while isinstance(provider, MiddlewareLanguageModel):
+        provider = provider.next
+    return (
+        type(provider).__name__,
+        getattr(provider, "hostname", None),
+        next.prepare(request).contexture.model,
+    )
+
+
+@dataclass(frozen=True)
+class HedgeMetrics(Metrics):
+    """How a reply was hedged, along with the provider's own metrics.
+
+    The provider's metrics, such as eval_count, can be read directly.
+    """
+
+    attempts: int  # requests made, including hedges
+    winner: int  # which request replied first; 0 is the original
+    delay: float  # seconds waited before each hedge
+    metrics: Metrics | None = None  # the winner's metrics, if any
+
+    def __getattr__(self, name: str):
+        metrics = self.__dict__.get("metrics")
+        if metrics is None or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(metrics, name)
+
+
+class Hedging:
+    """Latencies to the first token, and hedging counts, for a provider and model."""
+
+    hedgings = {}
+    hedgings_lock = threading.Lock()
+
+    def __init__(self, samples: int = 100) -> None:
+        self.latencies = deque(maxlen=samples)
+        self.requests = 0  # requests made, not counting hedges
+        self.hedges = 0  # extra requests made
+        self.wins = 0  # extra requests that replied first
+        self.lock = threading.Lock()
+
+    @classmethod
+    def of(cls, key: tuple) -> Hedging:
+        with cls.hedgings_lock:
+            if key not in cls.hedgings:
+                cls.hedgings[key] = cls()
+            return cls.hedgings[key]
+
+    def delay(self, percentile: float, min_samples: int = 20) -> float | None:
+        """The given percentile of latencies, once there are enough."""
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[
+            min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        ]
+
+    def record(self, latency: float, hedges: int, won: bool) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.hedges += hedges
+            self.wins += won
+
+
+@dataclass(frozen=True)
+class HedgeMiddleware(Middleware):
+    after: float | None
+    max_extra: int
+    percentile: float
+
+    def invoke(self, request: Request, next: LanguageModel) -> Reply:
+        hedging = Hedging.of(_provider_key(request, next))
+        delay = self.after if self.after is not None else hedging.delay(self.percentile)
+        if delay is None or self.max_extra == 0:
+            # nothing to go on yet, so just measure
+            start = time.monotonic()
+            reply = next.ask(request=request)
+            hedging.record(time.monotonic() - start, 0, False)
+            return reply
+
+        # Replies arrive once they have a first token (or fail).
+        results = queue.Queue()
+        tokens = []
+
+        def attempt(ix: int, token: CancellationToken):
+            start = time.monotonic()
+            try:
+                reply = next.ask(
+                    request=request.model_copy(update=dict(cancellation=token))
+                )
+            except BaseException as e:
+                results.put((ix, None, e))
+                return
+            results.put((ix, reply, None))
+
+        def launch():
+            token = CancellationToken()
+            tokens.append(token)
+            threading.Thread(
+                target=attempt, args=(len(tokens) - 1, token), daemon=True
+            ).start()
+
+        if request.cancellation is not None:
+            request.cancellation.on_cancel(lambda: [token.cancel() for token in tokens])
+
+        start = time.monotonic()
+        launch()
+        pending = 1
+        while True:
+            try:
+                timeout = delay if len(tokens) <= self.max_extra else None
+                ix, reply, error = results.get(timeout=timeout)
+            except queue.Empty:
+                launch()
+                pending += 1
+                continue
+            pending -= 1
+            if error is None:
+                break
+            if pending == 0:
+                # let retry, if any, decide what to do
+                raise error
+
+        # The losers are cancelled, even if they have not replied yet.
+        for loser, token in enumerate(tokens):
+            if loser != ix:
+                token.cancel()
+        # The latency of the original request, or as far as it got, so that
+        # hedging, which hides slow requests, does not shrink the delay.
+        hedging.record(time.monotonic() - start, len(tokens) - 1, ix != 0)
+        if len(tokens) == 1:
+            return reply
+        hedged = HedgeMetrics(len(tokens), ix, delay)
+
+        def streaming():
+            # the hedging is merged into the provider's metrics
+            merged = done = False
+            try:
+                for packet in reply:
+                    if isinstance(packet, Metrics) and not merged:
+                        packet = replace(hedged, metrics=packet)
+                        merged = True
+                    yield packet
+                if not merged:
+                    yield hedged
+                done = True
+            finally:
+                if not done:
+                    reply.cancel()
+
+        return Reply(streaming())
+
+
+def hedge(
+    after: float | None = None, max_extra: int = 1, percentile: float = 95
+) -> Middleware:
+    """ask again if the first token is slow to arrive, and use the first reply.
+
+    after is the delay, in seconds, before each extra request. If after is
+    None, the delay is learned: the given percentile of recent latencies to
+    the first token, for the same provider and model. Up to max_extra extra
+    requests are made, and the requests that lose are cancelled.
+    """
+    return HedgeMiddleware(after, max_extra, percentile)
+
+
+def rate_limit(
+    requests_per_second: float | None = None,
+    tokens_per_second: float | None = None,
+    max_concurrency: int = 16,
+    retries: int = 3,
+) -> Middleware:
+    """throttle requests to stay under a provider's quota.
+
+    Requests, and tokens, per second are shared by every rate_limit with the
+    same provider and model, so they must agree on requests_per_second,
+    tokens_per_second and max_concurrency, or LLMConfigurationError is
+    raised. When the provider refuses a request, with
+    LLMRateLimitError, the request is retried (up to retries times) after
+    any Retry-After, and the number of requests in flight is halved. It then
+    grows back, one at a time, up to max_concurrency.
+    """
+    return RateLimitMiddleware(
+        requests_per_second, tokens_per_second, max_concurrency, retries
+    )
+
+
 @dataclass(frozen=True)
 class ValidationMiddleware(Middleware):
-    """Validate if a predicate is true for the response."""
+    """Validate if a predicate is true for the response.
+
+    The stream_predicate, if any, is checked against the reply so far,
+    after every token, and the reply is cancelled as soon as it fails.
+    """
 
-    predicate: Callable[[str], bool]
+    predicate: Callable[[str], bool] | None
+    stream_predicate: Callable[[str], bool] | None = None
 
     def invoke(self, request: Request, next: LanguageModel):
         response = next.ask(request=request)
+        if self.stream_predicate is not None:
+            text = ""
+            for token in response.tokens():
+                text += token
+                if not self.stream_predicate(text):
+                    response.cancel()
+                    raise LLMResultError(f"reply rejected after {len(text)} characters")
         # the str forces the full evaluation here
-        if not self.predicate(str(response)):
+        if self.predicate is not None and not self.predicate(str(response)):
             raise LLMResultError()
         return response
 
+    async def ainvoke(self, request: Request, next: LanguageModel):
+        response = await next.aask(request=request)
+        if self.stream_predicate is not None:
+            text = ""
+            async for token in response.tokens():
+                text += token
+                if not self.stream_predicate(text):
+                    response.cancel()
+                    raise LLMResultError(f"reply rejected after {len(text)} characters")
+        if self.predicate is not None and not self.predicate(await response.text()):
+            raise LLMResultError()
+        return response
 
-def validate(predicate: Callable[[str], bool]) -> Middleware:
-    """validate the response as middleware. Can raise as LLMResultError"""
-    return ValidationMiddleware(predicate)
+
+def validate(
+    predicate: Callable[[str], bool] | None = None,
+    stream_predicate: Callable[[str], bool] | None = None,
+) -> Middleware:
+    """validate the response as middleware. Can raise as LLMResultError
+
+    stream_predicate is called with the reply so far, as each token arrives,
+    and the generation is cancelled as soon as it returns False.
+    """
+    assert (
+        predicate is not None or stream_predicate is not None
+    ), "validate needs a predicate"
+    return ValidationMiddleware(predicate, stream_predicate)
 
 
 @dataclass(frozen=True)
@@ -328,73 +842,140 @@ class CacheMiddleware(Middleware):
 
     filename: str
     mode: str  # "r", "a", "a+"
+    compress: str | None = None  # None, "zlib", "zstd"
+    retention: Retention | None = None
+    max_entries: int | None = None  # size of the in-memory tier, if any
 
     def invoke(self, request: Request, next: LanguageModel):
+        hit, save = self.lookup(request, next)
+        if hit is not None:
+            # just return the (cached) reply
+            return Reply(hit)
 
-        cache = Cache(self.filename, self.mode)
-
-        parameters = dict(request.contexture.options)
-        # TODO: make this Request parameter
+        response = next.ask(request=request)
+        if save is None:
+            return response
 
-        if self.mode in {"r", "a+"} and not request.fresh:
+        response.keep_text()
+        response.after(lambda: save(str(response)))
 
-            cached = cache.lookup_interactions(
-                request.contexture.system,
-                request.contexture.context,
-                request.prompt,
-                request.images,
-                parameters,
-                limit=1,
-                blacklist=True,
-            )
+        return response
 
-            if cached:
-                key = builtins.next(iter(cached.keys()))
-                if self.mode == "a+":
-                    cache.blacklist(key)
-                # just return the (cached) reply
-                return Reply(cached[key][2])
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        # only the cache itself is read and written in a worker thread
+        hit, save = await asyncio.to_thread(self.lookup, request, next)
+        if hit is not None:
+            return AsyncReply([hit])
 
-        response = next.ask(request=request)
-        if self.mode == "r":
+        response = await next.aask(request=request)
+        if save is None:
             return response
 
-        def save_response():
-            cache.insert_interaction(
-                request.contexture.system,
-                request.contexture.context,
-                request.prompt,
-                request.images,
-                str(response),
-                parameters,
+        async def streaming():
+            text = []
+            async for packet in response:
+                if isinstance(packet, str):
+                    text.append(packet)
+                yield packet
+            await asyncio.to_thread(save, "".join(text))
+
+        return AsyncReply(streaming())
+
+    def lookup(
+        self, request: Request, next: LanguageModel
+    ) -> tuple[str | None, Callable[[str], None] | None]:
+        """Any cached reply, and how to save a new reply, if the mode allows."""
+        backend = None
+        if self.filename != MEMORY_LRU:
+            backend = Backend.open(
+                self.filename, self.mode, self.compress, self.retention
             )
 
-        response.after(save_response)
+        # The model, options and format are typically set further down the
+        # pipeline, so the whole key is taken from the prepared request.
+        query = self.query(next.prepare(request))
 
-        return response
+        memory = None
+        if self.max_entries is not None:
+            memory = Memory.of(self.filename, self.max_entries)
+            memory_key = Memory.key(query)
 
-    def children(self, request: Request):
-        if self.mode == "a":
+        if self.mode in {"r", "a+"} and not request.fresh:
+            claim = self.mode == "a+"
+            hit = memory and memory.lookup(memory_key)
+            if hit and backend is not None:
+                # the backend records the use, for its retention
+                if not claim:
+                    backend.touch(hit[0])
+                elif not backend.claim(hit[0]):
+                    hit = None
+            if not hit and backend is not None:
+                hit = backend.lookup(query, claim)
+                if hit and memory:
+                    memory.insert(memory_key, *hit)
+
+            if hit:
+                return hit[1], None
+
+        if self.mode == "r":
+            return None, None
+
+        def save(reply: str):
+            interaction = INTERACTION(None)
+            if backend is not None:
+                interaction = backend.insert(query, reply)
+            if memory:
+                memory.insert(memory_key, interaction, reply)
+
+        return None, save
+
+    def query(self, prepared: Request) -> Query:
+        """The cache key of a request, as prepared by the rest of the pipeline."""
+        return Query(
+            system=prepared.contexture.system,
+            context=prepared.contexture.context,
+            prompt=prepared.prompt,
+            images=prepared.images,
+            parameters=dict(prepared.contexture.options),
+            model=prepared.contexture.model,
+            format=prepared.format,
+        )
+
+    def children(self, prepared: Request):
+        if self.mode == "a" or self.filename == MEMORY_LRU:
             return []
 
-        prompt = request.prompt
-        system = request.contexture.system
-        context = request.contexture.context
-        images = request.images
-        options = request.contexture.options
+        backend = Backend.open(self.filename, self.mode, self.compress)
+        return backend.replies(replace(self.query(prepared), images=()))
 
-        cache = Cache(self.filename, self.mode)
 
-        parameters = options.copy()
+def cache(
+    filename: str,
+    mode: str | None = "a+",
+    compress: str | None = None,
+    max_rows: int | None = None,
+    max_bytes: int | None = None,
+    max_age: float | None = None,
+    max_entries: int | None = None,
+) -> Middleware:
+    """Set the cache filename for this model.
 
-        return cache.lookup_interactions(
-            system, context, prompt, [], parameters, limit=None, blacklist=False
-        ).values()
+    if compress="zlib" or compress="zstd", then new replies and prompts are
+    stored compressed. zstd needs the zstandard package.
 
+    max_rows, max_bytes and max_age (in seconds) bound the size of the cache.
+    The least recently used interactions are evicted in a background thread.
 
-def cache(filename: str, mode: str | None = "a+") -> Middleware:
-    """Set the cache filename for this model."""
-    return CacheMiddleware(filename, mode)
+    max_entries adds an in-memory tier of the most recently used replies,
+    in front of the cache file. filename=":memory-lru:" uses only this tier.
+    """
+    assert compress in {None, "zlib", "zstd"}, f"unknown compression: {compress}"
+    retention = None
+    if (max_rows, max_bytes, max_age) != (None, None, None):
+        retention = Retention(max_rows, max_bytes, max_age)
+    if filename == MEMORY_LRU and max_entries is None:
+        max_entries = 1024
+    return CacheMiddleware(filename, mode, compress, retention, max_entries)
 
 
 @dataclass(frozen=True)
@@ -404,7 +985,28 @@ class TranscriptMiddleware(Middleware):
     def invoke(self, request: Request, next: LanguageModel) -> Reply:
 
         response: Reply = next.ask(request=request)
+        write_transcript = self.writer(request)
+
+        response.keep_text()
+        response.after(lambda: write_transcript(str(response)))
+        return response
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        response: AsyncReply = await next.aask(request=request)
+        write_transcript = self.writer(request)
+
+        async def streaming():
+            text = []
+            async for packet in response:
+                if isinstance(packet, str):
+                    text.append(packet)
+                yield packet
+            write_transcript("".join(text))
+
+        return AsyncReply(streaming())
 
+    def writer(self, request: Request) -> Callable[[str], None]:
+        """How to write the transcript, given the reply to request."""
         dirname = self.dirname
         # Ensure the parent directory exists
         if not os.path.exists(dirname):
@@ -415,9 +1017,9 @@ class TranscriptMiddleware(Middleware):
         for exchange in request.contexture.context:
             transcript = render_interaction(transcript, exchange.prompt, exchange.reply)
 
-        def write_transcript():
+        def write_transcript(reply: str):
             transcript_file = datetime.now().strftime("%Y%m%d_%H:%M:%S.%f.md")
-            transcript_ = render_interaction(transcript, request.prompt, str(response))
+            transcript_ = render_interaction(transcript, request.prompt, reply)
             with open(os.path.join(dirname, transcript_file), "w") as file:
                 file.write(transcript_)
 
@@ -428,8 +1030,7 @@ class TranscriptMiddleware(Middleware):
 
             os.symlink(transcript_file, latest_symlink)
 
-        response.after(write_transcript)
-        return response
+        return write_transcript
 
 
 def transcript(dirname: str) -> Middleware:
@@ -447,6 +1048,17 @@ class TraceMiddleware(Middleware):
 
         reply: Reply = next.ask(request=request)
 
+        return self._trace(reply)
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+
+        logger.log(self.level, f"request={repr(request)}")
+
+        reply: AsyncReply = await next.aask(request=request)
+
+        return self._trace(reply)
+
+    def _trace(self, reply: Reply | AsyncReply):
         # we give the reply twice, once when we first get it,
         # and second after the reply is complete.
         logger.log(self.level, f"initial reply={repr(reply)}")
@@ -468,8 +1080,13 @@ def trace(level: int = log.DEBUG) -> Middleware:
 class FreshMiddleware(Middleware):
 
     def invoke(self, request: Request, next: LanguageModel) -> Reply:
-        request = request.model_copy(update=dict(fresh=True))
-        return next.ask(request=request)
+        return next.ask(request=self.prepare(request))
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        return await next.aask(request=self.prepare(request))
+
+    def prepare(self, request: Request) -> Request:
+        return request.model_copy(update=dict(fresh=True))
 
 
 def fresh() -> Middleware:
@@ -477,14 +1094,133 @@ def fresh() -> Middleware:
     return FreshMiddleware()
 
 
+class Flight:
+    """A request in flight, shared by its leader and any followers."""
+
+    def __init__(self) -> None:
+        self.ready = threading.Event()  # set once reply, or error, is known
+        self.reply: Reply | None = None
+        self.error: BaseException | None = None
+        # cancelled once every participant has cancelled
+        self.cancellation = CancellationToken()
+        self.participants = 0
+
+
+@dataclass(frozen=True)
+class CoalesceMiddleware(Middleware):
+    flights: ClassVar[dict[str, Flight]] = {}  # by request digest
+    lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def invoke(self, request: Request, next: LanguageModel) -> Reply:
+        # The model (and format) are typically set further down the pipeline.
+        prepared = next.prepare(request)
+        if prepared.fresh:
+            # fresh asks for a reply of its own
+            return next.ask(request=request)
+
+        key = self.digest(prepared)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            flight.participants += 1
+
+        if leader:
+            try:
+                flight.reply = next.ask(
+                    request=request.model_copy(
+                        update=dict(cancellation=flight.cancellation)
+                    )
+                )
+            except BaseException as e:
+                flight.error = e
+                self.land(key, flight)
+                raise
+            finally:
+                flight.ready.set()
+            flight.reply.after(lambda: self.land(key, flight))
+        else:
+            flight.ready.wait()
+            if flight.error is not None:
+                raise flight.error
+
+        def streaming():
+            # A participant leaves when its reply is read, cancelled,
+            # closed, or garbage collected, which all close this generator.
+            done = False
+            try:
+                yield from flight.reply
+                done = True
+            finally:
+                self.leave(key, flight, done)
+
+        # Each participant reads the shared reply through its own Reply,
+        # so that one participant cancelling does not stop the others.
+        reply = Reply(streaming())
+        if request.cancellation is not None:
+            request.cancellation.on_cancel(reply.cancel)
+        return reply
+
+    def digest(self, request: Request) -> str:
+        query = Query(
+            system=request.contexture.system,
+            context=request.contexture.context,
+            prompt=request.prompt,
+            images=request.images,
+            parameters=dict(request.contexture.options),
+            model=request.contexture.model,
+            format=request.format,
+        )
+        text = json.dumps(query.to_json(), sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def land(self, key: str, flight: Flight) -> None:
+        """Stop new requests following this flight."""
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def leave(self, key: str, flight: Flight, done: bool) -> None:
+        """A participant has finished with the shared reply.
+
+        Once every participant has left, a reply that is not done is
+        cancelled, and new requests no longer follow it.
+        """
+        with self.lock:
+            flight.participants -= 1
+            abandoned = flight.participants == 0 and not done
+            # landed under the same lock, so no one can join a flight
+            # that is about to be cancelled
+            if abandoned and self.flights.get(key) is flight:
+                del self.flights[key]
+        if abandoned:
+            flight.cancellation.cancel()
+
+
+def coalesce() -> Middleware:
+    """share one reply between identical requests that are in flight at once.
+
+    The first request is asked; identical requests made before its reply
+    is complete follow it, reading the same reply. Requests marked fresh
+    are never shared.
+    """
+    return CoalesceMiddleware()
+
+
 @dataclass(frozen=True)
 class ModelMiddleware(Middleware):
     model: str
 
     def invoke(self, request: Request, next: LanguageModel) -> Reply:
+        return next.ask(request=self.prepare(request))
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        return await next.aask(request=self.prepare(request))
+
+    def prepare(self, request: Request) -> Request:
         contexture = request.contexture.model_copy(update=dict(model=self.model))
-        request = request.model_copy(update=dict(contexture=contexture))
-        return next.ask(request=request)
+        return request.model_copy(update=dict(contexture=contexture))
 
 
 def model(model_name: str) -> Middleware:
@@ -497,11 +1233,16 @@ class OptionsMiddleware(Middleware):
     options: dict
 
     def invoke(self, request: Request, next: LanguageModel) -> Reply:
+        return next.ask(request=self.prepare(request))
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        return await next.aask(request=self.prepare(request))
+
+    def prepare(self, request: Request) -> Request:
         contexture = request.contexture.model_copy(
             update=dict(options=request.contexture.options | self.options)
         )
-        request = request.model_copy(update=dict(contexture=contexture))
-        return next.ask(request=request)
+        return request.model_copy(update=dict(contexture=contexture))
 
 
 def options(**kwargs) -> Middleware:
@@ -539,8 +1280,54 @@ class FormatMiddleware(Middleware):
     """
 
     schema: dict | Type[BaseModel] | None
+    incremental: bool = False  # parse the JSON as it arrives
 
     def invoke(self, request: Request, next: LanguageModel):
+        reply = next.ask(request=self.prepare(request))
+        if not self.incremental:
+            return reply + Reply([self._value(str(reply))])
+
+        def streaming():
+            parser = JSONStream()
+            done = False
+            try:
+                for packet in reply:
+                    yield packet
+                    if isinstance(packet, str):
+                        for partial in parser.feed(packet):
+                            yield Value(value=partial, partial=True)
+                done = True
+            finally:
+                # invalid JSON stops the provider, as well as the reader
+                if not done:
+                    reply.cancel()
+            yield self._parsed(parser.finish())
+
+        return Reply(streaming())
+
+    async def ainvoke(self, request: Request, next: LanguageModel):
+        reply = await next.aask(request=self.prepare(request))
+        if not self.incremental:
+            return reply + AsyncReply([self._value(await reply.text())])
+
+        async def streaming():
+            parser = JSONStream()
+            done = False
+            try:
+                async for packet in reply:
+                    yield packet
+                    if isinstance(packet, str):
+                        for partial in parser.feed(packet):
+                            yield Value(value=partial, partial=True)
+                done = True
+            finally:
+                if not done:
+                    reply.cancel()
+            yield self._parsed(parser.finish())
+
+        return AsyncReply(streaming())
+
+    def prepare(self, request: Request) -> Request:
         schema = self.schema
         if schema is None:
             format = "json"
@@ -549,25 +1336,36 @@ class FormatMiddleware(Middleware):
         else:
             assert f"unsupported schema: {schema}"
 
-        request = request.model_copy(update=dict(format=format))
-        reply = next.ask(request=request)
+        return request.model_copy(update=dict(format=format))
 
-        if schema is None:
-            return reply + Reply([Value(value=json.loads(str(reply)))])
-        elif issubclass(schema, BaseModel):
-            return reply + Reply([Value(value=schema.model_validate_json(str(reply)))])
+    def _value(self, reply: str) -> Value:
+        if self.schema is None:
+            return Value(value=json.loads(reply))
+        return Value(value=self.schema.model_validate_json(reply))
 
-        return reply
+    def _parsed(self, value: dict | list | str | int | float | bool | None) -> Value:
+        if self.schema is None:
+            return Value(value=value)
+        try:
+            return Value(value=self.schema.model_validate(value))
+        except ValidationError as e:
+            raise LLMResultError(f"reply does not match {self.schema.__name__}: {e}")
 
 
-def format(schema: Type[BaseModel] | None = None) -> Middleware:
+def format(
+    schema: Type[BaseModel] | None = None, incremental: bool = False
+) -> Middleware:
     """Request the output in JSON, or parsed JSON.
 
     If a BaseModel type is provided, the JSON is parsed and validated against the schema.
 
     Response.value is set to the JSON, or if BaseModel is provided, the parsed JSON.
+
+    If incremental is True, the JSON is parsed as it arrives. Partial Values
+    (with partial=True) are added to the reply as each top-level field, or element,
+    is complete, and invalid JSON raises LLMResultError as soon as it is seen.
     """
-    return FormatMiddleware(schema)
+    return FormatMiddleware(schema, incremental)
 
 
 @dataclass(frozen=True)
@@ -578,10 +1376,15 @@ class DedentMiddleware(Middleware):
     """
 
     def invoke(self, request: Request, next: LanguageModel):
+        return next.ask(request=self.prepare(request))
+
+    async def ainvoke(self, request: Request, next: LanguageModel):
+        return await next.aask(request=self.prepare(request))
+
+    def prepare(self, request: Request) -> Request:
         prompt = request.prompt
         prompt = textwrap.dedent(prompt).strip()
-        request = request.model_copy(update=dict(prompt=prompt))
-        return next.ask(request=request)
+        return request.model_copy(update=dict(prompt=prompt))
 
 
 def dedent() -> Middleware:
@@ -626,6 +1429,7 @@ class MetaMiddleware(Middleware):
             exchange = Exchange(prompt=request.prompt, images=(), reply=str(response))
             self._model_cache[system, context + (exchange,)] = model
 
+        response.keep_text()
         response.after(after)
         return response
 
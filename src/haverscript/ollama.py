@@ -1,13 +1,22 @@
-from dataclasses import dataclass
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from dataclasses import MISSING, dataclass, fields
 from types import GeneratorType
 
+import httpx
 import ollama
 
+from .exceptions import LLMConnectivityError, LLMRateLimitError
 from .haverscript import Model, Service
 from .types import (
     Metrics,
     ServiceProvider,
     Reply,
+    AsyncReply,
+    CancellationToken,
     Request,
 )
 from .middleware import model
@@ -21,50 +30,208 @@ class OllamaMetrics(Metrics):
     prompt_eval_duration: int  # time spent in nanoseconds evaluating the prompt
     eval_count: int  # number of tokens in the response
     eval_duration: int  # time in nanoseconds spent generating the response
+    # estimated by haverscript, not reported by ollama
+    cached_prompt_tokens: int = 0  # prompt tokens reused from ollama's cache
+
+    @property
+    def prefix_hit_rate(self) -> float:
+        """The estimated fraction of the prompt that ollama did not evaluate."""
+        total = self.cached_prompt_tokens + self.prompt_eval_count
+        return self.cached_prompt_tokens / total if total else 0.0
+
+
+class Prefixes:
+    """Estimates how much of each prompt ollama already had cached.
+
+    ollama only reports the prompt tokens it evaluated. We remember how many
+    tokens each conversation had after its last turn, and how many tokens
+    a character is worth, so we can estimate the size of the whole prompt,
+    and so how much of it was cached.
+    """
+
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self.tokens = OrderedDict()  # conversation key -> tokens so far
+        self.characters = 0  # characters in prompts with nothing cached
+        self.evaluated = 0  # tokens in prompts with nothing cached
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str | None, messages: list[dict]) -> int:
+        return hash(
+            (model,)
+            + tuple(
+                (message["role"], message["content"], *message.get("images", ()))
+                for message in messages
+            )
+        )
+
+    def cached(self, model: str | None, messages: list[dict], reply: str, chunk) -> int:
+        """Estimate the cached prompt tokens, and remember this turn."""
+        prompt_eval_count = chunk["prompt_eval_count"]
+        with self.lock:
+            prefix_key = self.key(model, messages[:-1])
+            prefix = self.tokens.get(prefix_key)
+            if prefix is None:
+                # a new conversation, so assume nothing was cached
+                cached = 0
+                self.characters += sum(len(m["content"]) for m in messages)
+                self.evaluated += prompt_eval_count
+            else:
+                self.tokens.move_to_end(prefix_key)
+                ratio = self.evaluated / self.characters if self.characters else 0
+                new = ratio * len(messages[-1]["content"])
+                cached = min(prefix, max(0, round(prefix + new - prompt_eval_count)))
+            turn = messages + [{"role": "assistant", "content": reply}]
+            self.tokens[self.key(model, turn)] = (
+                cached + prompt_eval_count + chunk["eval_count"]
+            )
+            if len(self.tokens) > self.max_entries:
+                self.tokens.popitem(last=False)
+        return cached
+
+
+@dataclass(frozen=True)
+class Pool:
+    """The HTTP connection pool for an ollama host."""
+
+    max_connections: int = 100  # connections open at once
+    keepalive: float = 5.0  # seconds an idle connection is kept open
+    timeout: float | None = None  # seconds to wait for the server
+
+    def options(self) -> dict:
+        """The options for ollama's clients, which pass them on to httpx."""
+        return dict(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                # keep every connection warm, not just httpx's default 20
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive,
+            ),
+            timeout=self.timeout,
+        )
 
 
 class Ollama(ServiceProvider):
+    # clients are shared, by hostname and Pool, so connections are reused
     client = {}
+    # async clients are also by event loop, as their connections are bound
+    # to the loop that opened them; a loop's clients go when the loop does
+    async_client = weakref.WeakKeyDictionary()
+    lock = threading.Lock()
 
-    def __init__(self, hostname: str | None = None) -> None:
+    def __init__(
+        self,
+        hostname: str | None = None,
+        pool: Pool | None = None,
+        keep_alive: float | str | None = None,
+    ) -> None:
         self.hostname = hostname
-        if hostname not in self.client:
-            self.client[hostname] = ollama.Client(host=hostname)
+        self.pool = pool or Pool()
+        self.keep_alive = keep_alive
+        self.prefixes = Prefixes()
+        # a different pool gets its own clients, so no one's are replaced
+        self.key = (hostname, self.pool)
+        with self.lock:
+            if self.key not in self.client:
+                self.client[self.key] = ollama.Client(
+                    host=hostname, **self.pool.options()
+                )
+
+    def loaded(self) -> list[str]:
+        """Return the models currently loaded into memory on this host."""
+        try:
+            models = self.client[self.key].ps()
+        except Exception as e:
+            raise self._suggestions(e)
+        return [model.model for model in models["models"]]
 
     def list(self) -> list[str]:
-        models = self.client[self.hostname].list()
+        try:
+            models = self.client[self.key].list()
+        except Exception as e:
+            raise self._suggestions(e)
         assert "models" in models
         return [model.model for model in models["models"]]
 
     def _suggestions(self, e: Exception):
-        # Slighty better message. Should really have a type of reply for failure.
-        if "ConnectError" in str(type(e)):
-            print("Connection error (Check if ollama is running)")
+        # ollama raises ConnectionError when it can not connect,
+        # and httpx errors when the connection fails later.
+        if isinstance(e, (ConnectionError, httpx.TransportError)):
+            host = self.hostname or "ollama"
+            return LLMConnectivityError(
+                f"Connection error with {host} (Check if ollama is running)"
+            )
+        if isinstance(e, ollama.ResponseError) and e.status_code == 429:
+            return LLMRateLimitError(e.error)
         return e
 
-    def generator(self, response):
+    def metrics(self, chunk, arguments: dict, reply: str) -> OllamaMetrics:
+        reported = [f.name for f in fields(OllamaMetrics) if f.default is MISSING]
+        cached = self.prefixes.cached(
+            arguments["model"], arguments["messages"], reply, chunk
+        )
+        return OllamaMetrics(
+            **{k: chunk[k] for k in reported}, cached_prompt_tokens=cached
+        )
+
+    def generator(
+        self,
+        response,
+        arguments: dict,
+        cancellation: CancellationToken | None = None,
+    ):
 
         if isinstance(response, GeneratorType):
+            reply = []
             try:
                 for chunk in response:
+                    if cancellation is not None and cancellation.cancelled:
+                        break
+                    reply.append(chunk["message"]["content"])
                     if chunk["done"]:
-                        yield OllamaMetrics(
-                            **{
-                                k: chunk[k]
-                                for k in OllamaMetrics.__dataclass_fields__.keys()
-                            }
-                        )
+                        yield self.metrics(chunk, arguments, "".join(reply))
                     yield chunk["message"]["content"]
             except Exception as e:
                 raise self._suggestions(e)
+            finally:
+                # closing the stream closes the HTTP connection,
+                # which tells ollama to stop generating.
+                response.close()
         else:
             assert isinstance(response["message"]["content"], str)
             yield response["message"]["content"]
-            yield OllamaMetrics(
-                **{k: response[k] for k in OllamaMetrics.__dataclass_fields__.keys()}
-            )
+            yield self.metrics(response, arguments, response["message"]["content"])
 
-    def ask(self, request: Request):
+    async def async_generator(
+        self,
+        response,
+        arguments: dict,
+        cancellation: CancellationToken | None = None,
+    ):
+
+        if isinstance(response, AsyncIterator):
+            reply = []
+            try:
+                async for chunk in response:
+                    if cancellation is not None and cancellation.cancelled:
+                        break
+                    reply.append(chunk["message"]["content"])
+                    if chunk["done"]:
+                        yield self.metrics(chunk, arguments, "".join(reply))
+                    yield chunk["message"]["content"]
+            except Exception as e:
+                raise self._suggestions(e)
+            finally:
+                if aclose := getattr(response, "aclose", None):
+                    await aclose()
+        else:
+            assert isinstance(response["message"]["content"], str)
+            yield response["message"]["content"]
+            yield self.metrics(response, arguments, response["message"]["content"])
+
+    def arguments(self, request: Request) -> dict:
+        """The arguments to pass to ollama's chat, for a given request."""
 
         messages = []
 
@@ -83,16 +250,49 @@ class Ollama(ServiceProvider):
             | ({"images": list(request.images)} if request.images else {})
         )
 
+        return dict(
+            model=request.contexture.model,
+            stream=request.stream,
+            messages=messages,
+            options=request.contexture.options,
+            format=request.format,
+        ) | ({"keep_alive": self.keep_alive} if self.keep_alive is not None else {})
+
+    def ask(self, request: Request):
+
         try:
-            response = self.client[self.hostname].chat(
-                model=request.contexture.model,
-                stream=request.stream,
-                messages=messages,
-                options=request.contexture.options,
-                format=request.format,
-            )
+            arguments = self.arguments(request)
+            response = self.client[self.key].chat(**arguments)
 
-            return Reply(self.generator(response))
+            reply = Reply(self.generator(response, arguments, request.cancellation))
+            if request.cancellation is not None:
+                request.cancellation.on_cancel(reply.cancel)
+            return reply
+
+        except Exception as e:
+            raise self._suggestions(e)
+
+    async def aask(self, request: Request):
+
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = self.async_client.setdefault(loop, {})
+            if self.key not in clients:
+                clients[self.key] = ollama.AsyncClient(
+                    host=self.hostname, **self.pool.options()
+                )
+            client = clients[self.key]
+
+        try:
+            arguments = self.arguments(request)
+            response = await client.chat(**arguments)
+
+            reply = AsyncReply(
+                self.async_generator(response, arguments, request.cancellation)
+            )
+            if request.cancellation is not None:
+                request.cancellation.on_cancel(reply.cancel)
+            return reply
 
         except Exception as e:
             raise self._suggestions(e)
@@ -101,10 +301,24 @@ class Ollama(ServiceProvider):
 def connect(
     model_name: str | None = None,
     hostname: str | None = None,
+    max_connections: int = 100,
+    keepalive: float = 5.0,
+    timeout: float | None = None,
+    keep_alive: float | str | None = None,
 ) -> Model | Service:
-    """return a model or service that uses the given model name."""
+    """return a model or service that uses the given model name.
+
+    max_connections, keepalive (in seconds) and timeout (in seconds)
+    configure the HTTP connection pool shared by everything using hostname
+    with the same options.
+
+    keep_alive is how long ollama keeps the model loaded after each request,
+    in seconds or as a duration like "30m". A negative value keeps it loaded,
+    along with its cache of recent prompts.
+    """
 
-    service = Service(Ollama(hostname=hostname))
+    pool = Pool(max_connections=max_connections, keepalive=keepalive, timeout=timeout)
+    service = Service(Ollama(hostname=hostname, pool=pool, keep_alive=keep_alive))
 
     if model_name:
         service = service | model(model_name)
@@ -1,11 +1,13 @@
 import os
+from collections.abc import AsyncIterator
 from dataclasses import dataclass
 from types import GeneratorType
 
 import together
 
+from .exceptions import LLMRateLimitError, parse_retry_after
 from .haverscript import Metrics, Model, Service
-from .types import Reply, Request, ServiceProvider
+from .types import AsyncReply, CancellationToken, Reply, Request, ServiceProvider
 from .middleware import model
 
 
@@ -18,6 +20,7 @@ class TogetherMetrics(Metrics):
 
 class Together(ServiceProvider):
     client: together.Together | None = None
+    async_client: together.AsyncTogether | None = None
     hostname = ""
 
     def __init__(self, api_key: str | None = None) -> None:
@@ -26,6 +29,8 @@ class Together(ServiceProvider):
         assert api_key is not None, "need TOGETHER_API_KEY"
         if self.client is None:
             self.client: Together = together.Together(api_key=api_key)
+        if self.async_client is None:
+            self.async_client = together.AsyncTogether(api_key=api_key)
 
     def list(self) -> list[str]:
         models = self.client.models.list()
@@ -35,6 +40,12 @@ class Together(ServiceProvider):
         # Slighty better message. Should really have a type of reply for failure.
         if "ConnectError" in str(type(e)):
             print("Connection error with together.ai")
+        if isinstance(e, together.error.RateLimitError):
+            headers = e.headers if isinstance(e.headers, dict) else {}
+            headers = {key.lower(): value for key, value in headers.items()}
+            return LLMRateLimitError(
+                str(e), retry_after=parse_retry_after(headers.get("retry-after"))
+            )
         return e
 
     def metrics(self, chunk: dict) -> Metrics:
@@ -42,23 +53,52 @@ class Together(ServiceProvider):
             **{k: chunk[k] for k in TogetherMetrics.__dataclass_fields__.keys()}
         )
 
-    def generator(self, response):
+    def generator(self, response, cancellation: CancellationToken | None = None):
 
         if isinstance(response, GeneratorType):
             try:
                 for chunk in response:
+                    if cancellation is not None and cancellation.cancelled:
+                        break
                     for choice in chunk.choices:
                         if choice.finish_reason and chunk.usage:
                             yield self.metrics(chunk.usage.model_dump())
                         yield choice.delta.content
             except Exception as e:
                 raise self._suggestions(e)
+            finally:
+                # closing the stream closes the HTTP connection
+                response.close()
         else:
             assert isinstance(response.choices[0].message.content, str)
             yield response.choices[0].message.content
             yield self.metrics(response.usage.model_dump())
 
-    def ask(self, request: Request):
+    async def async_generator(
+        self, response, cancellation: CancellationToken | None = None
+    ):
+
+        if isinstance(response, AsyncIterator):
+            try:
+                async for chunk in response:
+                    if cancellation is not None and cancellation.cancelled:
+                        break
+                    for choice in chunk.choices:
+                        if choice.finish_reason and chunk.usage:
+                            yield self.metrics(chunk.usage.model_dump())
+                        yield choice.delta.content
+            except Exception as e:
+                raise self._suggestions(e)
+            finally:
+                if aclose := getattr(response, "aclose", None):
+                    await aclose()
+        else:
+            assert isinstance(response.choices[0].message.content, str)
+            yield response.choices[0].message.content
+            yield self.metrics(response.usage.model_dump())
+
+    def arguments(self, request: Request) -> dict:
+        """The arguments to pass to together's chat completion, for a given request."""
 
         messages = []
 
@@ -96,22 +136,45 @@ class Together(ServiceProvider):
         }
 
         response_format = None
-        if format == "json":
+        if request.format == "json":
             response_format = {"type": "json_object"}
-        elif isinstance(format, dict):
-            response_format = {"type": "json_object", "schema": format}
+        elif isinstance(request.format, dict):
+            response_format = {"type": "json_object", "schema": request.format}
+
+        return dict(
+            model=request.contexture.model,
+            stream=request.stream,
+            messages=messages,
+            response_format=response_format,
+            **kwargs,
+        )
+
+    def ask(self, request: Request):
 
         try:
             assert isinstance(self.client, together.Together)
-            response = self.client.chat.completions.create(
-                model=request.contexture.model,
-                stream=request.stream,
-                messages=messages,
-                response_format=response_format,
-                **kwargs,
+            response = self.client.chat.completions.create(**self.arguments(request))
+
+            reply = Reply(self.generator(response, request.cancellation))
+            if request.cancellation is not None:
+                request.cancellation.on_cancel(reply.cancel)
+            return reply
+
+        except Exception as e:
+            raise self._suggestions(e)
+
+    async def aask(self, request: Request):
+
+        try:
+            assert isinstance(self.async_client, together.AsyncTogether)
+            response = await self.async_client.chat.completions.create(
+                **self.arguments(request)
             )
 
-            return Reply(self.generator(response))
+            reply = AsyncReply(self.async_generator(response, request.cancellation))
+            if request.cancellation is not None:
+                request.cancellation.on_cancel(reply.cancel)
+            return reply
 
         except Exception as e:
             raise self._suggestions(e)
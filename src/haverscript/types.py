@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import threading
 from abc import ABC, abstractmethod
-from collections.abc import Iterable
-from dataclasses import dataclass
-from typing import Callable
+from collections import deque
+from collections.abc import AsyncIterable, Iterable, Iterator, Sequence
+from copy import deepcopy
+from dataclasses import dataclass, field
+from typing import Callable, ClassVar
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from pydantic_core import core_schema
+
+from .exceptions import LLMInternalError
 
 
 @dataclass(frozen=True)
@@ -21,7 +27,8 @@ class Informational(BaseModel):
 
 
 class Value(BaseModel):
-    value: dict | BaseModel
+    value: dict | list | BaseModel | str | int | float | bool | None  # any JSON
+    partial: bool = False  # only the fields, or elements, complete so far
 
     model_config = ConfigDict(frozen=True)
 
@@ -34,18 +41,206 @@ class Exchange(BaseModel):
     model_config = ConfigDict(frozen=True)
 
 
-class Contexture(BaseModel):
+class History(Sequence):
+    """The exchanges of a conversation, as a persistent (immutable) list.
+
+    Appending an exchange is O(1), and shares every earlier exchange with
+    the original history, so a long conversation is stored once, not once
+    per turn. Otherwise, a History behaves as a tuple of Exchange.
+    """
+
+    __slots__ = ("previous", "last", "length", "_hash", "address")
+
+    EMPTY: ClassVar[History]
+
+    def __init__(self, previous: History | None = None, last: Exchange | None = None):
+        self.previous = previous
+        self.last = last
+        self.length = 0 if previous is None else previous.length + 1
+        self._hash = None
+        self.address = None  # the content address, once the cache has found it
+
+    @classmethod
+    def of(cls, exchanges: Iterable[Exchange | dict]) -> History:
+        if isinstance(exchanges, History):
+            return exchanges
+        history = cls.EMPTY
+        for exchange in exchanges:
+            if not isinstance(exchange, Exchange):
+                exchange = Exchange.model_validate(exchange)
+            history = cls(history, exchange)
+        return history
+
+    def append(self, exchange: Exchange) -> History:
+        return History(self, exchange)
+
+    def _nodes(self) -> Iterator[History]:
+        """The non-empty histories, from this one back."""
+        node = self
+        while node.length:
+            yield node
+            node = node.previous
+
+    def _ancestor(self, length: int) -> History:
+        node = self
+        while node.length > length:
+            node = node.previous
+        return node
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[Exchange]:
+        return reversed([node.last for node in self._nodes()])
+
+    def __reversed__(self) -> Iterator[Exchange]:
+        return (node.last for node in self._nodes())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if start == 0 and step == 1:
+                return self._ancestor(max(stop, 0))
+            return History.of(tuple(self)[index])
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("History index out of range")
+        return self._ancestor(index + 1).last
+
+    def __add__(self, other: Iterable[Exchange]) -> History:
+        history = self
+        for exchange in other:
+            history = history.append(exchange)
+        return history
+
+    def __radd__(self, other: Iterable[Exchange]) -> History:
+        return History.of(other) + self
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, History):
+            if self.length != other.length:
+                return False
+            # walk back together, stopping at any shared history
+            a, b = self, other
+            while a is not b:
+                if a.last != b.last:
+                    return False
+                a, b = a.previous, b.previous
+            return True
+        if isinstance(other, (tuple, list)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            self._hash = hash(tuple(self))
+        return self._hash
+
+    def __repr__(self) -> str:
+        return f"History({tuple(self)!r})"
+
+    # Histories are immutable, and may be long; copying is never needed.
+    def __copy__(self) -> History:
+        return self
+
+    def __deepcopy__(self, memo) -> History:
+        return self
+
+    def __reduce__(self):
+        return (History.of, (tuple(self),))
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler) -> core_schema.CoreSchema:
+        return core_schema.no_info_plain_validator_function(
+            cls.of,
+            serialization=core_schema.plain_serializer_function_ser_schema(tuple),
+        )
+
+
+History.EMPTY = History()
+
+
+def _copier(cls: type) -> Callable:
+    """A function that copies instances of a slotted class, one slot at a time.
+
+    This is much quicker than a loop over the slots, or calling __init__.
+    """
+    lines = ["def copy(self):", "    copy = new(cls)"]
+    lines += [f"    set_{name}(copy, self.{name})" for name in cls.__slots__]
+    lines += ["    return copy"]
+    namespace = {f"set_{name}": getattr(cls, name).__set__ for name in cls.__slots__}
+    namespace |= dict(new=object.__new__, cls=cls)
+    exec("\n".join(lines), namespace)
+    return namespace["copy"]
+
+
+class Record:
+    """Base for the slotted, frozen dataclasses passed between middleware.
+
+    Every middleware layer copies the request it is given, so these are
+    plain dataclasses, not pydantic models. They keep the pydantic methods
+    that middleware uses, and use pydantic only to validate and serialize.
+    """
+
+    __slots__ = ()
+
+    _adapters: ClassVar[dict[type, TypeAdapter]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        # dataclass(slots=True) makes a second class, which has the slots.
+        if "__slots__" in cls.__dict__:
+            cls._copy = _copier(cls)
+
+    def __post_init__(self) -> None:
+        pass
+
+    def model_copy(self, *, update: dict | None = None, deep: bool = False):
+        """A copy, with the given fields updated (and not validated)."""
+        copy = self._copy()
+        if update:
+            for name, value in update.items():
+                object.__setattr__(copy, name, value)
+            copy.__post_init__()
+        return deepcopy(copy) if deep else copy
+
+    @classmethod
+    def _adapter(cls) -> TypeAdapter:
+        if cls not in Record._adapters:
+            Record._adapters[cls] = TypeAdapter(cls)
+        return Record._adapters[cls]
+
+    @classmethod
+    def model_validate(cls, obj):
+        return cls._adapter().validate_python(obj)
+
+    @classmethod
+    def model_validate_json(cls, data: str | bytes):
+        return cls._adapter().validate_json(data)
+
+    def model_dump(self, **kwargs) -> dict:
+        return self._adapter().dump_python(self, **kwargs)
+
+    def model_dump_json(self, **kwargs) -> str:
+        return self._adapter().dump_json(self, **kwargs).decode()
+
+
+@dataclass(frozen=True, slots=True)
+class Contexture(Record):
     """Background parts of a request"""
 
-    context: tuple[Exchange, ...] = ()
+    context: History = History.EMPTY
     system: str | None = None
-    options: dict = Field(default_factory=dict)
+    options: dict = field(default_factory=dict)
     model: str | None = None
 
-    model_config = ConfigDict(frozen=True)
+    def __post_init__(self) -> None:
+        if not isinstance(self.context, History):
+            object.__setattr__(self, "context", History.of(self.context))
 
     def append_exchange(self, exchange: Exchange):
-        return self.model_copy(update=dict(context=self.context + (exchange,)))
+        return self.model_copy(update=dict(context=self.context.append(exchange)))
 
     def add_options(self, **options):
         # using this pattern exclude None value in dict
@@ -62,7 +257,47 @@ class Contexture(BaseModel):
         )
 
 
-class Request(BaseModel):
+class CancellationToken:
+    """Cancels a request, wherever it has reached.
+
+    Middleware passes the token down with the request, and a provider
+    registers callbacks, with on_cancel, that stop its stream.
+    """
+
+    def __init__(self) -> None:
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+
+        # already cancelled, so just call the callback.
+        callback()
+
+    def __deepcopy__(self, memo) -> CancellationToken:
+        # a copy of a request is cancelled along with the original
+        return self
+
+
+@dataclass(frozen=True, slots=True)
+class Request(Record):
     """Foreground parts of a request"""
 
     contexture: Contexture
@@ -74,7 +309,29 @@ class Request(BaseModel):
     images: tuple[str, ...] = ()
     format: str | dict = ""  # str is "json" or "", dict is a JSON schema
 
-    model_config = ConfigDict(frozen=True)
+    # not part of what is asked, so never compared or serialized
+    cancellation: CancellationToken | None = field(
+        default=None, repr=False, compare=False
+    )
+
+    __pydantic_config__ = ConfigDict(arbitrary_types_allowed=True)
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.images, tuple):
+            object.__setattr__(self, "images", tuple(self.images))
+
+    def model_dump(self, **kwargs) -> dict:
+        kwargs["exclude"] = set(kwargs.get("exclude") or ()) | {"cancellation"}
+        return super(Request, self).model_dump(**kwargs)
+
+    def model_dump_json(self, **kwargs) -> str:
+        kwargs["exclude"] = set(kwargs.get("exclude") or ()) | {"cancellation"}
+        return super(Request, self).model_dump_json(**kwargs)
+
+
+Packet = str | Metrics | Value | Informational
+
+_BROADCAST = object()  # sentinel for a Reply that has started broadcasting
 
 
 class Reply:
@@ -90,43 +347,128 @@ class Reply:
         # has already been processed. If you have a
         # Reply, you can assume that tokens
         # are in flight, and the LLM worked.
+        self._cache = []  # every packet, in order
+        # typed views of the packets, so that common queries need not rescan
+        self._text = []  # the str packets
+        self._string = None  # the joined text, once complete
+        self._metrics = None  # first Metrics
+        self._value = None  # first Value
+        self._done = False  # self._packets is exhausted
+        self._cancelled = False
+        # broadcast mode, entered by subscribe, keeps only unread packets
+        self._broadcast = False
+        self._base = 0  # the index of self._cache[0], once packets are dropped
+        self._readers = {}  # the next index of each broadcast reader
+        self._plain = 0  # the number of readers that started before broadcasting
+        self._subscribers = []
+        self._keep_text = True  # collect self._text
+        self._wants_text = False  # str() will be called, so keep the text
         try:
-            self._cache = [next(self._packets)]
+            self._append(next(self._packets))
         except StopIteration:
             self._packets = iter([])
-            self._cache = []
         self._lock = threading.Lock()
         self.closers = []
         self.closing = False
+        self._parts = None  # for a concatenation, the flattened parts
+        self.cancellation = None  # a CancellationToken, cancelled with this reply
+
+    def _append(self, packet) -> None:
+        if isinstance(packet, str):
+            if self._keep_text:
+                self._text.append(packet)
+        elif isinstance(packet, Metrics):
+            if self._metrics is None:
+                self._metrics = packet
+        elif isinstance(packet, Value) and not packet.partial:
+            if self._value is None:
+                self._value = packet
+        # appended last, so readers of _cache also see the typed views
+        self._cache.append(packet)
+        for consumer in self._subscribers:
+            consumer(packet)
 
     def __str__(self):
-        return "".join(self.tokens())
+        if self._string is None:
+            if self._broadcast:
+                self._keep()
+            for _ in self._rest():
+                pass
+            self._string = "".join(self._text)
+        return self._string
 
     def __repr__(self):
 
         return f"Reply([{', '.join([repr(t) for t in self._cache])}{']' if self.closing else ', ...'})"
 
     def __iter__(self):
+        if self._broadcast:
+            yield from self._iter_from(0)
+            return
         ix = 0
-        while True:
-            # We need a lock, because the contents can be consumed
-            # by difference threads. With list, this just works.
-            # With generators, we need to both the cache, and the lock.
-            with self._lock:
-                if ix < len(self._cache):
-                    result = self._cache[ix]
+        cache = self._cache
+        reader = None
+        with self._lock:
+            # counted, because nothing can be dropped while plain readers,
+            # whose positions are not known, are still reading
+            self._plain += 1
+        try:
+            while reader is None:
+                # Packets already in the cache never change, so a reader
+                # that is behind can read them without the lock.
+                if ix < len(cache):
+                    result = cache[ix]
                 else:
-                    assert ix == len(self._cache)
-                    try:
-                        result = next(self._packets)
-                    except StopIteration:
+                    result = self._next(cache, ix)
+                    if result is _END:
+                        break
+                    if result is _BROADCAST:
+                        # subscribe was called while we were reading; we
+                        # are registered before we stop counting as plain,
+                        # so nothing we have still to read can be dropped
+                        reader = object()
+                        with self._lock:
+                            self._readers[reader] = ix
                         break
-                    self._cache.append(result)
 
-            ix += 1  # this a local ix, so does not need guarded
-            yield result
+                ix += 1  # this a local ix, so does not need guarded
+                yield result
+        finally:
+            with self._lock:
+                self._plain -= 1
+
+        if reader is not None:
+            yield from self._iter_from(ix, reader)
+            return
+
+        # auto close, unless the reply was cut short
+        if not self._cancelled:
+            self._close()
 
-        # auto close
+    def _next(self, cache: list, ix: int):
+        """The packet at ix, _END if there is none, or _BROADCAST."""
+        # We need a lock, because the contents can be consumed
+        # by difference threads. With generators, we need to
+        # guard both the cache, and the generator.
+        with self._lock:
+            if self._broadcast:
+                return _BROADCAST
+            elif ix < len(cache):
+                return cache[ix]
+            elif self._cancelled:
+                self._stop()
+                return _END
+            elif self._done:
+                return _END
+            try:
+                result = next(self._packets)
+            except StopIteration:
+                self._done = True
+                return _END
+            self._append(result)
+            return result
+
+    def _close(self) -> None:
         with self._lock:
             if self.closing:
                 return
@@ -137,27 +479,136 @@ class Reply:
         for completion in self.closers:
             completion()
 
+    def subscribe(self, consumer: Callable[[Packet], None]) -> None:
+        """Call consumer with each packet, as it is produced.
+
+        Packets already produced are passed on at once. consumer is called
+        with the reply's lock held, so must not read the reply itself.
+
+        A reply with subscribers only keeps the packets that some reader
+        has still to read, dropping the others as the reply is read. Its
+        text is only kept if str() (or keep_text) is called before any is
+        dropped, and readers (or subscribers) that start after packets are
+        dropped raise LLMInternalError.
+        """
+        with self._lock:
+            if not self._broadcast:
+                self._broadcast = True
+                self._keep_text = self._wants_text or self._string is not None
+                self._cache = deque(self._cache)
+            elif self._base:
+                raise LLMInternalError("subscribe after packets have been dropped")
+            for packet in self._cache:
+                consumer(packet)
+            self._subscribers.append(consumer)
+
+    def drain(self) -> None:
+        """Read the rest of the reply, for example to feed subscribers."""
+        for _ in self._rest():
+            pass
+
+    def keep_text(self) -> None:
+        """Keep the text of this reply, even with subscribers.
+
+        Call this when str() will be called once the reply is read, for
+        example by an after() callback.
+        """
+        self._wants_text = True
+        if self._broadcast:
+            self._keep()
+
+    def _keep(self) -> None:
+        """Keep the text of a broadcast reply, from now on."""
+        with self._lock:
+            if self._keep_text:
+                return
+            if self._base:
+                raise LLMInternalError(
+                    "str() of a reply with subscribers, after its text was dropped"
+                )
+            self._text = [packet for packet in self._cache if isinstance(packet, str)]
+            self._keep_text = True
+
+    def _rest(self) -> Iterator[Packet]:
+        """The packets not yet produced; every packet, unless broadcasting."""
+        if self._broadcast:
+            return self._iter_from(None)
+        return iter(self)
+
+    def _iter_from(self, ix: int | None, reader: object = None) -> Iterator[Packet]:
+        """Read a broadcast reply from index ix, or from the end if ix is None.
+
+        reader is given if it has already been registered, at ix.
+        """
+        if reader is None:
+            reader = object()
+            with self._lock:
+                if ix is None:
+                    ix = self._base + len(self._cache)
+                if ix < self._base:
+                    raise LLMInternalError("reply packets have already been dropped")
+                self._readers[reader] = ix
+        try:
+            while True:
+                with self._lock:
+                    if ix < self._base + len(self._cache):
+                        result = self._cache[ix - self._base]
+                    elif self._cancelled:
+                        self._stop()
+                        break
+                    elif self._done:
+                        break
+                    else:
+                        try:
+                            result = next(self._packets)
+                        except StopIteration:
+                            self._done = True
+                            break
+                        self._append(result)
+                    ix += 1
+                    self._readers[reader] = ix
+                    self._trim()
+                yield result
+        finally:
+            with self._lock:
+                del self._readers[reader]
+                self._trim()
+
+        if not self._cancelled:
+            self._close()
+
+    def _trim(self) -> None:
+        """Drop the packets every reader has read; the lock must be held."""
+        if self._plain:
+            return
+        end = min(self._readers.values(), default=self._base + len(self._cache))
+        while self._base < end:
+            self._cache.popleft()
+            self._base += 1
+
     def tokens(self) -> Iterable[str]:
         """Returns all str tokens."""
         yield from (token for token in self if isinstance(token, str))
 
     def metrics(self) -> Metrics | None:
         """Returns any Metrics."""
-        for t in self:
-            if isinstance(t, Metrics):
-                return t
-        return None
+        if self._metrics is None and not self._done:
+            for t in self._rest():
+                if isinstance(t, Metrics):
+                    break
+        return self._metrics
 
     @property
-    def value(self) -> dict | BaseModel | None:
+    def value(self) -> dict | list | BaseModel | str | int | float | bool | None:
         """Returns any value build by format middleware.
 
         value is a property to be consistent with Response.
         """
-        for t in self:
-            if isinstance(t, Value):
-                return t.value
-        return None
+        if self._value is None and not self._done:
+            for t in self._rest():
+                if isinstance(t, Value) and not t.partial:
+                    break
+        return None if self._value is None else self._value.value
 
     def after(self, completion: Callable[[], None]) -> None:
         with self._lock:
@@ -168,16 +619,240 @@ class Reply:
         # we have completed, so just call completion callback.
         completion()
 
+    def cancel(self) -> None:
+        """Stop generating this reply.
+
+        Packets already generated are kept, but consumers see no more,
+        and the after() callbacks are not called. Any cancellation token
+        is also cancelled, so the provider stops generating too.
+
+        cancel does not block; if another thread is waiting on the next
+        packet, the generator is closed as soon as that packet arrives.
+        """
+        if self._done or self._cancelled:
+            return
+        self._cancelled = True
+        if self._lock.acquire(blocking=False):
+            try:
+                self._stop()
+            finally:
+                self._lock.release()
+        for part in self._parts or []:
+            if isinstance(part, Reply):
+                part.cancel()
+        if self.cancellation is not None:
+            self.cancellation.cancel()
+
+    def _stop(self) -> None:
+        """Close the generator; the lock must be held."""
+        if self._done:
+            return
+        self._done = True
+        if close := getattr(self._packets, "close", None):
+            close()
+
+    def _flatten(self) -> list:
+        """The parts of this reply, each a Reply to read, or a close to call."""
+        if self._parts is None:
+            return [self]
+        return self._parts + [self._close]
+
     def __add__(self, other: "Reply"):
 
         # Need to append both streams of tokens and other values.
         # Need to correctly thread the close,
         # because the outer close needs the inner close to be called.
+        # Inner concatenations are flattened, so a chain of + does not
+        # build a chain of generators, but their closes are still called
+        # after their last part is read.
+        parts = self._flatten() + other._flatten()
+
         def streaming():
-            yield from self
-            yield from other
+            for part in parts:
+                if isinstance(part, Reply):
+                    yield from part
+                else:
+                    part()
+
+        reply = Reply(streaming())
+        reply._parts = parts
+        return reply
+
+
+_END = object()  # sentinel for the end of a synchronous Reply
+
+
+class AsyncReply:
+    """An asynchronous, potentially tokenized response to a large language model.
+
+    This is the asyncio counterpart of Reply. Packets are consumed using
+    `async for`, and can be consumed by many tasks at the same time.
+    """
+
+    def __init__(
+        self,
+        packets: (
+            AsyncIterable[str | Metrics | Value | Informational]
+            | Iterable[str | Metrics | Value | Informational]
+        ),
+    ):
+        if isinstance(packets, AsyncIterable):
+            self._packets = aiter(packets)
+        else:
+
+            async def lift():
+                for packet in packets:
+                    yield packet
+
+            self._packets = lift()
+        self._cache = []
+        self._done = False
+        self._cancelled = False
+        self._stopped = False  # self._packets has been closed
+        self._stopping = None  # the task closing self._packets, after cancel
+        self._reply = None  # any Reply being adapted
+        self.cancellation = None  # a CancellationToken, cancelled with this reply
+        self._lock = asyncio.Lock()
+        self.closers = []
+        self.closing = False
+
+    @classmethod
+    def from_reply(cls, reply: Reply) -> AsyncReply:
+        """Adapt a synchronous Reply.
+
+        Packets the reply has already produced are read at once; only
+        waiting for a new packet takes a worker thread.
+        """
+        iterator = iter(reply)
+
+        async def packets():
+            ix = 0
+            while True:
+                if reply._done or ix < reply._base + len(reply._cache):
+                    packet = next(iterator, _END)
+                else:
+                    packet = await asyncio.to_thread(next, iterator, _END)
+                if packet is _END:
+                    return
+                ix += 1
+                yield packet
 
-        return Reply(streaming())
+        async_reply = cls(packets())
+        async_reply._reply = reply
+        return async_reply
+
+    def __repr__(self):
+
+        return f"AsyncReply([{', '.join([repr(t) for t in self._cache])}{']' if self.closing else ', ...'})"
+
+    async def __aiter__(self):
+        ix = 0
+        while True:
+            if ix >= len(self._cache):
+                # Only one task pulls from the underlying stream at a time;
+                # the others wait, then read from the cache.
+                async with self._lock:
+                    if ix == len(self._cache) and not self._done:
+                        try:
+                            self._cache.append(await anext(self._packets))
+                        except StopAsyncIteration:
+                            self._done = True
+                    if self._cancelled:
+                        await self._stop()
+                if ix >= len(self._cache) or self._cancelled:
+                    break
+
+            result = self._cache[ix]
+            ix += 1
+            yield result
+
+        if self.closing or self._cancelled:
+            return
+        # first past the post
+        self.closing = True
+
+        # close all completers
+        for completion in self.closers:
+            completion()
+
+    def cancel(self) -> None:
+        """Stop generating this reply. The after() callbacks are not called.
+
+        The underlying stream is closed by a task, so the provider closes
+        its HTTP stream. If a task is waiting on the next packet, the
+        stream is closed as soon as that packet arrives.
+        """
+        if self._cancelled:
+            return
+        self._done = True
+        self._cancelled = True
+        if self._reply is not None:
+            self._reply.cancel()
+        if self.cancellation is not None:
+            self.cancellation.cancel()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # the next reader closes the stream instead
+
+        async def stop():
+            async with self._lock:
+                await self._stop()
+
+        self._stopping = loop.create_task(stop())
+
+    async def _stop(self) -> None:
+        """Close the underlying stream; the lock must be held."""
+        if self._stopped:
+            return
+        self._stopped = True
+        if aclose := getattr(self._packets, "aclose", None):
+            await aclose()
+
+    async def tokens(self) -> AsyncIterable[str]:
+        """Returns all str tokens."""
+        async for token in self:
+            if isinstance(token, str):
+                yield token
+
+    async def text(self) -> str:
+        """Returns the complete reply, as a string.
+
+        This is the asynchronous version of str(reply).
+        """
+        return "".join([token async for token in self.tokens()])
+
+    async def metrics(self) -> Metrics | None:
+        """Returns any Metrics."""
+        async for t in self:
+            if isinstance(t, Metrics):
+                return t
+        return None
+
+    async def value(self) -> dict | list | BaseModel | str | int | float | bool | None:
+        """Returns any value build by format middleware."""
+        async for t in self:
+            if isinstance(t, Value) and not t.partial:
+                return t.value
+        return None
+
+    def after(self, completion: Callable[[], None]) -> None:
+        if not self.closing:
+            self.closers.append(completion)
+            return
+
+        # we have completed, so just call completion callback.
+        completion()
+
+    def __add__(self, other: AsyncReply) -> AsyncReply:
+
+        async def streaming():
+            async for packet in self:
+                yield packet
+            async for packet in other:
+                yield packet
+
+        return AsyncReply(streaming())
 
 
 class LanguageModel(ABC):
@@ -187,6 +862,18 @@ class LanguageModel(ABC):
     def ask(self, request: Request) -> Reply:
         """Ask a LLM a specific request."""
 
+    async def aask(self, request: Request) -> AsyncReply:
+        """Ask a LLM a specific request, without blocking the event loop.
+
+        By default, the synchronous ask is run in a worker thread.
+        """
+        reply = await asyncio.to_thread(self.ask, request)
+        return AsyncReply.from_reply(reply)
+
+    def prepare(self, request: Request) -> Request:
+        """The request as it will reach the service, as far as is known before asking."""
+        return request
+
     def __or__(self, other) -> LanguageModel:
         assert isinstance(other, Middleware)
         return MiddlewareLanguageModel(other, self)
@@ -212,6 +899,22 @@ class Middleware(ABC):
     def invoke(self, request: Request, next: LanguageModel) -> Reply:
         return next.ask(request=request)
 
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        """The asynchronous version of invoke.
+
+        By default, the synchronous invoke is run in a worker thread,
+        so any Middleware can be used in an asynchronous pipeline. As invoke
+        may block, for example reading the whole reply, the rest of the
+        pipeline is then asked synchronously too. Middleware that do not
+        block override ainvoke, to call next.aask on the event loop.
+        """
+        reply = await asyncio.to_thread(self.invoke, request, next)
+        return AsyncReply.from_reply(reply)
+
+    def prepare(self, request: Request) -> Request:
+        """The request passed on by invoke, where this is known before invoking."""
+        return request
+
     def first(self):
         """get the first Middleware in the pipeline (from the Prompt's point of view)"""
         return self
@@ -233,6 +936,12 @@ class MiddlewareLanguageModel(LanguageModel):
     def ask(self, request: Request) -> Reply:
         return self.middleware.invoke(request=request, next=self.next)
 
+    async def aask(self, request: Request) -> AsyncReply:
+        return await self.middleware.ainvoke(request=request, next=self.next)
+
+    def prepare(self, request: Request) -> Request:
+        return self.next.prepare(self.middleware.prepare(request))
+
 
 @dataclass(frozen=True)
 class AppendMiddleware(Middleware):
@@ -245,6 +954,14 @@ class AppendMiddleware(Middleware):
             request=request, next=MiddlewareLanguageModel(self.after, next)
         )
 
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        return await self.before.ainvoke(
+            request=request, next=MiddlewareLanguageModel(self.after, next)
+        )
+
+    def prepare(self, request: Request) -> Request:
+        return self.after.prepare(self.before.prepare(request))
+
     def first(self):
         if first := self.before.first():
             return first
@@ -256,3 +973,61 @@ class EmptyMiddleware(Middleware):
 
     def invoke(self, request: Request, next: LanguageModel) -> Reply:
         return next.ask(request=request)
+
+    async def ainvoke(self, request: Request, next: LanguageModel) -> AsyncReply:
+        return await next.aask(request=request)
+
+
+@dataclass(frozen=True)
+class Pipeline(LanguageModel):
+    """Middleware, flattened into layers, and bound to the service it calls.
+
+    The layers are outermost first, that is, in the order that they see a
+    request. The chain of MiddlewareLanguageModel is built once, so asking
+    a pipeline allocates no wrappers, however the middleware was composed.
+    """
+
+    layers: tuple[Middleware, ...]
+    service: LanguageModel
+    top: LanguageModel = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        top = self.service
+        for layer in reversed(self.layers):
+            top = MiddlewareLanguageModel(layer, top)
+        object.__setattr__(self, "top", top)
+
+    @staticmethod
+    def compile(middleware: Middleware, service: LanguageModel) -> Pipeline:
+        layers = []
+        stack = [middleware]
+        while stack:
+            middleware = stack.pop()
+            if isinstance(middleware, AppendMiddleware):
+                # before is outside after, so is popped first
+                stack.append(middleware.after)
+                stack.append(middleware.before)
+            elif not isinstance(middleware, EmptyMiddleware):
+                layers.append(middleware)
+        return Pipeline(tuple(layers), service)
+
+    def ask(self, request: Request) -> Reply:
+        return self.top.ask(request)
+
+    async def aask(self, request: Request) -> AsyncReply:
+        return await self.top.aask(request)
+
+    def prepare(self, request: Request) -> Request:
+        for layer in self.layers:
+            request = layer.prepare(request)
+        return self.service.prepare(request)
+
+    def first(self) -> Middleware | None:
+        """The first middleware to see a request, if any."""
+        return self.layers[0] if self.layers else None
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def __iter__(self) -> Iterator[Middleware]:
+        return iter(self.layers)
@@ -1,19 +1,31 @@
+import asyncio
+import email.utils
+import gc
+import http.server
 import json
 import os
 import re
+import sqlite3
 import subprocess
 import sys
 import threading
 import time
+import weakref
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from dataclasses import asdict, dataclass, field, fields, replace
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import ollama
 import pytest
 from pydantic import BaseModel
 from tenacity import stop_after_attempt
 
 from haverscript import (
+    AsyncReply,
+    CancellationToken,
     LanguageModel,
     LLMError,
     LLMResultError,
@@ -25,8 +37,40 @@ from haverscript import (
     ServiceProvider,
     connect,
 )
-from haverscript.cache import INTERACTION, Cache
-from haverscript.types import Exchange, Request
+from haverscript.cache import (
+    INTERACTION,
+    SQL_VERSION,
+    Cache,
+    Memory,
+    Query,
+    RemoteBackend,
+    Retention,
+    SQLiteBackend,
+    context_address,
+    context_hashes,
+    main,
+    string_hash,
+)
+from haverscript.cache_server import serve
+from haverscript.exceptions import (
+    LLMConfigurationError,
+    LLMConnectivityError,
+    LLMInternalError,
+    LLMRateLimitError,
+    parse_retry_after,
+)
+from haverscript.fleet import LEAST_OUTSTANDING, Fleet
+from haverscript.fleet import connect as fleet_connect
+from haverscript.ollama import OllamaMetrics, Pool
+from haverscript.types import (
+    Contexture,
+    Exchange,
+    History,
+    Informational,
+    Metrics,
+    Request,
+    Value,
+)
 from haverscript.middleware import *
 from tests.test_utils import remove_spinner
 
@@ -73,8 +117,9 @@ class _TestClient:
             time.sleep(0.01)
             yield {"message": {"content": token}, "done": False}
 
-    def chat(self, model, stream, messages, options, format):
+    def chat(self, model, stream, messages, options, format, keep_alive=None):
         assert format == "json" or format == "" or isinstance(format, dict)
+        self.keep_alive = keep_alive
         extra = None
 
         assert isinstance(messages, list)
@@ -118,12 +163,43 @@ class _TestClient:
         return {"models": [Model(x) for x in ["A", "B", "C"]]}
 
 
+class _AsyncTestClient(_TestClient):
+    async def _async_streaming(self, reply):
+        for token in re.findall(r"\S+|\s+", reply):
+            await asyncio.sleep(0.01)
+            yield {"message": {"content": token}, "done": False}
+
+    async def chat(self, model, stream, messages, options, format, keep_alive=None):
+        response = super().chat(model, False, messages, options, format, keep_alive)
+        if stream:
+            return self._async_streaming(response["message"]["content"])
+        return response
+
+
+class _EveryLoop(weakref.WeakKeyDictionary):
+    """The same async clients, whichever event loop is running"""
+
+    def __init__(self, clients):
+        super().__init__()
+        self.clients = clients
+
+    def setdefault(self, loop, default=None):
+        return self.clients
+
+
 # inject the TestClient
 def inject():
+    pool = Pool()
     sys.modules["haverscript.ollama"].Ollama.client = {
-        None: _TestClient(None),
-        test_model_host: _TestClient(test_model_host),
+        (None, pool): _TestClient(None),
+        (test_model_host, pool): _TestClient(test_model_host),
     }
+    sys.modules["haverscript.ollama"].Ollama.async_client = _EveryLoop(
+        {
+            (None, pool): _AsyncTestClient(None),
+            (test_model_host, pool): _AsyncTestClient(test_model_host),
+        }
+    )
 
 
 @pytest.fixture
@@ -189,6 +265,103 @@ def check_model(model, host, system):
         render += "\n"
 
 
+def test_achat(sample_model):
+    async def main():
+        session = await sample_model.system("system").achat("Message #0")
+        session = await session.achat("Message #1")
+        return session
+
+    session = asyncio.run(main())
+    assert type(session) is Response
+    context = [
+        {"role": "system", "content": "system"},
+        {"role": "user", "content": "Message #0"},
+        {"role": "assistant", "content": session.parent.reply},
+        {"role": "user", "content": "Message #1"},
+    ]
+    assert session.reply == llm(None, test_model_name, context, {}, "")
+    assert session.metrics.total_duration == 100
+    assert session == session.parent.chat("Message #1")
+
+
+def test_achat_middleware(sample_model, capfd):
+    async def main():
+        # native async middleware
+        value = (await sample_model.achat("", middleware=format())).value
+        context = [{"role": "user", "content": ""}]
+        assert value == json.loads(llm(None, test_model_name, context, {}, "json"))
+        # synchronous middleware, adapted using worker threads
+        await (sample_model | echo(spinner=False)).achat("Hello")
+        # many concurrent conversations
+        return await asyncio.gather(
+            *[
+                (sample_model | options(seed=i)).achat(f"Message #{i}")
+                for i in range(20)
+            ]
+        )
+
+    replies = asyncio.run(main())
+    assert capfd.readouterr().out == reply_to_hello
+    for i, reply in enumerate(replies):
+        context = [{"role": "user", "content": f"Message #{i}"}]
+        assert reply.reply == llm(None, test_model_name, context, {"seed": i}, "")
+
+    with pytest.raises(LLMResultError):
+        asyncio.run(
+            (
+                sample_model
+                | validate(lambda reply: "Squirrel" not in reply)
+                | retry(stop=stop_after_attempt(3))
+            ).achat("Squirrel")
+        )
+
+
+def test_achat_threads(sample_model, tmp_path, monkeypatch):
+    # middleware that do not block call the provider on the event loop
+    threaded = []
+    to_thread = asyncio.to_thread
+
+    async def recording(function, *args, **kwargs):
+        threaded.append(function.__name__)
+        return await to_thread(function, *args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "to_thread", recording)
+    model = (
+        sample_model
+        | rate_limit()
+        | transcript(tmp_path / "transcripts")
+        | cache(str(tmp_path / "cache.db"))
+    )
+    first = asyncio.run(model.achat("Hello"))
+    assert threaded == ["lookup", "save"]
+    assert first.reply == sample_model.chat("Hello").reply
+    assert len(os.listdir(tmp_path / "transcripts")) == 2
+    assert model.children("Hello")[0].reply == first.reply
+
+    # and synchronous middleware only hop threads to wait for new packets
+    threaded.clear()
+    asyncio.run((sample_model | echo(spinner=False)).achat("Hello"))
+    assert threaded == ["invoke"]
+
+
+def test_chat_many(sample_model):
+    prompts = [f"Message #{i}" for i in range(20)] + ["FAIL(0)"]
+    session = sample_model.system("system")
+
+    for replies in [
+        session.chat_many(prompts, max_concurrency=4),
+        asyncio.run(session.achat_many(prompts, max_concurrency=4)),
+    ]:
+        assert len(replies) == len(prompts)
+        for prompt, reply in zip(prompts[:-1], replies):
+            assert reply == session.chat(prompt)
+        assert isinstance(replies[-1], LLMError)
+
+    # chat_many is also available on Response
+    response = session.chat("Hello")
+    assert response.chat_many(["World"]) == [response.chat("World")]
+
+
 class UserService(ServiceProvider):
     def ask(self, request: Request):
         return Reply(
@@ -377,6 +550,88 @@ def test_json_and_format(sample_model):
     )
 
 
+class _Streaming(LanguageModel):
+    """A LanguageModel that replies with the given tokens"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def ask(self, request):
+        return Reply(self.tokens)
+
+
+def test_format_incremental(sample_model):
+    reply = sample_model.chat("", middleware=format(LLM, incremental=True))
+    context = [{"role": "user", "content": ""}]
+    llm_reply = llm(None, test_model_name, context, {}, LLM.model_json_schema())
+    assert reply.reply == llm_reply
+    assert reply.value == LLM.model_validate_json(llm_reply)
+
+    request = Request(contexture=Contexture(), prompt="")
+    tokens = ['{"a": [1, ', "2], ", '"b": "x', 'y"', ', "c": {"d": null}}']
+    reply = format(incremental=True).invoke(request, _Streaming(tokens))
+    assert [packet.value for packet in reply if isinstance(packet, Value)] == [
+        {"a": [1, 2]},
+        {"a": [1, 2], "b": "xy"},
+        {"a": [1, 2], "b": "xy", "c": {"d": None}},
+        {"a": [1, 2], "b": "xy", "c": {"d": None}},
+    ]
+    assert reply.value == {"a": [1, 2], "b": "xy", "c": {"d": None}}
+
+    def invalid():
+        yield '{"a": 1 '
+        yield '"b": 2}'
+        assert False, "the error should be found before here"
+
+    reply = format(incremental=True).invoke(request, _Streaming(invalid()))
+    with pytest.raises(LLMResultError, match="offset 8"):
+        str(reply)
+
+    # an invalid prefix cancels the upstream reply, sync and async
+    class Upstream(LanguageModel):
+        def ask(self, request):
+            self.reply = Reply(self.tokens())
+            return self.reply
+
+        async def aask(self, request):
+            self.reply = AsyncReply(self.atokens())
+            return self.reply
+
+        def tokens(self):
+            self.closed = False
+            try:
+                yield '{"a": 1 '
+                yield '"b": 2}'
+            finally:
+                self.closed = True
+
+        async def atokens(self):
+            for token in self.tokens():
+                yield token
+
+    upstream = Upstream()
+    reply = format(incremental=True).invoke(request, upstream)
+    with pytest.raises(LLMResultError, match="offset 8"):
+        str(reply)
+    assert upstream.reply._cancelled and upstream.closed
+
+    async def invalid_async():
+        reply = await format(incremental=True).ainvoke(request, upstream)
+        with pytest.raises(LLMResultError, match="offset 8"):
+            await reply.text()
+
+    asyncio.run(invalid_async())
+    assert upstream.reply._cancelled
+
+    # any JSON value can be the reply, not just objects
+    for tokens, value in [(["[1, ", "2, 3]"], [1, 2, 3]), (["4", "2"], 42)]:
+        for incremental in (False, True):
+            service = Service(_Streaming(tokens)) | format(incremental=incremental)
+            response = service.chat("")
+            assert response.value == value
+            assert response.reply == "".join(tokens)
+
+
 def test_cache(sample_model, tmp_path):
     temp_file = tmp_path / "cache.db"
     mode = "a+"
@@ -459,6 +714,163 @@ def test_cache(sample_model, tmp_path):
     assert len(model.children()) == 0
 
 
+def test_cache_threads(sample_model, tmp_path):
+    temp_file = tmp_path / "cache.db"
+    model = sample_model | cache(temp_file)
+
+    hello = "### Hello"
+    replies = {model.chat(hello).reply for _ in range(8)}
+    assert len(replies) == 8
+
+    # reset the cursor, to simulate a new execute
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    model = sample_model | cache(temp_file)
+
+    # each thread has its own connection, but they share the blacklist
+    responses = model.chat_many([hello] * 8, max_concurrency=8)
+    assert {response.reply for response in responses} == replies
+
+    # readers do not wait on the lock that claims replies
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    reader = sample_model | cache(temp_file, "r")
+    store = Cache(str(temp_file), "r").store
+    read = []
+    with store.lock:
+        thread = threading.Thread(target=lambda: read.append(reader.chat(hello)))
+        thread.start()
+        thread.join(timeout=5)
+        assert read and read[0].reply in replies
+
+    result = subprocess.run(
+        f'echo "PRAGMA journal_mode;" | sqlite3 {temp_file}',
+        shell=True,
+        text=True,
+        capture_output=True,
+    )
+    assert result.stdout.strip() == "wal"
+
+
+def test_cache_subscribe(sample_model, tmp_path):
+    temp_file = tmp_path / "cache.db"
+    model = sample_model | transcript(tmp_path / "transcripts") | cache(temp_file)
+
+    request, reply = model.ask("Hello")
+    written = []
+    reply.subscribe(written.append)
+    reply.drain()
+    # the cache and transcript, which read the text once done, still work
+    text = "".join(packet for packet in written if isinstance(packet, str))
+    assert model.process(request, reply).reply == text
+    assert text in (tmp_path / "transcripts" / "latest.md").read_text()
+    assert model.children("Hello")[0].reply == text
+
+
+def test_cache_write(tmp_path):
+    filename = tmp_path / "cache.db"
+    context = (Exchange(prompt="Hello", images=(), reply="World"),)
+    query = Query(None, context, "How are you?", (), {})
+
+    # many threads adding the same new context and strings at once
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def insert(ix):
+        backend = SQLiteBackend(filename, "a+", blacklisted=set())
+        barrier.wait()
+        try:
+            backend.insert(query, f"Fine {ix}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=insert, args=(ix,)) for ix in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    backend = SQLiteBackend(filename, "a+", blacklisted=set())
+    assert sorted(reply for _, _, reply in backend.replies(query)) == [
+        f"Fine {ix}" for ix in range(8)
+    ]
+    conn = sqlite3.connect(filename)
+    assert conn.execute("SELECT count(*) FROM context").fetchone() == (9,)
+
+    # a failed insert is rolled back, and its strings are not remembered
+    store = backend.cache.store
+    with pytest.raises(TypeError):
+        backend.insert(replace(query, parameters=dict(bad=object())), "Never")
+    assert not store.conn.in_transaction
+    assert store.strings.get("Never") is None
+    assert conn.execute(
+        "SELECT count(*) FROM string_pool WHERE hash = ?", (string_hash("Never"),)
+    ).fetchone() == (0,)
+    assert backend.insert(query, "Fine again").id is not None
+
+    # the contexts remembered are bounded, however many are added
+    store.contexts.size = 4
+    for ix in range(8):
+        context = context + (Exchange(prompt=f"{ix}", images=(), reply="OK"),)
+        backend.insert(replace(query, context=context), "Fine")
+    assert len(store.contexts.entries) == 4
+    assert backend.replies(replace(query, context=context))[0][2] == "Fine"
+
+
+@pytest.mark.parametrize("compress", ["zlib", "zstd"])
+def test_cache_compress(sample_model, tmp_path, compress):
+    if compress == "zstd":
+        pytest.importorskip("zstandard")
+    temp_file = tmp_path / "cache.db"
+
+    # some uncompressed replies, to train any dictionary
+    replies = (sample_model | cache(temp_file)).chat_many(
+        [f"### {i}" for i in range(200)]
+    )
+
+    model = sample_model | cache(temp_file, compress=compress)
+    session = model.chat("### Hello").chat("### World")
+
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    model = sample_model | cache(temp_file, "r")
+    assert model.chat("### Hello").chat("### World").render() == session.render()
+    assert [model.chat(f"### {i}").reply for i in range(200)] == [
+        reply.reply for reply in replies
+    ]
+
+    conn = Cache(temp_file, "r").conn
+    assert conn.execute("SELECT name FROM codecs").fetchall() == [(compress,)]
+    # the new replies are compressed, but not the (short) prompts
+    for text, compressed in [
+        (session.parent.reply, True),
+        (session.reply, True),
+        (replies[0].reply, False),
+        ("### World", False),
+    ]:
+        string, data = conn.execute(
+            "SELECT string, data FROM string_pool WHERE hash = ?",
+            (string_hash(text),),
+        ).fetchone()
+        assert (string is None) == (data is not None) == compressed
+
+    if compress == "zstd":
+        # a new cache trains its dictionary once it has enough strings
+        temp_file = tmp_path / "new.db"
+        model = sample_model | cache(temp_file, compress=compress)
+        replies = model.chat_many([f"### {i}" for i in range(300)])
+        conn = Cache(temp_file, "r").conn
+        ((codec, dictionary),) = conn.execute(
+            "SELECT id, dictionary FROM codecs WHERE dictionary IS NOT NULL"
+        ).fetchall()
+        assert conn.execute(
+            "SELECT count(*) FROM string_pool WHERE codec = ?", (codec,)
+        ).fetchone()[0]
+        sys.modules["haverscript.cache"].Cache.connections = {}
+        model = sample_model | cache(temp_file, "r")
+        assert [model.chat(f"### {i}").reply for i in range(300)] == [
+            reply.reply for reply in replies
+        ]
+
+
 def test_check(sample_model):
     # simple check
     assert repr(
@@ -534,6 +946,32 @@ def valid_json(txt):
         raise False
 
 
+def test_pipeline(sample_model: Model):
+    first, second = options(a=1), options(b=2)
+    llm = sample_model | first | (second | fresh())
+
+    # compiled once, outermost layer first
+    pipeline = llm.pipeline()
+    assert pipeline is llm.pipeline()
+    assert pipeline.layers[:3] == (fresh(), second, first)
+    assert pipeline.layers[3] == model(test_model_name)
+    assert pipeline.first() == fresh()
+    assert pipeline.service is llm.settings.service
+
+    reply = llm.chat("Hello")
+    assert json.loads(str(reply))["options"] == dict(a=1, b=2)
+    assert reply.pipeline() is pipeline
+    assert (llm | echo()).pipeline().first() == echo()
+
+    # deep compositions are flattened without recursion
+    deep = sample_model
+    for ix in range(3000):
+        deep = deep | options(ix=ix)
+    assert len(deep.pipeline()) == 3001
+    request = deep.request("Hello")
+    assert deep.pipeline().prepare(request).contexture.options == dict(ix=0)
+
+
 def test_image(sample_model):
     image_src = f"{Path(__file__).parent}/../examples/images/edinburgh.png"
     prompt = "Describe this image"
@@ -594,6 +1032,798 @@ def test_validate(sample_model: Model):
         ).chat("###")
 
 
+def test_validate_stream(sample_model: Model):
+    pulled = []
+
+    def tokens():
+        try:
+            for i in range(100):
+                pulled.append(i)
+                yield "xx"
+        finally:
+            pulled.append("closed")
+
+    request = Request(contexture=Contexture(), prompt="")
+    short = validate(stream_predicate=lambda text: len(text) < 10)
+    with pytest.raises(LLMResultError, match="after 10 characters"):
+        short.invoke(request, _Streaming(tokens()))
+    # the generation was stopped at the first failure
+    assert pulled == [0, 1, 2, 3, 4, "closed"]
+
+    assert str(short.invoke(request, _Streaming(["xx"] * 4))) == "xx" * 4
+
+    with pytest.raises(LLMError):
+        (sample_model | validate(stream_predicate=lambda txt: "###" not in txt)).chat(
+            "###"
+        )
+
+
+def test_cancel(sample_model: Model):
+    closed = []
+
+    class _ClosingClient(_TestClient):
+        def _streaming(self, reply):
+            try:
+                yield from super()._streaming(reply)
+            finally:
+                closed.append(True)
+
+    Ollama = sys.modules["haverscript.ollama"].Ollama
+    Ollama.client["closing", Pool()] = _ClosingClient("closing")
+
+    # cancelling the token closes the provider's stream
+    token = CancellationToken()
+    request = Request(
+        contexture=Contexture(model=test_model_name),
+        prompt="Hello",
+        stream=True,
+        cancellation=token,
+    )
+    reply = Ollama("closing").ask(request)
+    tokens = iter(reply)
+    next(tokens)
+    token.cancel()
+    assert closed == [True]
+    assert list(tokens) == []
+    assert token.cancelled
+    assert "cancellation" not in request.model_dump()
+
+    # cancelling a reply cancels its request
+    request, reply = sample_model.ask("Hello")
+    assert request.cancellation is not None
+    assert not request.cancellation.cancelled
+    reply.cancel()
+    assert request.cancellation.cancelled
+
+    # a reader waiting for a packet stops once it arrives
+    def slow():
+        yield "a"
+        time.sleep(0.2)
+        yield "b"
+        yield "c"
+
+    reply = Reply(slow())
+    tokens = iter(reply)
+    assert next(tokens) == "a"
+    threading.Timer(0.1, reply.cancel).start()
+    assert list(tokens) == ["b"]
+
+
+def test_acancel():
+    closed = []
+
+    class _ClosingAsyncClient(_AsyncTestClient):
+        async def _async_streaming(self, reply):
+            try:
+                async for chunk in super()._async_streaming(reply):
+                    yield chunk
+            finally:
+                closed.append(True)
+
+    inject()
+    Ollama = sys.modules["haverscript.ollama"].Ollama
+    Ollama.client["aclosing", Pool()] = _TestClient("aclosing")
+    Ollama.async_client.clients["aclosing", Pool()] = _ClosingAsyncClient("aclosing")
+
+    def request():
+        return Request(
+            contexture=Contexture(model=test_model_name), prompt="Hello", stream=True
+        )
+
+    async def main():
+        # the caller stops reading, then cancels; the provider's stream is closed
+        reply = await Ollama("aclosing").aask(request())
+        async for _ in reply:
+            break
+        reply.cancel()
+        await asyncio.sleep(0.05)
+        assert closed == [True]
+        assert [packet async for packet in reply] == [reply._cache[0]]
+
+        # a reader waiting for a packet stops, and closes the stream, once it arrives
+        reply = await Ollama("aclosing").aask(request())
+
+        async def read():
+            return [packet async for packet in reply]
+
+        reader = asyncio.create_task(read())
+        await asyncio.sleep(0.015)
+        reply.cancel()
+        packets = await reader
+        await asyncio.sleep(0.01)
+        assert closed == [True, True]
+        assert len(packets) < 10
+
+    asyncio.run(main())
+
+
+def test_History():
+    exchanges = [
+        Exchange(prompt=f"prompt {i}", images=(), reply=f"reply {i}")
+        for i in range(3000)
+    ]
+    contexture = Contexture()
+    for exchange in exchanges:
+        contexture = contexture.append_exchange(exchange)
+    context = contexture.context
+    assert isinstance(context, History)
+
+    # each turn shares the history of the turn before
+    assert contexture.append_exchange(exchanges[0]).context.previous is context
+
+    # behaves as a tuple
+    assert len(context) == 3000
+    assert context[0] == exchanges[0] and context[-1] == exchanges[-1]
+    assert context == tuple(exchanges) and context != tuple(exchanges[1:])
+    assert hash(context) == hash(tuple(exchanges))
+    assert list(context) == exchanges
+    assert context[:10] == tuple(exchanges[:10])
+    assert context[5:10] == tuple(exchanges[5:10])
+    assert context + (exchanges[0],) == tuple(exchanges + exchanges[:1])
+    assert Contexture().context == ()
+    with pytest.raises(IndexError):
+        context[3000]
+
+    # validated from, and dumped as, a tuple
+    contexture = Contexture(context=tuple(exchanges[:2]))
+    assert isinstance(contexture.context, History)
+    assert contexture.model_dump()["context"] == tuple(
+        exchange.model_dump() for exchange in exchanges[:2]
+    )
+    assert Contexture.model_validate_json(contexture.model_dump_json()) == contexture
+
+    # long histories are not copied
+    assert deepcopy(context) is context
+
+
+def test_Request():
+    token = CancellationToken()
+    request = Request(
+        contexture=Contexture(model="A", context=()),
+        prompt="Hello",
+        images=["image"],
+        cancellation=token,
+    )
+    assert isinstance(request.contexture.context, History)
+    assert request.images == ("image",)
+    with pytest.raises(AttributeError):
+        request.prompt = "World"
+
+    # copies share the unchanged fields, including the token
+    copy = request.model_copy(update=dict(prompt="World"))
+    assert copy.prompt == "World" and request.prompt == "Hello"
+    assert copy.contexture is request.contexture
+    assert copy.cancellation is token
+    assert copy.model_copy(update=dict(prompt="Hello")) == request
+    assert request.model_copy(deep=True).cancellation is token
+
+    # pydantic is used to serialize and validate
+    assert request.model_dump()["contexture"]["model"] == "A"
+    assert "cancellation" not in request.model_dump_json()
+    assert Request.model_validate_json(request.model_dump_json()) == request
+    assert Request.model_validate(request.model_dump()) == request
+
+
+def test_coalesce(monkeypatch):
+    class Slow(LanguageModel):
+        def __init__(self):
+            self.requests = []
+
+        def ask(self, request):
+            self.requests.append(request)
+
+            def tokens():
+                time.sleep(0.1)
+                yield from ["Hello", " ", "World"]
+
+            return Reply(tokens())
+
+    def ask(middleware, request, replies):
+        replies.append(middleware.invoke(request, service))
+
+    def request(**kwargs):
+        return Request(
+            contexture=Contexture(model="A"),
+            prompt="Hello",
+            cancellation=CancellationToken(),
+            **kwargs,
+        )
+
+    # identical requests in flight at once are asked once
+    service = Slow()
+    replies = []
+    threads = [
+        threading.Thread(target=ask, args=(coalesce(), request(), replies))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(service.requests) == 1
+    assert [str(reply) for reply in replies] == ["Hello World"] * 8
+    # ... but once the reply is complete, the request is asked again
+    assert str(coalesce().invoke(request(), service)) == "Hello World"
+    assert len(service.requests) == 2
+
+    # fresh requests, and different requests, are not shared
+    first = coalesce().invoke(request(fresh=True), service)
+    second = (coalesce() | fresh()).invoke(request(), service)
+    third = coalesce().invoke(request(images=("image",)), service)
+    assert len(service.requests) == 5
+    assert str(first) == str(second) == str(third)
+
+    # the shared reply is only cancelled when every follower has cancelled
+    first, second, third = request(), request(), request()
+    replies = [coalesce().invoke(each, service) for each in (first, second, third)]
+    shared = service.requests[-1].cancellation
+    first.cancellation.cancel()
+    assert not shared.cancelled
+    assert str(replies[1]) == "Hello World"
+    third.cancellation.cancel()
+    assert shared.cancelled
+
+    # an abandoned reply leaves too, whether cancelled or garbage collected
+    first = Request(contexture=Contexture(model="A"), prompt="Hello")
+    replies = [coalesce().invoke(first, service), coalesce().invoke(request(), service)]
+    shared = service.requests[-1].cancellation
+    replies[0].cancel()
+    assert not shared.cancelled
+    replies.pop()
+    gc.collect()
+    assert shared.cancelled
+    # and new requests are asked afresh, rather than following it
+    assert str(coalesce().invoke(first, service)) == "Hello World"
+    assert len(service.requests) == 8
+
+    # ... even if they arrive just as the last participant leaves
+    class Window:
+        """A lock that asks a request the first time it is released, once armed"""
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.armed = False
+            self.replies = []
+
+        def __enter__(self):
+            self.lock.acquire()
+
+        def __exit__(self, *exc):
+            self.lock.release()
+            if self.armed:
+                self.armed = False
+                self.replies.append(coalesce().invoke(first, service))
+
+    window = Window()
+    monkeypatch.setattr(CoalesceMiddleware, "lock", window)
+    reply = coalesce().invoke(first, service)
+    window.armed = True
+    reply.cancel()
+    assert service.requests[-2].cancellation.cancelled
+    assert not service.requests[-1].cancellation.cancelled
+    assert str(window.replies[0]) == "Hello World"
+
+
+@dataclass(frozen=True)
+class _Usage(Metrics):
+    total_tokens: int
+
+
+class _Limited(LanguageModel):
+    """A LanguageModel that refuses the first few requests"""
+
+    def __init__(self, refusals=0, retry_after=None, tokens=10):
+        self.refusals = refusals
+        self.retry_after = retry_after
+        self.tokens = tokens
+        self.asked = []
+
+    def ask(self, request):
+        self.asked.append(time.monotonic())
+        if len(self.asked) <= self.refusals:
+            raise LLMRateLimitError("429", retry_after=self.retry_after)
+        return Reply(["Hello", _Usage(self.tokens)])
+
+
+def test_rate_limit():
+    def request(model):
+        return Request(contexture=Contexture(model=model), prompt="Hello")
+
+    def limiter(model):
+        return sys.modules["haverscript.middleware"].Limiter.limiters[
+            ("_Limited", None, model)
+        ]
+
+    # Retry-After is honoured, and each refusal halves the concurrency
+    service = _Limited(refusals=2, retry_after=0.1)
+    assert str(rate_limit().invoke(request("A"), service)) == "Hello"
+    assert len(service.asked) == 3
+    assert service.asked[2] - service.asked[0] >= 0.2
+    assert limiter("A").concurrency == 4 + 1 / 4
+    assert limiter("A").in_flight == 0
+
+    service = _Limited(refusals=10)
+    with pytest.raises(LLMRateLimitError):
+        rate_limit(retries=2).invoke(request("B"), service)
+    assert len(service.asked) == 3
+
+    # requests per second are shared between rate_limits
+    service = _Limited()
+    start = time.monotonic()
+    for _ in range(30):
+        str(rate_limit(requests_per_second=50).invoke(request("C"), service))
+    for _ in range(30):
+        str(rate_limit(requests_per_second=50).invoke(request("C"), service))
+    assert time.monotonic() - start >= (60 - 50) / 50
+
+    # a rate of less than one request per second still makes requests
+    service = _Limited()
+    start = time.monotonic()
+    str(rate_limit(requests_per_second=0.5).invoke(request("G"), service))
+    assert time.monotonic() - start < 0.5
+    assert limiter("G").requests.wait(time.monotonic()) == pytest.approx(2, abs=0.1)
+
+    # tokens are counted once each reply is complete
+    service = _Limited(tokens=1000)
+    start = time.monotonic()
+    for _ in range(4):
+        str(rate_limit(tokens_per_second=2000).invoke(request("D"), service))
+    assert time.monotonic() - start >= 0.5
+
+    # rate_limits on the same provider and model must agree
+    with pytest.raises(LLMConfigurationError):
+        rate_limit(requests_per_second=10).invoke(request("C"), service)
+
+    # abandoned replies give back their slot
+    service = _Limited()
+    middleware = rate_limit(max_concurrency=1)
+    reply = middleware.invoke(request("E"), service)
+    reply.cancel()
+    assert limiter("E").in_flight == 0
+    reply = middleware.invoke(request("E"), service)
+    del reply
+    gc.collect()
+    assert limiter("E").in_flight == 0
+    assert str(middleware.invoke(request("E"), service)) == "Hello"
+    assert limiter("E").in_flight == 0
+
+    # ... including asynchronous replies, which are not started eagerly
+    async def abandon():
+        reply = await middleware.ainvoke(request("F"), service)
+        reply.cancel()
+        assert limiter("F").in_flight == 0
+        reply = await middleware.ainvoke(request("F"), service)
+        del reply
+        gc.collect()
+        assert limiter("F").in_flight == 0
+        reply = await middleware.ainvoke(request("F"), service)
+        return await reply.text()
+
+    assert asyncio.run(asyncio.wait_for(abandon(), 5)) == "Hello"
+    assert limiter("F").in_flight == 0
+
+    # failures, and cancellations, give back their slot, but do not grow the window
+    class Flaky(LanguageModel):
+        def __init__(self, outcomes):
+            self.outcomes = iter(outcomes)
+
+        def ask(self, request):
+            outcome = next(self.outcomes)
+            if outcome == "refuse":
+                raise LLMRateLimitError("429", retry_after=0.0)
+            if outcome == "fail":
+                raise ConnectionError()
+
+            def tokens():
+                yield "Hello"
+                if outcome == "break":
+                    raise ConnectionError()
+
+            return Reply(tokens())
+
+        async def aask(self, request):
+            reply = self.ask(request)
+            return AsyncReply(reply)
+
+    def flaky(model):
+        return sys.modules["haverscript.middleware"].Limiter.limiters[
+            ("Flaky", None, model)
+        ]
+
+    service = Flaky(["refuse", "ok", "fail", "break", "ok", "break"])
+    middleware = rate_limit(retries=1)
+    str(middleware.invoke(request("H"), service))
+    window = flaky("H").concurrency
+    assert window < flaky("H").max_concurrency
+    with pytest.raises(ConnectionError):
+        middleware.invoke(request("H"), service)
+    with pytest.raises(ConnectionError):
+        str(middleware.invoke(request("H"), service))
+    middleware.invoke(request("H"), service).cancel()
+
+    async def broken():
+        with pytest.raises(ConnectionError):
+            await (await middleware.ainvoke(request("H"), service)).text()
+
+    asyncio.run(broken())
+    assert flaky("H").concurrency == window
+    assert flaky("H").in_flight == 0
+
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 -0000") == 0
+    assert (
+        3590
+        < parse_retry_after(
+            email.utils.format_datetime(
+                datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+            )
+        )
+        <= 3600
+    )
+    assert parse_retry_after("soon") is None
+    Ollama = sys.modules["haverscript.ollama"].Ollama
+    error = Ollama()._suggestions(ollama.ResponseError("slow down", 429))
+    assert isinstance(error, LLMRateLimitError)
+
+
+def test_rate_limit_executor(tmp_path):
+    # waiting for a slot takes no worker thread, which cache needs
+    inject()
+    model = (
+        connect("executor-model")
+        | cache(str(tmp_path / "cache.db"))
+        | rate_limit(max_concurrency=2)
+    )
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(4))
+        return await asyncio.wait_for(
+            asyncio.gather(*[model.achat(f"Message #{i}") for i in range(8)]), 10
+        )
+
+    replies = asyncio.run(main())
+    assert [reply.prompt for reply in replies] == [f"Message #{i}" for i in range(8)]
+
+
+class _Latent(LanguageModel):
+    """A LanguageModel where each request takes the next latency to reply"""
+
+    def __init__(self, latencies, metrics=False):
+        self.latencies = list(latencies)
+        self.metrics = metrics
+        self.tokens = []
+        self.lock = threading.Lock()
+
+    def ask(self, request):
+        with self.lock:
+            latency = self.latencies.pop(0)
+            ix = len(self.tokens)
+            self.tokens.append(request.cancellation)
+        if latency is None:
+            raise LLMError()
+        if isinstance(latency, BaseException):
+            raise latency
+
+        def tokens():
+            time.sleep(latency)
+            yield f"reply {ix}"
+            if self.metrics:
+                yield _Usage(ix)
+
+        return Reply(tokens())
+
+
+def test_hedge():
+    def request(model):
+        return Request(contexture=Contexture(model=model), prompt="Hello")
+
+    # a slow first token is hedged, and the loser cancelled
+    service = _Latent([1.0, 0.0])
+    start = time.monotonic()
+    reply = hedge(after=0.05).invoke(request("A"), service)
+    assert time.monotonic() - start < 0.5
+    assert str(reply) == "reply 1"
+    assert list(reply)[-1] == HedgeMetrics(attempts=2, winner=1, delay=0.05)
+    assert service.tokens[0].cancelled
+    assert not service.tokens[1].cancelled
+
+    # ... and the provider's metrics are merged with the hedging
+    service = _Latent([1.0, 0.0], metrics=True)
+    reply = hedge(after=0.05).invoke(request("A"), service)
+    assert reply.metrics() == HedgeMetrics(2, 1, 0.05, _Usage(1))
+    assert reply.metrics().total_tokens == 1
+
+    # a fast first token is not
+    service = _Latent([0.0])
+    assert list(hedge(after=0.05).invoke(request("A"), service)) == ["reply 0"]
+
+    # the delay can be learned
+    service = _Latent([0.01] * 20 + [1.0, 0.0])
+    for _ in range(20):
+        str(hedge().invoke(request("B"), service))
+    assert len(service.tokens) == 20
+    assert str(hedge().invoke(request("B"), service)) == "reply 21"
+    hedging = sys.modules["haverscript.middleware"].Hedging.of(("_Latent", None, "B"))
+    assert (hedging.requests, hedging.hedges, hedging.wins) == (21, 1, 1)
+    # the slow original request is sampled, not the hedge that won
+    assert hedging.latencies[-1] >= hedging.delay(95) > 0
+
+    # exceptions of any kind reach the caller
+    service = _Latent([KeyboardInterrupt(), KeyboardInterrupt()])
+    with pytest.raises(KeyboardInterrupt):
+        hedge(after=0.05).invoke(request("C"), service)
+
+    # failures are left to retry
+    service = _Latent([None, 0.0])
+    middleware = hedge(after=1.0) | retry(stop=stop_after_attempt(2))
+    start = time.monotonic()
+    assert str(middleware.invoke(request("C"), service)) == "reply 1"
+    assert time.monotonic() - start < 0.5
+
+
+def test_connect_pool():
+    inject()
+    ollama = sys.modules["haverscript.ollama"]
+    Ollama = ollama.Ollama
+
+    # injected clients are used for the default pool
+    client = Ollama.client[None, ollama.Pool()]
+    connect(test_model_name).chat("Hello")
+    assert Ollama.client[None, ollama.Pool()] is client
+
+    # concurrent connects to a new host share one client
+    host = "http://pool.invalid:11434"
+    threads = [
+        threading.Thread(
+            target=connect,
+            args=(test_model_name, host),
+            kwargs=dict(max_connections=8, keepalive=30, timeout=2),
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool = ollama.Pool(8, 30, 2)
+    assert len([key for key in Ollama.client if key[0] == host]) == 1
+    client = Ollama.client[host, pool]
+    assert client._client.timeout.read == 2
+
+    connect(test_model_name, host, max_connections=8, keepalive=30, timeout=2)
+    assert Ollama.client[host, pool] is client
+    # a different pool gets its own client, and does not replace this one
+    connect(test_model_name, host, max_connections=16)
+    connect(test_model_name, host)
+    assert Ollama.client[host, pool] is client
+    assert Ollama.client[host, ollama.Pool()] is not client
+    assert Ollama.client[host, ollama.Pool(max_connections=16)] is not client
+
+
+def test_ollama_prefixes(sample_model):
+    Ollama = sys.modules["haverscript.ollama"].Ollama
+    connect(test_model_name, keep_alive="30m").chat("Hello")
+    client = Ollama.client[None, Pool()]
+    assert client.keep_alive == "30m"
+    sample_model.chat("Hello")
+    assert client.keep_alive is None
+
+    prefixes = sys.modules["haverscript.ollama"].Prefixes()
+    first = [{"role": "user", "content": "x" * 400}]
+    # nothing is cached in a new conversation, which sets 4 characters a token
+    chunk = {"prompt_eval_count": 100, "eval_count": 50}
+    assert prefixes.cached("A", first, "y" * 200, chunk) == 0
+    second = first + [
+        {"role": "assistant", "content": "y" * 200},
+        {"role": "user", "content": "z" * 40},
+    ]
+    # only the 10 new tokens were evaluated, so 150 were cached
+    chunk = {"prompt_eval_count": 10, "eval_count": 1}
+    assert prefixes.cached("A", second, "ok", chunk) == 150
+    # every token was evaluated, so nothing was cached
+    chunk = {"prompt_eval_count": 160, "eval_count": 1}
+    assert prefixes.cached("A", second, "ok", chunk) == 0
+    # the cache is per model
+    chunk = {"prompt_eval_count": 10, "eval_count": 1}
+    assert prefixes.cached("B", second, "ok", chunk) == 0
+
+    metrics = OllamaMetrics(100, 0, 10, 0, 1, 0, cached_prompt_tokens=150)
+    assert metrics.prefix_hit_rate == 150 / 160
+    assert replace(metrics, cached_prompt_tokens=0).prefix_hit_rate == 0
+
+
+class _FakeOllama(http.server.BaseHTTPRequestHandler):
+    """Just enough of ollama's HTTP API for a fleet"""
+
+    def reply(self, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        models = [{"model": model, "name": model} for model in self.server.loaded]
+        self.reply({"models": models})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.loaded.add(request["model"])
+        self.server.asked.append(request["messages"][-1]["content"])
+        metrics = dict.fromkeys(OllamaMetrics.__dataclass_fields__, 0)
+        content = self.server.server_address[1]
+        self.reply(
+            {"model": request["model"], "done": True}
+            | {"message": {"role": "assistant", "content": str(content)}}
+            | metrics
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fleet(caplog):
+    servers = []
+    for loaded in [set(), {"B"}, set()]:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _FakeOllama)
+        server.loaded, server.asked = loaded, []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    hostnames = [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+    ports = [str(server.server_address[1]) for server in servers]
+
+    def request(prompt, model, context=()):
+        return Request(
+            contexture=Contexture(model=model, context=context), prompt=prompt
+        )
+
+    fleet = Fleet(hostnames, health_interval=None)
+    fleet.check()
+    assert fleet.list() == ["B"]
+    # routed to the host with the model loaded
+    assert str(fleet.ask(request("Hello", "B"))) == ports[1]
+    # ... which ollama lists with its tag
+    servers[2].loaded.add("C:latest")
+    fleet.check()
+    assert str(fleet.ask(request("Hello", "C"))) == ports[2]
+
+    # ... and to where it was last asked for
+    replies = [fleet.ask(request(f"{i}", "A")) for i in range(3)]
+    assert [str(reply) for reply in replies] == [ports[0]] * 3
+
+    # open replies are balanced over the hosts
+    fleet = Fleet(hostnames, routing=LEAST_OUTSTANDING, health_interval=None)
+    replies = [fleet.ask(request(f"{i}", "A")) for i in range(4)]
+    assert [str(reply) for reply in replies] == ports + [ports[0]]
+    assert all(host.outstanding == 0 for host in fleet.hosts)
+
+    # a conversation stays on the same host
+    open_reply = fleet.ask(request("Hello", "A"))
+    first = fleet.ask(request("Hi", "A"))
+    assert str(first) == ports[1]
+    context = (Exchange(prompt="Hi", images=(), reply=str(first)),)
+    assert str(fleet.ask(request("And?", "A", context))) == ports[1]
+    assert str(open_reply) == ports[0]
+
+    # replies that are cancelled, fail part way, or are never read, are released
+    class Broken(LanguageModel):
+        def ask(self, request):
+            def tokens():
+                yield "Hello"
+                raise ConnectionError()
+
+            return Reply(tokens())
+
+    failing = Fleet(hostnames, routing=LEAST_OUTSTANDING, health_interval=None)
+    failing.hosts[0].ollama = Broken()
+    with pytest.raises(ConnectionError):
+        str(failing.ask(request("Hello", "A")))
+    failing.ask(request("Hello", "A")).cancel()
+
+    async def abandon():
+        (await failing.aask(request("Hello", "A"))).cancel()
+        reply = await failing.aask(request("Hello", "A"))
+        del reply
+        gc.collect()
+
+    asyncio.run(abandon())
+    assert [host.outstanding for host in failing.hosts] == [0, 0, 0]
+
+    # a health check that fails unexpectedly ejects the host, and is logged,
+    # and the background checks carry on
+    class Malformed:
+        checked = 0
+
+        def loaded(self):
+            Malformed.checked += 1
+            raise ValueError("malformed reply")
+
+    flaky = Fleet(hostnames, health_interval=0.01)
+    flaky.hosts[0].ollama = Malformed()
+    with caplog.at_level("ERROR", logger="haverscript"):
+        flaky.check()
+    now = time.monotonic()
+    assert [host.healthy(now) for host in flaky.hosts] == [False, True, True]
+    assert "B:latest" in flaky.hosts[1].models
+    assert "health check of" in caplog.text and "malformed reply" in caplog.text
+    for host in flaky.hosts:
+        host.ollama = Malformed()
+    with caplog.at_level("CRITICAL", logger="haverscript"):
+        flaky.start()
+        time.sleep(0.2)
+        assert flaky.checker.is_alive() and Malformed.checked > 4
+        flaky.health_interval = 3600  # leave the checker asleep
+        time.sleep(0.05)
+
+    # a host that is down is ejected, and the request goes elsewhere
+    servers[1].shutdown()
+    servers[1].server_close()
+    assert str(fleet.ask(request("And?", "A", context))) in (ports[0], ports[2])
+    now = time.monotonic()
+    assert [host.healthy(now) for host in fleet.hosts] == [True, False, True]
+    assert all(host.outstanding == 0 for host in fleet.hosts)
+
+    fleet.eject(fleet.hosts[0])
+    fleet.eject(fleet.hosts[2])
+    with pytest.raises(LLMConnectivityError):
+        fleet.ask(request("Hello", "A"))
+    # a health check brings back the hosts that are up
+    fleet.check()
+    now = time.monotonic()
+    assert [host.healthy(now) for host in fleet.hosts] == [True, False, True]
+
+    model = fleet_connect("A", hostnames, health_interval=None)
+    assert model.chat("Hello").reply in (ports[0], ports[2])
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_ollama_loops(monkeypatch):
+    # connections kept alive between event loops must not be reused
+    Ollama = sys.modules["haverscript.ollama"].Ollama
+    monkeypatch.setattr(Ollama, "async_client", weakref.WeakKeyDictionary())
+
+    class KeepAlive(_FakeOllama):
+        protocol_version = "HTTP/1.1"
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), KeepAlive)
+    server.loaded, server.asked = set(), []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+        model = connect("A", f"http://127.0.0.1:{port}")
+        for _ in range(3):
+            assert asyncio.run(model.achat("Hello")).reply == str(port)
+        assert server.asked == ["Hello"] * 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 #
 
 
@@ -725,6 +1955,149 @@ def test_Reply():
     assert closing == [True, True, False, False]
 
 
+def test_Reply_add():
+    """Test that chains of Reply + Reply are flat, and close in order"""
+    closed = []
+
+    def reply(name):
+        reply = Reply([name])
+        reply.after(lambda: closed.append(name))
+        return reply
+
+    ab = reply("a") + reply("b")
+    ab.after(lambda: closed.append("ab"))
+    abc = ab + reply("c")
+    abc.after(lambda: closed.append("abc"))
+    assert str(abc) == "abc"
+    assert closed == ["a", "b", "ab", "c", "abc"]
+    assert str(ab) == "ab"
+    assert closed == ["a", "b", "ab", "c", "abc"]
+
+    # deeper than the recursion limit
+    chain = Reply([])
+    for i in range(sys.getrecursionlimit() * 2):
+        chain = chain + Reply(["."])
+    assert str(chain) == "." * sys.getrecursionlimit() * 2
+
+
+def test_Reply_packets():
+    """Test that Reply remembers the text, metrics and value as they pass"""
+
+    class TestMetrics(Metrics):
+        pass
+
+    metrics = TestMetrics()
+    packets = ["Hello", Informational(message="..."), " World", metrics]
+    packets += [Value(value={"a": 1}), Value(value={"b": 2})]
+    reply = Reply(iter(packets))
+    assert reply.value == {"a": 1}
+    assert reply.metrics() is metrics
+    assert str(reply) == "Hello World"
+    assert str(reply) is str(reply)
+    # every consumer sees every packet, in order
+    assert list(reply) == packets
+    assert list(reply.tokens()) == ["Hello", " World"]
+
+    empty = Reply([])
+    assert (str(empty), empty.metrics(), empty.value) == ("", None, None)
+
+
+def test_Reply_subscribe():
+    """Test that a Reply with subscribers only keeps unread packets"""
+
+    tokens = [f"{i} " for i in range(1000)]
+    text = "".join(tokens)
+
+    # a long reply streamed to a file keeps almost nothing
+    written, kept = [], []
+    reply = Reply(iter(tokens))
+    reply.subscribe(written.append)
+    reply.subscribe(lambda packet: kept.append(len(reply._cache)))
+    reply.drain()
+    assert written == tokens
+    assert max(kept) <= 2
+    with pytest.raises(LLMInternalError):
+        str(reply)
+    with pytest.raises(LLMInternalError):
+        list(reply)
+
+    # str keeps the text, if asked before any is dropped
+    written = []
+    reply = Reply(iter(tokens))
+    reader = iter(reply)
+    assert next(reader) == tokens[0]
+    reply.subscribe(written.append)
+    assert str(reply) == text
+    assert written == tokens
+    # the earlier reader holds on to the packets it has still to read
+    assert len(reply._cache) == 1000
+    assert list(reader) == tokens[1:]
+    assert len(reply._cache) == 0
+
+    closed = []
+    reply = Reply(iter(tokens))
+    reply.after(lambda: closed.append(True))
+    reply.subscribe(lambda packet: None)
+    reply.drain()
+    assert closed == [True]
+
+    # keep_text, for str() once the reply is read
+    reply = Reply(iter(tokens))
+    reply.keep_text()
+    reply.subscribe(lambda packet: None)
+    reply.drain()
+    assert str(reply) == text
+
+    # readers that find the reply broadcasting, part way, still read it all
+    def slow():
+        for token in tokens:
+            time.sleep(0.0001)
+            yield token
+
+    for _ in range(5):
+        reply = Reply(slow())
+        results = [[] for _ in range(8)]
+        threads = [
+            threading.Thread(target=lambda result: result.extend(reply), args=(result,))
+            for result in results
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.01)
+        reply.subscribe(lambda packet: None)
+        for thread in threads:
+            thread.join()
+        assert results == [tokens] * 8
+        assert len(reply._cache) == 0
+
+
+def test_AsyncReply():
+    """Test that AsyncReply can be consumed by many tasks"""
+
+    async def gen(xs):
+        for x in xs:
+            await asyncio.sleep(0.01)
+            yield f"{x} "
+
+    async def main():
+        reply = AsyncReply(gen(range(10)))
+        closed = []
+        reply.after(lambda: closed.append(True))
+
+        async def consume():
+            return [int(x) async for x in reply.tokens()]
+
+        results = await asyncio.gather(*[consume() for _ in range(10)])
+        assert results == [list(range(10))] * 10
+        assert closed == [True]
+        assert await reply.metrics() is None
+
+        m12 = AsyncReply(gen(range(3))) + AsyncReply.from_reply(Reply(["3 ", "4 "]))
+        assert (await m12.text()).split() == ["0", "1", "2", "3", "4"]
+
+    asyncio.run(main())
+
+
 def test_cache_class(tmp_path):
     temp_file = tmp_path / "cache.db"
     cache = Cache(temp_file, "a+")
@@ -744,7 +2117,7 @@ def test_cache_class(tmp_path):
     )
 
     # pretend that the database is read fresh
-    cache.conn.execute("DELETE FROM blacklist;")
+    cache.store.blacklisted.clear()
 
     assert cache.lookup_interactions(
         system, context, prompt, images, options, limit=None, blacklist=False
@@ -776,6 +2149,9 @@ def test_cache_class(tmp_path):
     ) == {
         INTERACTION(1): (prompt, images, reply),
     }
+    # timestamps vary from run to run
+    cache.conn.execute("UPDATE interactions SET created = 0, accessed = 0")
+    cache.conn.commit()
     result = subprocess.run(
         f'echo ".dump" | sqlite3 {temp_file}',
         shell=True,
@@ -790,63 +2166,357 @@ def test_cache_class(tmp_path):
 sql_dump = """
 PRAGMA foreign_keys=OFF;
 BEGIN TRANSACTION;
+CREATE TABLE collections (
+    id INTEGER PRIMARY KEY,         -- one row for each garbage collection
+    time REAL
+);
+CREATE TABLE codecs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,             -- zlib or zstd
+    dictionary BLOB                 -- trained zstd dictionary, if any
+);
 CREATE TABLE string_pool (
     id INTEGER PRIMARY KEY,
-    string TEXT NOT NULL UNIQUE
+    hash BLOB NOT NULL UNIQUE,      -- digest of the string
+    string TEXT,                    -- the string, when not compressed
+    data BLOB,                      -- the compressed string
+    codec INTEGER,                  -- how data was compressed
+    FOREIGN KEY (codec)         REFERENCES codecs(id)
 );
-INSERT INTO string_pool VALUES(1,'Hello');
-INSERT INTO string_pool VALUES(2,'[]');
-INSERT INTO string_pool VALUES(3,'World');
-INSERT INTO string_pool VALUES(4,'Hello2');
-INSERT INTO string_pool VALUES(5,'World2');
-INSERT INTO string_pool VALUES(6,'Hello!');
-INSERT INTO string_pool VALUES(7,'["foo.png"]');
-INSERT INTO string_pool VALUES(8,'Wombat');
-INSERT INTO string_pool VALUES(9,'...');
-INSERT INTO string_pool VALUES(10,'{"model": "modal"}');
-INSERT INTO string_pool VALUES(11,'Hello!..2');
-INSERT INTO string_pool VALUES(12,'Wombat..2');
-INSERT INTO string_pool VALUES(13,'Wombat (Again)');
+INSERT INTO string_pool VALUES(1,X'ad10196e1159e75dd6be7d03f75be04f','Hello',NULL,NULL);
+INSERT INTO string_pool VALUES(2,X'7ebb3c7c2a87b1a2f8a7ed729ecb040d','[]',NULL,NULL);
+INSERT INTO string_pool VALUES(3,X'29a5a4d65bd0a24de55ed48e851fc4d9','World',NULL,NULL);
+INSERT INTO string_pool VALUES(4,X'af9a771c466b425b4edb757129605fae','Hello2',NULL,NULL);
+INSERT INTO string_pool VALUES(5,X'c88ceeb9b740ae0ac417fc9140323823','World2',NULL,NULL);
+INSERT INTO string_pool VALUES(6,X'35ea251a17a6c1a18823ae2b88906c91','Hello!',NULL,NULL);
+INSERT INTO string_pool VALUES(7,X'980973746980176bd3da731d75baa024','["foo.png"]',NULL,NULL);
+INSERT INTO string_pool VALUES(8,X'e954cf7b106612805638e2d1513338a4','Wombat',NULL,NULL);
+INSERT INTO string_pool VALUES(9,X'886a2fad908ce17e95931c902a52c5ee','...',NULL,NULL);
+INSERT INTO string_pool VALUES(10,X'03f1c9b19275c7bd38a23863ef92d1f6','{"model": "modal"}',NULL,NULL);
+INSERT INTO string_pool VALUES(11,X'319faed87b35d5b374adb587cd436072','Hello!..2',NULL,NULL);
+INSERT INTO string_pool VALUES(12,X'b26f91b62f4bb1b330cf0a3896c87366','Wombat..2',NULL,NULL);
+INSERT INTO string_pool VALUES(13,X'8022c1ae2f2093043c03503d401e641b','Wombat (Again)',NULL,NULL);
 CREATE TABLE context (
     id INTEGER PRIMARY KEY,
     prompt INTEGER  NOT NULL,       -- what was said to the LLM
     images INTEGER NOT NULL,        -- string of list of images
     reply INTEGER NOT NULL,         -- reply from the LLM
     context INTEGER,
+    hash BLOB,                      -- content address of the whole context
     FOREIGN KEY (prompt)        REFERENCES string_pool(id),
     FOREIGN KEY (images)        REFERENCES string_pool(id),
     FOREIGN KEY (reply)         REFERENCES string_pool(id),
     FOREIGN KEY (context)       REFERENCES interactions(id)
 );
-INSERT INTO context VALUES(1,1,2,3,NULL);
-INSERT INTO context VALUES(2,4,2,5,1);
-INSERT INTO context VALUES(3,6,7,8,2);
-INSERT INTO context VALUES(4,11,7,12,2);
-INSERT INTO context VALUES(5,6,7,13,2);
+INSERT INTO context VALUES(1,1,2,3,NULL,X'b463ab8dc007937d29b32ce6c95df6bd');
+INSERT INTO context VALUES(2,4,2,5,1,X'bc9fbf92b961b99d2b05af151a3b78fb');
+INSERT INTO context VALUES(3,6,7,8,2,X'811126f4549d86e31a0984f705ed310b');
+INSERT INTO context VALUES(4,11,7,12,2,X'9f50eb72135e321079767f92e7216a4e');
+INSERT INTO context VALUES(5,6,7,13,2,X'eef55188e5218c03dd956277471c9d1e');
 CREATE TABLE interactions (
     id INTEGER PRIMARY KEY,
     system INTEGER,
     context INTEGER,
     parameters INTEGER NOT NULL,
+    created REAL,                   -- when the interaction was added (unix time)
+    accessed REAL,                  -- when the interaction was last used (unix time)
+    model INTEGER,                  -- name of the model
+    format INTEGER,                 -- requested format, as JSON
     FOREIGN KEY (system)        REFERENCES string_pool(id),
     FOREIGN KEY (context)       REFERENCES context(id),
-    FOREIGN KEY (parameters)    REFERENCES string_pool(id)
+    FOREIGN KEY (parameters)    REFERENCES string_pool(id),
+    FOREIGN KEY (model)         REFERENCES string_pool(id),
+    FOREIGN KEY (format)        REFERENCES string_pool(id)
 );
-INSERT INTO interactions VALUES(1,9,3,10);
-INSERT INTO interactions VALUES(2,9,4,10);
-INSERT INTO interactions VALUES(3,9,5,10);
-CREATE INDEX string_index ON string_pool(string);
+INSERT INTO interactions VALUES(1,9,3,10,0.0,0.0,NULL,NULL);
+INSERT INTO interactions VALUES(2,9,4,10,0.0,0.0,NULL,NULL);
+INSERT INTO interactions VALUES(3,9,5,10,0.0,0.0,NULL,NULL);
+CREATE UNIQUE INDEX context_hash_index ON context(hash);
 CREATE INDEX context_prompt_index ON context(prompt);
 CREATE INDEX context_images_index ON context(images);
 CREATE INDEX context_reply_index ON context(reply);
-CREATE INDEX context_context_index ON context(context);
-CREATE INDEX interactions_system_index ON interactions(system);
-CREATE INDEX interactions_context_index ON interactions(context);
-CREATE INDEX interactions_parameters_index ON interactions(parameters);
+CREATE INDEX context_lookup_index ON context(context, prompt, images, reply);
+CREATE INDEX interactions_lookup_index
+    ON interactions(context, system, parameters, model, format);
+CREATE INDEX interactions_accessed_index ON interactions(accessed);
 COMMIT;
 """.strip()
 
 
+def test_cache_upgrade(sample_model, tmp_path, monkeypatch):
+    temp_file = tmp_path / "cache.db"
+    model = sample_model | cache(temp_file)
+    session = model.chat("### Hello").chat("### World")
+    hashes = Cache(temp_file, "a+").conn.execute("SELECT hash FROM context").fetchall()
+
+    # rewrite the cache file as a version 2 cache
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    conn = sqlite3.connect(temp_file)
+    conn.executescript("""
+        CREATE TABLE interactions_2 (
+            id INTEGER PRIMARY KEY,
+            system INTEGER,
+            context INTEGER NOT NULL,
+            parameters INTEGER NOT NULL
+        );
+        INSERT INTO interactions_2 SELECT id, system, context, parameters
+            FROM interactions;
+        DROP TABLE interactions;
+        ALTER TABLE interactions_2 RENAME TO interactions;
+        CREATE INDEX interactions_context_index ON interactions(context);
+        DROP INDEX context_lookup_index;
+        CREATE INDEX context_context_index ON context(context);
+        DROP INDEX context_hash_index;
+        ALTER TABLE context DROP COLUMN hash;
+        CREATE TABLE string_pool_2 (
+            id INTEGER PRIMARY KEY,
+            string TEXT NOT NULL UNIQUE
+        );
+        INSERT INTO string_pool_2 SELECT id, string FROM string_pool;
+        DROP TABLE string_pool;
+        ALTER TABLE string_pool_2 RENAME TO string_pool;
+        CREATE INDEX string_index ON string_pool(string);
+        PRAGMA user_version = 2;
+        """)
+    copy = tmp_path / "copy.db"
+    with sqlite3.connect(copy) as target:
+        conn.backup(target)
+    target.close()
+    conn.close()
+
+    # the model of older interactions is not known
+    cache_ = Cache(temp_file, "r")
+    replies = cache_.lookup_interactions(
+        None, session.parent.contexture.context, "### World", [], {}, None, False
+    )
+    assert [reply for (_, _, reply) in replies.values()] == [session.reply]
+    conn = cache_.conn
+    assert conn.execute("SELECT hash FROM context").fetchall() == hashes
+    assert conn.execute("PRAGMA user_version").fetchone() == (SQL_VERSION,)
+    names = {name for (name,) in conn.execute("SELECT name FROM sqlite_master")}
+    assert "string_index" not in names
+    assert "context_context_index" not in names
+    assert "interactions_lookup_index" in names
+
+    # processes upgrading the same file at once take turns
+    Store = sys.modules["haverscript.cache"].Store
+    UPGRADES = sys.modules["haverscript.cache"].UPGRADES
+    errors = []
+
+    def slowly(step):
+        def upgrade(conn):
+            time.sleep(0.1)
+            step(conn)
+
+        return upgrade
+
+    for version, step in list(UPGRADES.items()):
+        monkeypatch.setitem(UPGRADES, version, slowly(step))
+
+    def upgrade():
+        try:
+            Store(str(copy))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upgrade) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    conn = sqlite3.connect(copy)
+    assert conn.execute("PRAGMA user_version").fetchone() == (SQL_VERSION,)
+    conn.close()
+
+
+def test_cache_evict(sample_model, tmp_path, capsys):
+    temp_file = tmp_path / "cache.db"
+    model = sample_model | cache(temp_file, "a")
+    replies = [model.chat(f"### {i}").reply for i in range(10)]
+
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    cache_ = Cache(temp_file, "a")
+    cache_.touch(INTERACTION(1))  # most recently used
+    assert cache_.store.evict(Retention(max_rows=8)) == 2
+    # what they used is left to be collected in one pass, once eviction is done
+    assert cache_.conn.execute("SELECT count(*) FROM context").fetchone() == (10,)
+    main(["gc", str(temp_file), "--max-rows", "5"])
+    assert "evicted 3 interactions" in capsys.readouterr().out
+
+    conn = cache_.conn
+    assert conn.execute("SELECT count(*) FROM interactions").fetchone() == (5,)
+    assert conn.execute("SELECT count(*) FROM context").fetchone() == (5,)
+    assert conn.execute(
+        "SELECT id FROM string_pool WHERE hash = ?", (string_hash("### 0"),)
+    ).fetchone()
+
+    model = sample_model | cache(temp_file, "r")
+    assert model.chat("### 6").reply == replies[6]
+
+    # readers save their uses too, so gc keeps what they use
+    Cache(str(temp_file), "r").store.save_accessed_now()
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    main(["gc", str(temp_file), "--max-rows", "1"])
+    assert conn.execute("SELECT id FROM interactions").fetchall() == [(7,)]
+
+    assert cache_.store.prune(Retention(max_age=0)) == 1
+    assert conn.execute("SELECT count(*) FROM string_pool").fetchone() == (0,)
+
+    # max_bytes evicts only what it must, least recently used first
+    cache_ = Cache(tmp_path / "bytes.db", "a")
+    keys = cache_.insert_interactions(
+        [(None, (), f"{i}", [], f"{i} " * 1000, {}) for i in range(300)]
+    )
+    for key in keys[:30]:
+        cache_.touch(key)
+    store = cache_.store
+    size = store.size()
+    evicted = store.prune(Retention(max_bytes=int(size * 0.8)))
+    assert 40 <= evicted <= 90
+    assert store.size() <= size * 0.8
+    kept = {id for (id,) in store.conn.execute("SELECT id FROM interactions")}
+    assert {key.id for key in keys[:30] + keys[evicted + 30 :]} == kept
+
+
+def test_cache_model(sample_model, tmp_path):
+    temp_file = tmp_path / "cache.db"
+    models = [
+        sample_model,
+        connect("other-model"),
+        sample_model | format(),
+        sample_model | options(seed=1),
+        sample_model | options(seed=2),
+    ]
+    replies = [(model | cache(temp_file, "a")).chat("### Hello") for model in models]
+    assert len({reply.reply for reply in replies}) == 5
+
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    for model, reply in zip(models, replies):
+        assert (model | cache(temp_file, "r")).chat("### Hello").reply == reply.reply
+        assert [child.reply for child in (model | cache(temp_file)).children()] == [
+            reply.reply
+        ]
+
+
+@pytest.mark.parametrize("transport", ["tcp", "unix"])
+def test_cache_server(sample_model, tmp_path, transport):
+    if transport == "tcp":
+        server = serve(tmp_path / "cache.db", ("127.0.0.1", 0))
+        url = "tcp://127.0.0.1:%d" % server.server_address[1]
+    else:
+        server = serve(tmp_path / "cache.db", str(tmp_path / "cache.sock"))
+        url = f"unix://{tmp_path / 'cache.sock'}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        model = sample_model | cache(url)
+        session = model.chat("### Hello").chat("### World")
+        # in the same session, we get a fresh reply
+        assert model.chat("### Hello").reply != session.parent.reply
+        RemoteBackend.of(url).flush()
+
+        # another session (typically, another process) shares the replies
+        RemoteBackend.clients = {}
+        model = sample_model | cache(url, "r")
+        assert model.chat("### Hello").chat("### World").render() == session.render()
+        assert len(model.children("### Hello")) == 2
+
+        # inserts are sent after batch_delay, without waiting for another call
+        backend = RemoteBackend.of(url)
+        backend.batch_delay = 0.1
+        reply = (sample_model | cache(url, "a")).chat("### Batch").reply
+        time.sleep(0.5)
+        assert not backend.pending
+        RemoteBackend.clients = {}
+        assert (sample_model | cache(url, "r")).chat("### Batch").reply == reply
+
+        # calls made at once use their own connections, in one session
+        backend = RemoteBackend.of(url)
+        busy = backend.connect()
+        assert (sample_model | cache(url)).children("### Batch")
+        assert server.sessions[backend.session].connections == 2
+        busy.close()
+
+        # uses of replies found in memory are sent too
+        backend.touch(INTERACTION(1))
+        assert backend.touched == {1}
+        backend.flush()
+        assert not backend.touched
+
+        # the server's options can not be changed by its clients
+        with pytest.raises(LLMConfigurationError):
+            (sample_model | cache(url, compress="zlib")).chat("### Hello")
+    finally:
+        RemoteBackend.clients = {}
+        server.shutdown()
+        server.server_close()
+
+
+def test_cache_context_address(monkeypatch):
+    exchanges = [Exchange(prompt=f"{i}", images=(), reply=f"{i}!") for i in range(4)]
+    history = History.of(exchanges[:3])
+    hashes = context_hashes(tuple(exchanges[:3]))
+    assert context_address(history) == hashes[-1]
+    assert context_address(()) is None
+
+    # each History remembers its content address, so a new turn hashes once
+    cache_module = sys.modules["haverscript.cache"]
+    hashed = []
+    context_hash = cache_module.context_hash
+
+    def counting(*args):
+        hashed.append(args)
+        return context_hash(*args)
+
+    expected = context_hashes(tuple(exchanges))
+    monkeypatch.setattr(cache_module, "context_hash", counting)
+    longer = history.append(exchanges[3])
+    assert context_hashes(longer) == expected
+    assert context_address(longer) == expected[-1]
+    assert len(hashed) == 1
+
+
+def test_cache_memory(sample_model, tmp_path):
+    Memory.instances = {}
+    model = sample_model | cache(":memory-lru:", max_entries=2)
+    replies = [model.chat(f"### {i}").reply for i in range(3)]
+    assert model.chat("### 2").reply == replies[2]
+    assert model.chat("### 1").reply == replies[1]
+    # least recently used
+    assert model.chat("### 0").reply != replies[0]
+    # different format
+    assert (model | format()).chat("### 1").reply != replies[1]
+
+    temp_file = tmp_path / "cache.db"
+    session = (sample_model | cache(temp_file, "a")).chat("### Hello")
+
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    model = sample_model | cache(temp_file, "r", max_entries=10)
+    assert model.chat("### Hello").reply == session.reply
+    # now served from memory
+    conn = Cache(temp_file, "a").conn
+    conn.execute("DELETE FROM interactions")
+    conn.commit()
+    assert model.chat("### Hello").reply == session.reply
+
+    # replies found in memory are still used, as far as retention is concerned
+    temp_file = str(tmp_path / "retention.db")
+    writer = sample_model | cache(temp_file, "a")
+    hello, world = writer.chat("### Hello"), writer.chat("### World")
+    sys.modules["haverscript.cache"].Cache.connections = {}
+    model = sample_model | cache(temp_file, "r", max_entries=10)
+    assert model.chat("### Hello").reply == hello.reply
+    assert model.chat("### World").reply == world.reply
+    assert model.chat("### Hello").reply == hello.reply  # from memory
+    store = Cache(temp_file, "a").store
+    store.save_accessed_now()
+    assert store.prune(Retention(max_rows=1)) == 1
+    assert model.chat("### Hello").reply == hello.reply
+    assert store.conn.execute("SELECT count(*) FROM interactions").fetchone() == (1,)
+    assert (sample_model | cache(temp_file, "r")).chat("### Hello").reply == hello.reply
+
+
 def test_transcript(sample_model: Model, tmp_path: str):
     temp_dir = tmp_path / "transcripts"
 